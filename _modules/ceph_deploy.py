@@ -17,26 +17,79 @@ import time
 import errno
 import re
 import shutil
-import ConfigParser
 import struct
 import base64
 import uuid
+import json
+import socket
+import subprocess
+import signal
+import threading
+import Queue
+import functools
+import hashlib
+import atexit
 
 # Import salt libs
 from salt import utils
 
+# Import third party libs
+try:
+    import rados
+    HAS_RADOS = True
+except ImportError:
+    HAS_RADOS = False
+
 __virtualname__ = 'ceph_deploy'
 
 COMMAND_TIMEOUT = 180                   # 180 seconds
+UDEV_SETTLE_TIMEOUT = 60                # 60 seconds
+
+OSD_BATCH_WORKERS = 8                   # Default workers of OSD batch
+OSD_ROLLING_TIMEOUT = 900               # 15 minutes per restart step
+OSD_ROLLING_INTERVAL = 5                # 5 seconds between health polls
+
+CRUSH_RAMP_STEP = 0.1                   # Fraction of target weight per step
+CRUSH_RAMP_MAX_RECOVERING = 10          # Max PGs recovering to step on
+CRUSH_RAMP_INTERVAL = 30                # 30 seconds between load polls
+CRUSH_RAMP_TIMEOUT = 3600               # 1 hour per ramp step
+
+# cluster flags held while a batch of OSDs is added or removed, flags the
+# cluster does not know, e.g. norebalance before hammer, are skipped
+MAINTENANCE_ADD_FLAGS = ['norebalance', 'nobackfill']
+MAINTENANCE_REMOVE_FLAGS = ['noout', 'norebalance', 'nobackfill']
+MAINTENANCE_THROTTLE = dict(            # OSD options injected meanwhile
+    osd_max_backfills=1,
+    osd_recovery_max_active=1,
+)
+MAINTENANCE_SETTLE_TIMEOUT = 1800       # 30 minutes throttled after release
+MAINTENANCE_SETTLE_INTERVAL = 5         # 5 seconds between health polls
 
 CEPH_CLUSTER = 'ceph'                   # Default cluster name
 CEPH_CONNECT_TIMEOUT = 30               # 60 seconds
+CEPH_ASOK_TIMEOUT = 5                   # 5 seconds
+MON_QUORUM_TIMEOUT = 300                # 5 minutes
+MON_QUORUM_MIN_DELAY = 0.2              # First poll of mon_status
+MON_QUORUM_MAX_DELAY = 10               # Max delay between polls
 
 JOURNAL_UUID = '45b0969e-9b03-4f30-b4c6-b4b80ceff106'
 OSD_UUID = '4fbd7e29-9d25-41b8-afd0-062c0ceff05d'
 
 DEFAULT_FS_TYPE = 'xfs'
 
+OSD_CACHE_DIR = '/var/cache/ceph-formula/osd'
+
+FINGERPRINT_DIR = '/var/cache/ceph-formula/fingerprint'
+FINGERPRINT_TTL = 3600                  # 1 hour
+
+RESTART_FILE = '/var/cache/ceph-formula/restart.json'
+
+RAMP_FILE = '/var/cache/ceph-formula/ramp.json'
+
+TRACE_FILE = '/var/cache/ceph-formula/trace.json'
+TRACE_MAX_RECORDS = 2000                # Max commands recorded per call
+TRACE_MAX_TRACES = 200                  # Max traces kept in TRACE_FILE
+
 MOUNT_OPTIONS = dict(
     btrfs='noatime,user_subvol_rm_allowed',
     # user_xattr is default ever since linux 2.6.39 / 3.0, but we'll
@@ -102,12 +155,449 @@ def _error(ret, msg):
     return ret
 
 
+class _CephTrace(object):
+    '''
+    Records of external commands run by the outermost traced operation.
+
+    A trace begins when the first traced operation is entered and ends when
+    it returns, nested operations, even those run by worker threads, add
+    their commands to the same trace. Each record is tagged with the
+    innermost operation of the thread that ran the command. The finished
+    trace is appended to the last TRACE_MAX_TRACES traces in TRACE_FILE,
+    tagged with the minion job process, for trace_last.
+    '''
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    _depth = 0
+    _trace = None
+
+    @classmethod
+    def __ops(cls):
+        if not hasattr(cls._local, 'ops'):
+            cls._local.ops = []
+        return cls._local.ops
+
+    @classmethod
+    def current(cls):
+        '''
+        Get the operations the current thread is in.
+
+        :return: A list of operation names, the innermost is the last.
+        '''
+        return list(cls.__ops())
+
+    @classmethod
+    def inherit(cls, ops):
+        '''
+        Make the current thread, e.g. a worker thread, run in the operations
+        of another thread.
+
+        :param ops: Operations returned by current.
+        :return: None.
+        '''
+        cls._local.ops = list(ops)
+
+    @classmethod
+    def enter(cls, op):
+        '''
+        Enter an operation, begin a new trace if it is the outermost one.
+
+        :param op: Name of the operation.
+        :return: True if it is the outermost operation.
+        '''
+        cls.__ops().append(op)
+
+        with cls._lock:
+            outermost = cls._depth == 0
+            if outermost:
+                cls._trace = {
+                    'operation': op,
+                    'job': os.getpid(),
+                    'started': time.time(),
+                    'elapsed': None,
+                    'commands': 0,
+                    'dropped': 0,
+                    'records': [],
+                }
+            cls._depth += 1
+
+        return outermost
+
+    @classmethod
+    def leave(cls, save=True):
+        '''
+        Leave the current operation.
+
+        :param save: Save the trace if the outermost operation is left.
+        :return: The finished trace if the outermost operation is left,
+        otherwise None.
+        '''
+        cls.__ops().pop()
+
+        with cls._lock:
+            cls._depth -= 1
+            if cls._depth != 0:
+                return None
+
+            trace = cls._trace
+            cls._trace = None
+
+        trace['elapsed'] = time.time() - trace['started']
+
+        if save:
+            cls.__save(trace)
+
+        return trace
+
+    @classmethod
+    def record(cls, cmd, stdout, stderr):
+        '''
+        Add a finished command to the current trace, if any.
+
+        :param cmd: _CephCmd finished.
+        :param stdout: Output of the command.
+        :param stderr: Error output of the command.
+        :return: None.
+        '''
+        cls.record_call(cmd.argv, cmd.started, cmd.elapsed, cmd.code,
+                        stdout, stderr, cmd.timed_out)
+
+    @classmethod
+    def record_call(cls, argv, started, elapsed, code, stdout, stderr,
+                    timed_out=False):
+        '''
+        Add a finished call to the current trace, if any, e.g. a monitor
+        command sent in process.
+
+        :param argv: Command and its arguments.
+        :param started: Start time of the call.
+        :param elapsed: Seconds the call took.
+        :param code: Exit code or errno of the call.
+        :param stdout: Output of the call.
+        :param stderr: Error output of the call.
+        :param timed_out: Whether the call timed out.
+        :return: None.
+        '''
+        ops = cls.__ops()
+
+        record = {
+            'operation': ops[-1] if ops else None,
+            'argv': argv,
+            'started': started,
+            'elapsed': elapsed,
+            'code': code,
+            'timed_out': timed_out,
+            'stdout_bytes': len(stdout),
+            'stderr_bytes': len(stderr),
+        }
+
+        with cls._lock:
+            if cls._trace is None:
+                return
+
+            cls._trace['commands'] += 1
+            if len(cls._trace['records']) < TRACE_MAX_RECORDS:
+                cls._trace['records'].append(record)
+            else:
+                cls._trace['dropped'] += 1
+
+    @classmethod
+    def __save(cls, trace):
+        # errors are ignored, tracing must never fail the operation, traces
+        # of jobs running concurrently may get lost
+        pdir = os.path.dirname(TRACE_FILE)
+
+        traces = cls.load()
+        traces.append(trace)
+
+        try:
+            if not os.path.exists(pdir):
+                os.makedirs(pdir, 0700)
+
+            (fd, path) = tempfile.mkstemp(prefix='trace.', dir=pdir)
+            with os.fdopen(fd, 'wb') as fobj:
+                json.dump(traces[-TRACE_MAX_TRACES:], fobj)
+            os.rename(path, TRACE_FILE)
+        except (IOError, OSError):
+            pass
+
+    @classmethod
+    def load(cls):
+        '''
+        Load the saved traces.
+
+        :return: A list of traces, the latest is the last.
+        '''
+        try:
+            with open(TRACE_FILE, 'rb') as fobj:
+                traces = json.load(fobj)
+        except (IOError, ValueError):
+            return []
+
+        # a single trace saved by older versions
+        if isinstance(traces, dict):
+            traces = [traces]
+        if not isinstance(traces, list):
+            return []
+
+        return traces
+
+
+def _trace_enabled():
+    try:
+        return bool(__salt__['config.get']('ceph_deploy.trace', False))
+    except (NameError, KeyError):
+        return False
+
+
+def _fingerprint_ttl():
+    try:
+        return int(__salt__['config.get']('ceph_deploy.fingerprint_ttl',
+                                          FINGERPRINT_TTL))
+    except (NameError, KeyError, TypeError, ValueError):
+        return FINGERPRINT_TTL
+
+
+def _traced(op, record=True):
+    '''
+    Decorator tags commands run by the decorated function with op.
+
+    If the decorated function is the outermost traced operation and returns
+    a state return dict, the trace is attached to it as ret['trace'] when the
+    ceph_deploy.trace config option is set.
+
+    Snapshots of block devices and daemons live as long as the outermost
+    operation, i.e. one state run, the minion process may run many.
+
+    :param op: Name of the operation, e.g. '_CephOsd.prepare'.
+    :param record: Save the trace of the operation if outermost, False for
+    cheap queries, e.g. liveness checks, not to crowd out others.
+    :return: The decorator.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ret = None
+
+            if _CephTrace.enter(op):
+                _BlockInventory.invalidate()
+                _CephHostStatus.invalidate()
+            try:
+                ret = func(*args, **kwargs)
+                return ret
+            finally:
+                trace = _CephTrace.leave(record)
+                if trace is not None:
+                    _BlockInventory.invalidate()
+                    _CephHostStatus.invalidate()
+                if trace is not None and record and isinstance(ret, dict) \
+                        and 'changes' in ret and _trace_enabled():
+                    ret['trace'] = trace
+        return wrapper
+    return decorator
+
+
+class _CephCmd(object):
+    '''
+    A command running in the background.
+
+    The argv list is passed to the process as is, no shell is involved.
+    stdout and stderr are read by background threads line by line, and can
+    be streamed to a callback while the command is running. The command is
+    killed if it does not finish in time.
+    '''
+    def __init__(self, argv, timeout=COMMAND_TIMEOUT, stdin=None,
+                 on_output=None):
+        '''
+        Init _CephCmd object.
+
+        :param argv: Command line to run, a list of arguments.
+        :param timeout: Seconds to wait before the command is killed.
+        :param stdin: Content to feed to stdin of the command.
+        :param on_output: Callable takes (stream, line), stream is 'stdout'
+        or 'stderr', called from the reader threads.
+        :return: None.
+        '''
+        super(_CephCmd, self).__init__()
+
+        if not isinstance(argv, list):
+            raise ValueError('cmd: {0} must be a list'.format(argv))
+
+        self.argv = [str(arg) for arg in argv]
+        self.timeout = timeout
+        self.stdin = stdin
+        self.on_output = on_output
+
+        self.proc = None
+        self.code = None
+        self.timed_out = False
+        self.started = None
+        self.elapsed = None
+
+        self.__out = {'stdout': [], 'stderr': []}
+        self.__threads = []
+        self.__timer = None
+        self.__traced = False
+
+    def start(self):
+        '''
+        Start the command, return immediately.
+
+        :return: self.
+        '''
+        if self.proc is not None:
+            raise AssertionError('cmd: {0} already started'.format(self.argv))
+
+        self.started = time.time()
+
+        try:
+            self.proc = subprocess.Popen(
+                self.argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+                # outputs are parsed, e.g. parted, sgdisk, xfs_db, debugfs
+                env=dict(os.environ, LC_ALL='C', LANG='C')
+            )
+        except OSError as e:
+            # behave as the shell does if the command could not be run
+            self.code = 127 if e.errno == errno.ENOENT else 126
+            self.__out['stderr'].append('{0}: {1}\n'.format(self.argv[0], e))
+            self.elapsed = time.time() - self.started
+            return self
+
+        self.__threads.append(self.__spawn(self.__write, self.proc.stdin))
+        self.__threads.append(
+            self.__spawn(self.__read, 'stdout', self.proc.stdout)
+        )
+        self.__threads.append(
+            self.__spawn(self.__read, 'stderr', self.proc.stderr)
+        )
+
+        if self.timeout:
+            self.__timer = threading.Timer(self.timeout, self.__kill)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+        return self
+
+    @classmethod
+    def __spawn(cls, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __write(self, fobj):
+        try:
+            if self.stdin:
+                fobj.write(self.stdin)
+        except IOError as e:
+            # the command exited without reading all its input
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            fobj.close()
+
+    def __read(self, stream, fobj):
+        for line in iter(fobj.readline, ''):
+            self.__out[stream].append(line)
+            if self.on_output is not None:
+                self.on_output(stream, line)
+        fobj.close()
+
+    def __kill(self):
+        # do not reap the process here, wait() is doing it
+        if self.proc.returncode is None:
+            self.timed_out = True
+            try:
+                self.proc.send_signal(signal.SIGKILL)
+            except OSError:
+                pass
+
+    def poll(self):
+        '''
+        Check if the command has finished.
+
+        :return: Exit code if finished, or None.
+        '''
+        if self.code is not None:
+            return self.code
+
+        if self.proc is None or self.proc.poll() is None:
+            return None
+
+        return self.wait()[0]
+
+    def wait(self):
+        '''
+        Wait for the command to finish.
+
+        :return: (code, stdout, stderr) 3-tuples.
+        '''
+        if self.proc is None and self.code is None:
+            self.start()
+
+        if self.code is None:
+            self.proc.wait()
+
+            for thread in self.__threads:
+                thread.join()
+            if self.__timer is not None:
+                self.__timer.cancel()
+
+            self.code = self.proc.returncode
+            self.elapsed = time.time() - self.started
+
+            if self.timed_out:
+                self.__out['stderr'].append(
+                    'Timed out after {0} seconds\n'.format(self.timeout)
+                )
+
+        stdout = ''.join(self.__out['stdout'])
+        stderr = ''.join(self.__out['stderr'])
+
+        if not self.__traced:
+            self.__traced = True
+            _CephTrace.record(self, stdout, stderr)
+
+        return self.code, stdout, stderr
+
+
+def _run_many(cmds, max_workers=None):
+    '''
+    Run commands concurrently.
+
+    :param cmds: A list of _CephCmd objects not started yet.
+    :param max_workers: Max number of commands running at the same time,
+    None for no limit.
+    :return: A list of (code, stdout, stderr) 3-tuples in the order of cmds.
+    '''
+    pending = list(cmds)
+    running = []
+
+    while pending or running:
+        while pending and (not max_workers or len(running) < max_workers):
+            running.append(pending.pop(0).start())
+
+        for cmd in list(running):
+            if cmd.poll() is not None:
+                running.remove(cmd)
+
+        if running:
+            time.sleep(0.01)
+
+    return [cmd.wait() for cmd in cmds]
+
+
 def _run(cmd, **kwargs):
     '''
     Run cmd and return (code, stdout, stderr) 3-tuples.
 
-    :param cmd: Command line to run.
-    :param kwargs: Options etc.
+    :param cmd: Command line to run, a list of arguments.
+    :param kwargs: Options etc., see _CephCmd.
     :return: (code, stdout, stderr) 3-tuples.
     '''
     if not isinstance(cmd, list):
@@ -116,11 +606,9 @@ def _run(cmd, **kwargs):
     if 'timeout' not in kwargs:
         kwargs['timeout'] = COMMAND_TIMEOUT
 
-    cmd = ' '.join(cmd)
+    (code, stdout, stderr) = _CephCmd(cmd, **kwargs).wait()
 
-    data = __salt__['cmd.run_all'](cmd, **kwargs)
-
-    return data['retcode'], data['stdout'], data['stderr']
+    return code, stdout.rstrip(), stderr.rstrip()
 
 
 def _check_run(cmd, **kwargs):
@@ -140,6 +628,70 @@ def _check_run(cmd, **kwargs):
     return code, stdout, stderr
 
 
+def _pool_map(func, items, max_workers):
+    '''
+    Call func on every item concurrently, at most max_workers at a time.
+
+    :param func: Callable takes one item as its argument.
+    :param items: A list of items.
+    :param max_workers: Max number of worker threads.
+    :return: A list of (result, exception) 2-tuples in the order of items.
+    '''
+    results = [(None, None)] * len(items)
+
+    if not items:
+        return results
+
+    tasks = Queue.Queue()
+    for idx, item in enumerate(items):
+        tasks.put((idx, item))
+
+    # commands run by workers are tagged with the operation of the caller
+    ops = _CephTrace.current()
+
+    def worker():
+        _CephTrace.inherit(ops)
+
+        while True:
+            try:
+                (idx, item) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[idx] = (func(item), None)
+            except Exception as e:
+                results[idx] = (None, e)
+
+    max_workers = max(1, min(int(max_workers), len(items)))
+
+    threads = [threading.Thread(target=worker) for _ in range(max_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def _merge_changes(changes, other):
+    '''
+    Merge changes of a state return into another one.
+
+    :param changes: Changes merge to.
+    :param other: Changes to be merged.
+    :return: None.
+    '''
+    for key, val in other.iteritems():
+        if key not in changes:
+            changes[key] = val
+        elif isinstance(changes[key], list) and isinstance(val, list):
+            changes[key].extend(x for x in val if x not in changes[key])
+        else:
+            changes[key] = val
+
+
 def _rmdir(path):
     for name in os.listdir(path):
         full_path = os.path.join(path, name)
@@ -181,6 +733,15 @@ class _CephOneLineTag(_CephTag):
                 return None
             raise
 
+        return self.decode(line)
+
+    def decode(self, line):
+        '''
+        Decode raw content of the tag file.
+
+        :param line: Raw content of the tag file.
+        :return: Content of the tag.
+        '''
         # safe for empty line
         if line[-1:] != '\n':
             raise AssertionError(
@@ -240,19 +801,29 @@ class _CephMultiLineTag(_CephTag):
         try:
             with open(self.path, 'rb') as fobj:
                 line = fobj.read()
-                if line[-1:] != '\n':
-                    raise AssertionError(
-                        'content of tag: {0} does not end with \'\\n\''
-                        .format(self.path)
-                    )
-                line = line[:-1]
-                lines = line.split('\n')
-                return lines
         except IOError as e:
             if e.errno == errno.ENOENT:
                 return None
             raise
 
+        return self.decode(line)
+
+    def decode(self, line):
+        '''
+        Decode raw content of the tag file.
+
+        :param line: Raw content of the tag file.
+        :return: Lines of the tag.
+        '''
+        if line[-1:] != '\n':
+            raise AssertionError(
+                'content of tag: {0} does not end with \'\\n\''
+                .format(self.path)
+            )
+        line = line[:-1]
+        lines = line.split('\n')
+        return lines
+
     def write(self, lines):
         '''
         Write mutiple lines to tag file.
@@ -291,6 +862,9 @@ class _CephMultiLineTag(_CephTag):
 
 
 class _CephConf(object):
+    _lock = threading.RLock()
+    _cache = {}                 # (conf, stamp, name) -> cache entry
+
     def __init__(self, cluster=CEPH_CLUSTER, conf=''):
         super(_CephConf, self).__init__()
 
@@ -300,7 +874,7 @@ class _CephConf(object):
             conf = ''
 
         self.cluster, self.conf = self.normalize(cluster, conf)
-        self.parser = ConfigParser.SafeConfigParser()
+        self.doc = None
 
     @classmethod
     def normalize(cls, cluster=CEPH_CLUSTER, conf=''):
@@ -334,53 +908,176 @@ class _CephConf(object):
         return cluster, conf
 
     def open(self):
-        with _CephIniFile(self.conf) as fobj:
-            self.parser.readfp(fobj)
-        return self.parser
+        '''
+        Load ceph.conf for editing.
+
+        :return: _CephConfDoc.
+        '''
+        self.doc = _CephConfDoc.load(self.conf)
+        return self.doc
 
     def write(self):
-        with open(self.conf, 'wb') as fobj:
-            self.parser.write(fobj)
+        '''
+        Write back ceph.conf opened, only if it is changed.
 
-    def get_conf(self, key, name=''):
+        :return: True if written.
         '''
-        Get config value of a key.
+        return self.doc.write(self.conf)
 
-        Note:
+    @classmethod
+    def normalize_key(cls, key):
+        '''
+        Normalize a config key as ceph does, i.e. 'osd op threads' and
+        'osd_op_threads' are the same key.
+
+        :param key: Config key.
+        :return: Normalized key.
+        '''
+        return '_'.join(key.split())
+
+    @classmethod
+    def parse_value(cls, value):
+        value = value.strip()
+
+        if value.startswith('"'):
+            end = value.find('"', 1)
+            if end > 0:
+                return value[1:end]
+            return value[1:]
+
+        for ch in (';', '#'):
+            pos = value.find(ch)
+            if pos >= 0:
+                value = value[:pos]
+
+        return value.strip()
+
+    @classmethod
+    def __parse(cls, conf):
+        '''
+        Parse ceph.conf into a dict of section -> dict of normalized key -> value.
+
+        :param conf: ceph conf path.
+        :return: Parsed sections.
+        '''
+        sections = {}
+        section = None
+        lines = []
+
+        with open(conf, 'rb') as fobj:
+            pending = ''
+            for line in fobj:
+                line = line.rstrip('\r\n')
+                if line.endswith('\\'):
+                    pending += line[:-1]
+                    continue
+                lines.append(pending + line)
+                pending = ''
+            if pending:
+                lines.append(pending)
+
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in (';', '#'):
+                continue
+
+            if line.startswith('['):
+                end = line.find(']')
+                if end < 0:
+                    raise AssertionError(
+                        'Invalid line in ceph conf: {0}'.format(line)
+                    )
+                section = line[1:end].strip()
+                sections.setdefault(section, {})
+                continue
+
+            if section is None or '=' not in line:
+                continue
+
+            (key, value) = line.split('=', 1)
+            sections[section][cls.normalize_key(key)] = cls.parse_value(value)
+
+        return sections
+
+    def __load(self, name):
+        '''
+        Get the cache entry for an entity, parse ceph.conf and load defaults
+        lazily.
 
-        :param key: The key whose value is to get.
         :param name: ceph entity name.
-        :return: Value of the key, None if not set.
+        :return: Cache entry of the entity.
+        '''
+        try:
+            st = os.stat(self.conf)
+            stamp = (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            stamp = None
+
+        ckey = (self.conf, stamp, name)
+
+        with _CephConf._lock:
+            entry = _CephConf._cache.get(ckey)
+            if entry is None:
+                # drop stale entries of this conf
+                for k in _CephConf._cache.keys():
+                    if k[0] == self.conf and k[1] != stamp:
+                        del _CephConf._cache[k]
+
+                sections = {}
+                if stamp is not None:
+                    sections = self.__parse(self.conf)
+
+                entry = {
+                    'sections': sections,
+                    'defaults': None,
+                    'values': {},
+                }
+                _CephConf._cache[ckey] = entry
+
+            return entry
+
+    def __load_defaults(self, name):
+        '''
+        Get compiled-in (and configured) values of all options with only one
+        ceph-conf run.
+
+        :param name: ceph entity name.
+        :return: A dict of normalized key -> value, None if not supported.
         '''
-        # To get the value from the config file
         cmd = ['ceph-conf']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        if name:
-            cmd.append('--name {0}'.format(name))
-        cmd.append('--lookup {0}'.format(key))
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.extend(['--name', name])
+        cmd.append('--show-config')
 
-        (code, stdout, stderr) = _run(cmd)
+        (code, stdout, _) = _run(cmd)
 
-        if not code:
-            value = stdout.strip().split('\n', 1)
-            if len(value) != 1:
-                raise AssertionError('Weird ceph-conf output: {0}'.format(value))
-            value = value[0]
-            if not value:
-                return None
-            return value
+        if code:
+            return None
 
-        if code != 1:   # ceph-conf return 1 if entry not found
-            raise RuntimeError(cmd, stderr, code)
+        defaults = {}
+        for line in stdout.splitlines():
+            if ' = ' not in line:
+                continue
+            (key, value) = line.split(' = ', 1)
+            defaults[self.normalize_key(key)] = value.strip()
 
-        # Fallback to get the value if the daemon knows
+        return defaults
+
+    def __get_default(self, key, name):
+        '''
+        Get compiled-in value of a key, used when --show-config is not
+        supported by ceph-conf.
+
+        :param key: The key whose value is to get.
+        :param name: ceph entity name.
+        :return: Value of the key, None if not set.
+        '''
         cmd = ['ceph-conf']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        if name:
-            cmd.append('--name {0}'.format(name))
-        cmd.append('--show-config-value {0}'.format(key))
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.extend(['--name', name])
+        cmd.extend(['--show-config-value', key])
 
         # Unfortunately as shown in ceph/src/common/config.cc --show-config-value
         # only has two exit codes: 0 or 1, and 1 are used for both option does not
@@ -391,26 +1088,603 @@ class _CephConf(object):
             value = stdout.strip().split('\n', 1)
             if len(value) != 1:
                 raise AssertionError('Weird ceph-conf output: {0}'.format(value))
-            value = value[0]
-            if not value:
-                return None
-            return value
+            return value[0]
 
         return None
 
-
-class _CephDev(object):
-    def __init__(self, dev, dtype):
+    def __expand(self, value, name, depth):
         '''
-        Init _CephDev object.
+        Expand metavariables, e.g. $cluster, $type, $id, $name, $host and
+        references to other options, e.g. $run_dir.
 
-        :param dev: Device full path name.
-        :param dtype: Device type.
-        :return: None.
+        :param value: Value to expand.
+        :param name: ceph entity name.
+        :param depth: Recursion depth of option references.
+        :return: Expanded value.
         '''
-        super(_CephDev, self).__init__()
+        (etype, eid) = name.split('.', 1)
+
+        metas = {
+            'cluster': self.cluster,
+            'type': etype,
+            'id': eid,
+            'num': eid,
+            'name': name,
+            'host': socket.gethostname().split('.')[0],
+        }
 
-        if dev is None:
+        def sub(m):
+            var = m.group(1) or m.group(2)
+            if var in metas:
+                return metas[var]
+            if depth < 8:
+                ref = self.__lookup(var, name, depth + 1)
+                if ref is not None:
+                    return ref
+            return m.group(0)
+
+        return re.sub(r'\$\{(\w+)\}|\$(\w+)', sub, value)
+
+    def __lookup(self, key, name, depth=0):
+        key = self.normalize_key(key)
+        entry = self.__load(name)
+
+        with _CephConf._lock:
+            if key in entry['values']:
+                return entry['values'][key]
+
+        (etype, _) = name.split('.', 1)
+
+        value = None
+        found = False
+
+        # the same search order as ceph: $name, $type, global
+        for section in (name, etype, 'global'):
+            options = entry['sections'].get(section, {})
+            if key in options:
+                value = self.__expand(options[key], name, depth)
+                found = True
+                break
+
+        if not found:
+            with _CephConf._lock:
+                if entry['defaults'] is None:
+                    entry['defaults'] = self.__load_defaults(name) or False
+
+            if entry['defaults'] is False:
+                value = self.__get_default(key, name)
+            else:
+                value = entry['defaults'].get(key)
+
+        if not value:
+            value = None
+
+        with _CephConf._lock:
+            entry['values'][key] = value
+
+        return value
+
+    def get_conf(self, key, name=''):
+        '''
+        Get config value of a key.
+
+        Note: ceph.conf is parsed by ourselves, compiled-in defaults of all
+        options are loaded by a single ceph-conf run only if needed, results
+        are cached per (conf, mtime, entity name).
+
+        :param key: The key whose value is to get.
+        :param name: ceph entity name.
+        :return: Value of the key, None if not set.
+        '''
+        # ceph-conf uses client.admin if no name specified
+        return self.__lookup(key, name or 'client.admin')
+
+    def get_confs(self, keys, name=''):
+        '''
+        Get config values of a list of keys.
+
+        :param keys: Keys whose values are to get.
+        :param name: ceph entity name.
+        :return: A dict of key -> value, value is None if not set.
+        '''
+        return dict((key, self.get_conf(key, name)) for key in keys)
+
+
+class _CephConfDoc(object):
+    '''
+    Round-trip ceph.conf document.
+
+    Lines are kept as read and edits only touch the lines of the options
+    changed, so comments, order and layout of everything else survive a
+    rewrite. Keys match as ceph matches them, i.e. 'osd op threads' and
+    'osd_op_threads' are the same key.
+    '''
+    def __init__(self, text=''):
+        super(_CephConfDoc, self).__init__()
+
+        self.original = text
+        self.lines = text.splitlines(True)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a ceph.conf.
+
+        :param path: ceph conf path, a missing file is an empty document.
+        :return: _CephConfDoc.
+        '''
+        if not os.path.exists(path):
+            return cls()
+
+        with open(path, 'rb') as fobj:
+            return cls(fobj.read())
+
+    def __scan(self):
+        '''
+        Parse logical lines, i.e. with continuation lines joined.
+
+        :return: A list of (section, key, value, start, end), key and value
+                 are None for section headers, lines[start:end] are the raw
+                 lines of the entry.
+        '''
+        entries = []
+        section = None
+
+        idx = 0
+        while idx < len(self.lines):
+            start = idx
+            line = self.lines[idx].rstrip('\r\n')
+            while line.endswith('\\') and idx + 1 < len(self.lines):
+                idx += 1
+                line = line[:-1] + self.lines[idx].rstrip('\r\n')
+            idx += 1
+
+            line = line.strip()
+            if not line or line[0] in (';', '#'):
+                continue
+
+            if line.startswith('['):
+                end = line.find(']')
+                if end < 0:
+                    raise AssertionError(
+                        'Invalid line in ceph conf: {0}'.format(line)
+                    )
+                section = line[1:end].strip()
+                entries.append((section, None, None, start, idx))
+                continue
+
+            if section is None or '=' not in line:
+                continue
+
+            (key, value) = line.split('=', 1)
+            entries.append((section, key.strip(), _CephConf.parse_value(value),
+                            start, idx))
+
+        return entries
+
+    def __options(self, section, key):
+        nkey = _CephConf.normalize_key(key)
+
+        return [x for x in self.__scan()
+                if x[0] == section and x[1] is not None
+                and _CephConf.normalize_key(x[1]) == nkey]
+
+    def __delete(self, entries):
+        # from the last one, so line numbers of the others stay valid
+        for entry in sorted(entries, key=lambda x: x[3], reverse=True):
+            del self.lines[entry[3]:entry[4]]
+
+    @classmethod
+    def __format_value(cls, value):
+        if value != value.strip() or '#' in value or ';' in value:
+            return '"{0}"'.format(value)
+        return value
+
+    def sections(self):
+        names = []
+        for entry in self.__scan():
+            if entry[1] is None and entry[0] not in names:
+                names.append(entry[0])
+
+        return names
+
+    def has_section(self, section):
+        return section in self.sections()
+
+    def items(self, section):
+        '''
+        Get options of a section, the last one wins if a key is repeated.
+
+        :param section: Section name.
+        :return: A list of (key, value) tuples, keys as written.
+        '''
+        options = {}
+        order = []
+
+        for entry in self.__scan():
+            if entry[0] != section or entry[1] is None:
+                continue
+
+            nkey = _CephConf.normalize_key(entry[1])
+            if nkey not in options:
+                order.append(nkey)
+            options[nkey] = (entry[1], entry[2])
+
+        return [options[x] for x in order]
+
+    def get(self, section, key):
+        options = self.__options(section, key)
+
+        return options[-1][2] if options else None
+
+    def add_section(self, section):
+        if self.has_section(section):
+            raise ValueError('Section: {0} already exists'.format(section))
+
+        if self.lines:
+            if not self.lines[-1].endswith('\n'):
+                self.lines[-1] += '\n'
+            if self.lines[-1].strip():
+                self.lines.append('\n')
+
+        self.lines.append('[{0}]\n'.format(section))
+
+    def remove_section(self, section):
+        '''
+        Remove all occurrences of a section, i.e. from its header up to the
+        next section header.
+        '''
+        entries = self.__scan()
+        headers = [x for x in entries if x[1] is None]
+
+        spans = []
+        for (idx, header) in enumerate(headers):
+            if header[0] != section:
+                continue
+            end = headers[idx + 1][3] if idx + 1 < len(headers) \
+                else len(self.lines)
+            spans.append((section, None, None, header[3], end))
+
+        self.__delete(spans)
+
+    def set(self, section, key, value):
+        '''
+        Set an option, an existing line of the key is rewritten in place,
+        a new one is appended to the section.
+
+        :param section: Section name, added if missing.
+        :param key: Option key.
+        :param value: Option value.
+        :return: None.
+        '''
+        value = str(value)
+        options = self.__options(section, key)
+
+        if options:
+            last = options[-1]
+            if last[2] == value and len(options) == 1:
+                return
+
+            raw = self.lines[last[3]]
+            indent = raw[:len(raw) - len(raw.lstrip())]
+            self.__delete(options[:-1])
+
+            # line numbers of the last one may have moved
+            last = self.__options(section, key)[-1]
+            self.lines[last[3]:last[4]] = ['{0}{1} = {2}\n'.format(
+                indent, last[1], self.__format_value(value))]
+            return
+
+        if not self.has_section(section):
+            self.add_section(section)
+
+        entries = [x for x in self.__scan() if x[0] == section]
+        body = [x for x in entries if x[1] is not None]
+
+        indent = ''
+        if body:
+            raw = self.lines[body[-1][3]]
+            indent = raw[:len(raw) - len(raw.lstrip())]
+
+        pos = entries[-1][4]
+        if not self.lines[pos - 1].endswith('\n'):
+            self.lines[pos - 1] += '\n'
+
+        self.lines.insert(pos, '{0}{1} = {2}\n'.format(
+            indent, key, self.__format_value(value)))
+
+    def remove_option(self, section, key):
+        '''
+        Remove an option, all lines of the key in the section are removed.
+
+        :return: True if the option existed.
+        '''
+        options = self.__options(section, key)
+        self.__delete(options)
+
+        return bool(options)
+
+    def dumps(self):
+        return ''.join(self.lines)
+
+    def write(self, path):
+        '''
+        Write the document atomically, only if its content changed. The mode
+        and owner of an existing file are kept.
+
+        :param path: ceph conf path, symbolic links are followed.
+        :return: True if written.
+        '''
+        data = self.dumps()
+
+        path = os.path.realpath(path)
+
+        if data == self.original and os.path.isfile(path):
+            return False
+
+        pdir = os.path.dirname(path)
+
+        mode = 0644
+        owner = None
+        if os.path.isfile(path):
+            st = os.stat(path)
+            mode = stat.S_IMODE(st.st_mode)
+            owner = (st.st_uid, st.st_gid)
+
+        (fd, tmp) = tempfile.mkstemp(prefix='.conf.', dir=pdir)
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                if owner is not None:
+                    os.fchown(fobj.fileno(), *owner)
+                os.fchmod(fobj.fileno(), mode)
+                fobj.write(data)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        # make the rename durable
+        dfd = os.open(pdir, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+        self.original = data
+
+        return True
+
+
+class _BlockInventory(object):
+    '''
+    Snapshot of all block devices on this host.
+
+    Disks and partitions are gathered from /sys/block, filesystem and GPT
+    info from a single 'lsblk' (or 'blkid' if 'lsblk' is too old) run,
+    mounts from /proc/mounts. The snapshot is shared by all _CephDev
+    objects of one operation, see _traced, and must be invalidated after
+    any command that changes the partitions, filesystems or mounts.
+    '''
+    _lock = threading.RLock()
+    _snapshot = None
+
+    def __init__(self):
+        super(_BlockInventory, self).__init__()
+
+        self.disks = {}         # disk path -> set of partition numbers
+        self.parts = {}         # partition path -> (disk path, number)
+        self.devs = {}          # device path -> dict of lsblk/blkid info
+        self.mounts = []        # list of (dev, path, fstype, options)
+        self.lvs = None         # set of LV paths, probed on demand
+        self.tables = {}        # disk path -> partition numbers in its GPT
+        self.probed = False     # True if 'lsblk' gave us partition info
+
+    @classmethod
+    def get(cls):
+        '''
+        Get the current snapshot, gather a new one if invalidated.
+
+        :return: _BlockInventory object.
+        '''
+        with cls._lock:
+            if cls._snapshot is None:
+                snapshot = cls()
+                snapshot.load()
+                cls._snapshot = snapshot
+            return cls._snapshot
+
+    @classmethod
+    def invalidate(cls):
+        '''
+        Drop the current snapshot, called after mutating commands.
+
+        :return: None.
+        '''
+        with cls._lock:
+            cls._snapshot = None
+
+    @classmethod
+    def __name_to_path(cls, name):
+        return '/dev/' + name.replace('!', '/')
+
+    def load(self):
+        self.__load_sysfs()
+        if not self.__load_lsblk():
+            self.__load_blkid()
+        self.__load_mounts()
+
+    def __load_sysfs(self):
+        for name in os.listdir('/sys/block'):
+            # device mapper devices are not disks, see get_lvs
+            if name.startswith('dm-'):
+                continue
+
+            disk = self.__name_to_path(name)
+            nums = set()
+
+            sysdir = os.path.join('/sys/block', name)
+            for sub in os.listdir(sysdir):
+                fpath = os.path.join(sysdir, sub, 'partition')
+                if not os.path.exists(fpath):
+                    continue
+                with open(fpath, 'rb') as fobj:
+                    num = int(fobj.read().strip())
+                nums.add(num)
+                self.parts[self.__name_to_path(sub)] = (disk, num)
+
+            self.disks[disk] = nums
+
+    def __load_lsblk(self):
+        if not utils.which('lsblk'):
+            return False
+
+        cmd = ['lsblk']
+        cmd.append('--json')
+        cmd.append('--paths')
+        cmd.extend(['--output',
+                    'NAME,FSTYPE,UUID,PARTUUID,PARTTYPE,PARTLABEL,PTTYPE'])
+
+        # '--json' is only supported by util-linux 2.27 and later
+        (code, stdout, _) = _run(cmd)
+
+        if code:
+            return False
+
+        try:
+            data = json.loads(stdout)
+        except ValueError:
+            return False
+
+        devs = list(data.get('blockdevices', []))
+        while devs:
+            dev = devs.pop()
+            devs.extend(dev.get('children', []))
+
+            info = dict()
+            for key in ('fstype', 'uuid', 'partuuid', 'parttype',
+                        'partlabel', 'pttype'):
+                val = dev.get(key)
+                info[key] = val.lower() if val and key != 'partlabel' else val
+            self.devs[os.path.realpath(dev['name'])] = info
+
+        self.probed = True
+
+        return True
+
+    def __load_blkid(self):
+        # '-c /dev/null' to bypass the (may be stale) blkid cache
+        cmd = ['blkid']
+        cmd.extend(['-c', '/dev/null'])
+        cmd.extend(['-o', 'export'])
+
+        (code, stdout, _) = _run(cmd)
+
+        # blkid returns 2 if no device could be identified
+        if code:
+            return
+
+        for block in stdout.strip().split('\n\n'):
+            fields = dict(
+                line.split('=', 1) for line in block.splitlines() if '=' in line
+            )
+            if 'DEVNAME' not in fields:
+                continue
+
+            info = dict()
+            info['fstype'] = fields.get('TYPE')
+            info['uuid'] = fields.get('UUID')
+            self.devs[os.path.realpath(fields['DEVNAME'])] = info
+
+    def __load_mounts(self):
+        with open('/proc/mounts', 'rb') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                dev = fields[0]
+                if dev.startswith('/dev/') and os.path.exists(dev):
+                    dev = os.path.realpath(dev)
+                    self.mounts.append((dev, fields[1], fields[2], fields[3]))
+
+    def get_lvs(self):
+        '''
+        Get all LVM2 LV device(s).
+
+        Note: Any symbolic links are eliminated!
+
+        :return: A set of logical volumes on this host.
+        '''
+        with self._lock:
+            if self.lvs is not None:
+                return self.lvs
+
+            lvs = set()
+
+            if utils.which('lvs'):
+                cmd = ['lvs']
+                cmd.append('--noheadings')
+                cmd.extend(['-o', 'lv_path'])
+
+                (_, stdout, _) = _check_run(cmd)
+
+                for line in stdout.splitlines():
+                    line = line.strip()
+                    if line:
+                        lvs.add(os.path.realpath(line))
+
+            self.lvs = lvs
+
+            return lvs
+
+    def get_info(self, dev, key):
+        '''
+        Get lsblk/blkid info of a device.
+
+        :param dev: Real path of the device.
+        :param key: One of fstype, uuid, partuuid, parttype, partlabel, pttype.
+        :return: (known, value) 2-tuples, known is False if the snapshot can
+        not answer, then the caller should probe the device itself.
+        '''
+        if key in ('partuuid', 'parttype', 'partlabel', 'pttype'):
+            if not self.probed:
+                return False, None
+
+        info = self.devs.get(dev)
+        if info is None:
+            # blkid lists only devices have something identified on
+            return True, None
+
+        return True, info.get(key)
+
+    def get_mount(self, dev):
+        '''
+        Get mount info of a device.
+
+        :param dev: Real path of the device.
+        :return: (path, fstype, options) 3-tuples, or (None, None, None).
+        '''
+        for (mdev, path, fstype, options) in self.mounts:
+            if mdev == dev:
+                return path, fstype, options
+
+        return None, None, None
+
+
+class _CephDev(object):
+    def __init__(self, dev, dtype):
+        '''
+        Init _CephDev object.
+
+        :param dev: Device full path name.
+        :param dtype: Device type.
+        :return: None.
+        '''
+        super(_CephDev, self).__init__()
+
+        if dev is None:
             raise ValueError('Device path must not be None')
         if not os.path.isabs(dev):
             raise ValueError('Device: {0} is not an abs path'.format(dev))
@@ -464,58 +1738,25 @@ class _CephDev(object):
         '''
         dev_name = cls.__get_blk_dev_name(dev)
 
+        inventory = _BlockInventory.get()
+
         # Check LVM2 LV
         if dev_name.startswith('dm-'):
-            lvs = cls.__get_lv_list()
-            if dev in lvs:
+            if dev in inventory.get_lvs():
                 return _CephDevType.LV
             else:
                 return _CephDevType.OTHER
 
         # Check whole disk
-        if os.path.exists(os.path.join('/sys/block', dev_name)):
+        if dev in inventory.disks:
             return _CephDevType.DISK
 
         # Check partition
-        pardev_name = dev_name
-        while len(pardev_name):
-            fpath = '/sys/block/{pardev}/{dev}'\
-                .format(pardev=pardev_name, dev=dev_name)
-            if os.path.exists(fpath):
-                return _CephDevType.PART
-            pardev_name = pardev_name[:-1]
+        if dev in inventory.parts:
+            return _CephDevType.PART
 
         return _CephDevType.OTHER
 
-    @classmethod
-    def __get_lv_list(cls):
-        '''
-        Get all LVM2 LV device(s).
-
-        Note: Any symbolic links are eliminated!
-
-        :return: A list of logical volumes on this host.
-        '''
-        if not utils.which('lvs'):
-            return set()
-
-        cmd = ['lvs']
-        cmd.append('--noheadings')
-        cmd.append('-o lv_path')
-
-        (_, stdout, _) = _check_run(cmd)
-
-        lines = stdout.splitlines()
-
-        lvs = set()
-        for line in lines:
-            line = line.strip()
-            if line:
-                lv = os.path.realpath(line)
-                lvs.add(lv)
-
-        return lvs
-
     @classmethod
     def __get_blk_dev_name(cls, path):
         '''
@@ -636,6 +1877,17 @@ class _CephDev(object):
         if not self.is_disk():
             raise AssertionError('Not a disk dev')
 
+        (known, pts) = _BlockInventory.get().get_info(self.dev, 'pttype')
+
+        if known:
+            if pts is None:
+                return _CephPartType.NONE
+            elif pts == 'gpt':
+                return _CephPartType.GPT
+            elif pts == 'dos':
+                return _CephPartType.DOS
+            return _CephPartType.OTHER
+
         cmd = ['parted']
         cmd.append('--script')
         cmd.append('--')
@@ -683,10 +1935,17 @@ class _CephDev(object):
 
         fs_type = _CephFsType.NONE
 
+        (known, data) = _BlockInventory.get().get_info(self.dev, 'fstype')
+
+        if known:
+            if data is None:
+                return fs_type
+            return self.__to_fs_type(data)
+
         cmd = ['blkid']
         cmd.append('-p')
-        cmd.append('-o value')
-        cmd.append('-s TYPE')
+        cmd.extend(['-o', 'value'])
+        cmd.extend(['-s', 'TYPE'])
         cmd.append('--')
         cmd.append(self.dev)
 
@@ -697,28 +1956,70 @@ class _CephDev(object):
                 return fs_type
             raise RuntimeError(cmd, stderr, code)
 
-        data = stdout
-
-        if data == 'xfs':
-            fs_type = _CephFsType.XFS
-        elif data == 'ext4':
-            fs_type = _CephFsType.EXT4
-        elif data == 'btrfs':
-            fs_type = _CephFsType.BTRFS
-        else:
-            fs_type = _CephFsType.OTHER
+        return self.__to_fs_type(stdout.strip())
 
-        return fs_type
-
-    def get_part_info(self):
+    def get_part_fs_uuid(self):
         '''
-        Get partition info.
+        Get filesystem UUID of given partition or LV.
 
-        :return: (guid, typecode, name) 3-tuples.
+        :return: Filesystem UUID, None if no filesystem.
         '''
-        if not self.is_part():
-            raise AssertionError('Not a partition')
-
+        if not self.is_part() and not self.is_lv():
+            raise AssertionError('Not a partition or LVM2 logical volume')
+
+        (known, fsuuid) = _BlockInventory.get().get_info(self.dev, 'uuid')
+
+        if known:
+            return fsuuid
+
+        cmd = ['blkid']
+        cmd.append('-p')
+        cmd.extend(['-o', 'value'])
+        cmd.extend(['-s', 'UUID'])
+        cmd.append('--')
+        cmd.append(self.dev)
+
+        (code, stdout, stderr) = _run(cmd)
+
+        if code:
+            if code == errno.ENOENT:
+                return None
+            raise RuntimeError(cmd, stderr, code)
+
+        return stdout.strip().lower() or None
+
+    @classmethod
+    def __to_fs_type(cls, data):
+        if data == 'xfs':
+            fs_type = _CephFsType.XFS
+        elif data == 'ext4':
+            fs_type = _CephFsType.EXT4
+        elif data == 'btrfs':
+            fs_type = _CephFsType.BTRFS
+        else:
+            fs_type = _CephFsType.OTHER
+
+        return fs_type
+
+    def get_part_info(self):
+        '''
+        Get partition info.
+
+        :return: (guid, typecode, name) 3-tuples.
+        '''
+        if not self.is_part():
+            raise AssertionError('Not a partition')
+
+        inventory = _BlockInventory.get()
+
+        (known, guid) = inventory.get_info(self.dev, 'partuuid')
+
+        if known:
+            (_, typecode) = inventory.get_info(self.dev, 'parttype')
+            (_, name) = inventory.get_info(self.dev, 'partlabel')
+
+            return guid, typecode, name
+
         (disk, num) = self.__get_part_num(self.dev)
 
         (guid, typecode, name) = (None, None, None)
@@ -758,6 +2059,13 @@ class _CephDev(object):
         if not self.is_disk():
             raise AssertionError('Not a disk')
 
+        # the partition table, not the kernel view, read once per snapshot
+        inventory = _BlockInventory.get()
+
+        with inventory._lock:
+            if self.dev in inventory.tables:
+                return set(inventory.tables[self.dev])
+
         cmd = ['sgdisk']
         cmd.append('--print')
         cmd.append('--')
@@ -784,6 +2092,9 @@ class _CephDev(object):
             if not os.path.exists(fpath):
                 raise AssertionError('Kernel not sync with disk?')
 
+        with inventory._lock:
+            inventory.tables[self.dev] = set(parts)
+
         return parts
 
     def get_disk_part(self, num):
@@ -856,7 +2167,10 @@ class _CephDev(object):
         cmd.append('mklabel')
         cmd.append('gpt')
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def make_disk_part(self, num, size, guid, typecode, name):
         '''
@@ -891,7 +2205,10 @@ class _CephDev(object):
         cmd.append('--')
         cmd.append(self.dev)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def remove_disk_part(self, num):
         '''
@@ -908,7 +2225,10 @@ class _CephDev(object):
         cmd.append('--')
         cmd.append(self.dev)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def make_part_fs(self, fstype, options=''):
         '''
@@ -927,12 +2247,15 @@ class _CephDev(object):
             options.append('-f')
 
         cmd = ['mkfs']
-        cmd.append('-t {0}'.format(fstype))
+        cmd.extend(['-t', fstype])
         cmd.extend(options)
         cmd.append('--')
         cmd.append(self.dev)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def set_part_info(self, guid=None, typecode=None, name=None):
         '''
@@ -961,7 +2284,10 @@ class _CephDev(object):
         cmd.append('--')
         cmd.append(disk)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def get_mount_info(self):
         '''
@@ -972,18 +2298,7 @@ class _CephDev(object):
         if not self.is_part() and not self.is_lv():
             raise AssertionError('Not a partition or LVM2 logical volume')
 
-        with open('/proc/mounts', 'rb') as mounts:
-            for line in mounts:
-                fields = line.split()
-                if len(fields) < 3:
-                    continue
-                dev = fields[0]
-                if dev.startswith('/dev/') and os.path.exists(dev):
-                    dev = os.path.realpath(dev)
-                    if dev == self.dev:
-                        return fields[1], fields[2], fields[3]
-
-        return None, None, None
+        return _BlockInventory.get().get_mount(self.dev)
 
     def mount(self, path, fstype, options=''):
         '''
@@ -998,14 +2313,17 @@ class _CephDev(object):
             raise AssertionError('Not a partition or LVM2 logical volume')
 
         cmd = ['mount']
-        cmd.append('-t {0}'.format(fstype))
+        cmd.extend(['-t', fstype])
         if options.strip():
-            cmd.append('-o {0}'.format(options))
+            cmd.extend(['-o', options])
         cmd.append('--')
         cmd.append(self.dev)
         cmd.append(path)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
         return path
 
@@ -1063,6 +2381,8 @@ class _CephDev(object):
             else:
                 break
 
+        _BlockInventory.invalidate()
+
     def move_mount(self, opath, npath, fstype, options):
         '''
         Move an mount from an old mount point to a new mount point.
@@ -1099,7 +2419,10 @@ class _CephDev(object):
         cmd.append('--')
         cmd.append(self.dev)
 
-        _check_run(cmd)
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
     def clear_part(self):
         '''
@@ -1115,6 +2438,8 @@ class _CephDev(object):
         with open(self.dev, 'wb') as fobj:
             fobj.write(size*'\0')
 
+        _BlockInventory.invalidate()
+
     def clear_dir(self):
         '''
         Clear directory content.
@@ -1149,1274 +2474,4581 @@ class _CephDev(object):
         cmd.append('--')
         cmd.append(self.dev)
 
-        _check_run(cmd)
-
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
-class _CephDaemon(object):
-    def __init__(self, etype, eid, cluster=CEPH_CLUSTER):
-        super(_CephDaemon, self).__init__()
 
-        if etype not in ['mon', 'osd', 'mds', 'client']:
-            raise ValueError('Invalid daemon type: {0}'.format(etype))
+class _CephFsProbe(object):
+    '''
+    Read small files from the root directory of an unmounted filesystem
+    without mounting it, read-only and best effort, i.e. the caller should
+    mount the filesystem and check if we can not decide.
 
-        cfg = _CephConf(cluster)
+    ext4 is probed by 'debugfs', xfs by 'xfs_db' (need the 'path' command of
+    xfsprogs 4.20 and later), btrfs is not supported.
+    '''
+    def __init__(self, dev, fstype):
+        super(_CephFsProbe, self).__init__()
 
-        self.cluster = cfg.cluster
-        self.conf = cfg.conf
-        self.cfg = cfg
-        self.type = etype
-        self.id = eid
-        self.name = '{type}.{id}'.format(type=etype, id=eid)
+        self.dev = dev
+        self.fstype = fstype
 
-    @classmethod
-    def start_mon(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+    def read(self, names):
+        '''
+        Read files from the root directory.
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('start')
-        cmd.append('mon')
+        :param names: File names to read.
+        :return: A dict of name -> raw content, None if the file does not
+        exist, or None if the filesystem can not be probed.
+        '''
+        try:
+            if self.fstype == _CephFsType.EXT4:
+                return self.__read_ext4(names)
+            if self.fstype == _CephFsType.XFS:
+                return self.__read_xfs(names)
+        except (RuntimeError, ValueError):
+            pass
 
-        _check_run(cmd)
+        return None
 
-    @classmethod
-    def start_osd(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+    def __read_ext4(self, names):
+        if not utils.which('debugfs'):
+            return None
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('start')
-        cmd.append('osd')
+        # debugfs opens the filesystem read-only without '-w'
+        cmd = ['debugfs']
+        cmd.extend(['-f', '-'])
+        cmd.append(self.dev.dev)
 
-        _check_run(cmd)
+        requests = ''.join('cat /{0}\n'.format(name) for name in names)
 
-    @classmethod
-    def start_mds(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+        (code, stdout, _) = _run(cmd, stdin=requests)
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('start')
-        cmd.append('mds')
+        if code:
+            return None
 
-        _check_run(cmd)
+        # debugfs echoes each request as 'debugfs: <request>'
+        fields = re.split(r'(?m)^debugfs: cat /(\S+)\n', stdout)
 
-    @classmethod
-    def start_all(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+        if len(fields) != 2 * len(names) + 1 or fields[0].strip():
+            return None
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('start')
+        data = {}
+        for idx, name in enumerate(names):
+            if fields[2 * idx + 1] != name:
+                return None
+            content = fields[2 * idx + 2]
+            # missing file prints nothing, a tag is never empty
+            if not content:
+                content = None
+            elif idx == len(names) - 1 and content[-1:] != '\n':
+                # trailing newline of the output may have been stripped
+                content += '\n'
+            data[name] = content
+
+        return data
+
+    def __read_xfs(self, names):
+        if not utils.which('xfs_db'):
+            return None
 
-        _check_run(cmd)
+        cmd = ['xfs_db']
+        cmd.append('-r')
+        cmd.extend(['-c', 'path /'])
+        cmd.extend(['-c', 'inode'])
+        for name in names:
+            # 'path' leaves the current inode unchanged if it fails, so
+            # reset to root and compare inode numbers to tell missing files
+            cmd.extend(['-c', 'echo @@{0}'.format(name)])
+            cmd.extend(['-c', 'path /'])
+            cmd.extend(['-c', 'path /{0}'.format(name)])
+            cmd.extend(['-c', 'inode'])
+            cmd.extend(['-c', 'dblock 0'])
+            cmd.extend(['-c', 'type text'])
+            cmd.extend(['-c', 'print'])
+        cmd.append(self.dev.dev)
 
-    @classmethod
-    def stop_mon(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+        (code, stdout, _) = _run(cmd)
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('stop')
-        cmd.append('mon')
+        if code:
+            return None
 
-        _check_run(cmd)
+        blocks = re.split(r'(?m)^@@(\S+)$', stdout)
 
-    @classmethod
-    def stop_osd(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+        if len(blocks) != 2 * len(names) + 1:
+            return None
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('stop')
-        cmd.append('osd')
+        m = re.search(r'current inode number is (\d+)', blocks[0])
+        if not m:
+            return None
+        root = m.group(1)
 
-        _check_run(cmd)
+        data = {}
+        for idx, name in enumerate(names):
+            if blocks[2 * idx + 1] != name:
+                return None
 
-    @classmethod
-    def stop_mds(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+            block = blocks[2 * idx + 2]
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('stop')
-        cmd.append('mds')
+            m = re.search(r'current inode number is (\d+)', block)
+            if not m:
+                return None
+            if m.group(1) == root:
+                data[name] = None
+                continue
 
-        _check_run(cmd)
+            content = []
+            for line in block.splitlines():
+                m = re.match(r'\s*[0-9a-f]+:\s+((?:[0-9a-f]{2}\s+){1,16})', line)
+                if m:
+                    content.extend(chr(int(x, 16)) for x in m.group(1).split())
 
-    @classmethod
-    def stop_all(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+            content = ''.join(content)
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('stop')
+            # file data is padded with zeros to the block size
+            end = content.find('\0')
+            if end >= 0:
+                content = content[:end]
 
-        _check_run(cmd)
+            if not content:
+                return None
 
-    @classmethod
-    def restart_mon(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+            data[name] = content
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('restart')
-        cmd.append('mon')
+        return data
 
-        _check_run(cmd)
 
-    @classmethod
-    def restart_osd(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+class _CephAdminSocket(object):
+    '''
+    Client of the admin socket of a ceph daemon, talks the same protocol as
+    'ceph daemon' does without forking the ceph CLI.
+    '''
+    def __init__(self, path, timeout=CEPH_ASOK_TIMEOUT):
+        super(_CephAdminSocket, self).__init__()
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('restart')
-        cmd.append('osd')
+        self.path = path
+        self.timeout = timeout
 
-        _check_run(cmd)
+    def __connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except:
+            sock.close()
+            raise
+        return sock
 
     @classmethod
-    def restart_mds(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+    def __recv(cls, sock, size):
+        data = []
+        while size > 0:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise socket.error(errno.ECONNRESET, 'admin socket closed')
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def is_alive(self):
+        '''
+        Check if the daemon is listening on the socket, a socket file left
+        by a dead daemon refuses connections.
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('restart')
-        cmd.append('mds')
+        :return: True if alive.
+        '''
+        try:
+            self.__connect().close()
+        except socket.error:
+            return False
 
-        _check_run(cmd)
+        return True
 
-    @classmethod
-    def restart_all(cls, cluster=CEPH_CLUSTER):
-        cfg = _CephConf(cluster)
+    def command(self, prefix, **kwargs):
+        '''
+        Run an admin socket command.
 
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('restart')
+        :param prefix: Command, e.g. 'status', 'config set'.
+        :param kwargs: Arguments of the command.
+        :return: Reply decoded from JSON, or the raw reply if not JSON.
+        '''
+        request = dict(kwargs)
+        request['prefix'] = prefix
 
-        _check_run(cmd)
+        sock = self.__connect()
+        try:
+            sock.sendall(json.dumps(request) + '\0')
+            # reply is prefixed with its length, 32 bits big endian
+            (size,) = struct.unpack('>I', self.__recv(sock, 4))
+            data = self.__recv(sock, size)
+        finally:
+            sock.close()
 
-    def start(self):
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('start')
-        cmd.append(self.name)
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
 
-        _check_run(cmd)
 
-    def stop(self):
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('stop')
-        cmd.append(self.name)
+class _CephHostStatus(object):
+    '''
+    Liveness of local daemons of a cluster, collected by one pass over the
+    admin sockets in run_dir, shared by all daemons until something is
+    started or stopped.
+    '''
+    _lock = threading.RLock()
+    _snapshots = {}     # cluster -> snapshot
 
-        _check_run(cmd)
+    def __init__(self, cluster=CEPH_CLUSTER):
+        super(_CephHostStatus, self).__init__()
 
-    def restart(self):
-        cmd = ['/etc/init.d/ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('restart')
-        cmd.append(self.name)
+        self.cluster = cluster
+        self.sockets = {}   # daemon name -> admin socket path
+        self.alive = {}     # daemon name -> True or False
+        self.known = False
 
-        _check_run(cmd)
+    @classmethod
+    def get(cls, cluster=CEPH_CLUSTER):
+        '''
+        Get the current snapshot, collect one if needed.
 
-    def status(self):
-        pass
+        :param cluster: Cluster name.
+        :return: _CephHostStatus object.
+        '''
+        with cls._lock:
+            if cluster not in cls._snapshots:
+                snapshot = cls(cluster)
+                snapshot.load()
+                cls._snapshots[cluster] = snapshot
+            return cls._snapshots[cluster]
 
-    def is_running(self):
-        pass
+    @classmethod
+    def invalidate(cls):
+        '''
+        Drop all snapshots, called after daemons are started or stopped.
 
+        :return: None.
+        '''
+        with cls._lock:
+            cls._snapshots = {}
 
-class _CephOsdDaemonState(object):
-    DEAD = 0
-    RUNNING = 1
+    def load(self):
+        run_dir = _CephConf(self.cluster).get_conf('run_dir')
 
+        if not run_dir or not os.path.isdir(run_dir):
+            return
 
-class _CephOsdDaemon(_CephDaemon):
-    def __init__(self, osdid, cluster=CEPH_CLUSTER):
-        super(_CephOsdDaemon, self).__init__('osd', osdid, cluster)
+        # the default admin socket is $run_dir/$cluster-$name.asok
+        prefix = '{0}-'.format(self.cluster)
 
-    def status(self):
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('daemon')
-        cmd.append(self.name)
-        cmd.append('status')
+        for fname in os.listdir(run_dir):
+            if not fname.startswith(prefix) or not fname.endswith('.asok'):
+                continue
 
-        (code, _, stderr) = _run(cmd)
+            name = fname[len(prefix):-len('.asok')]
+            path = os.path.join(run_dir, fname)
 
-        # TODO: Read ceph source to verify this errno.
-        if code:
-            if code == errno.EINVAL:
-                return _CephOsdDaemonState.DEAD
-            raise RuntimeError(cmd, stderr, code)
+            self.sockets[name] = path
+            self.alive[name] = _CephAdminSocket(path).is_alive()
 
-        return _CephOsdDaemonState.RUNNING
+        self.known = True
 
-    def is_running(self):
-        return self.status() != _CephOsdDaemonState.DEAD
+    def status(self, name):
+        '''
+        Get liveness of a daemon.
 
+        :param name: Daemon name, e.g. osd.0.
+        :return: True if running, False if not, None if no admin socket
+        found, e.g. the admin socket is configured elsewhere, the caller
+        should ask 'ceph daemon' then.
+        '''
+        if not self.known or name not in self.alive:
+            return None
 
-class _CephMonDaemonState(object):
-    DEAD = 0
-    RUNNING = 1
+        return self.alive[name]
 
+    def daemons(self, etype=None):
+        '''
+        Get names of daemons have admin sockets on this host.
 
-class _CephMonDaemon(_CephDaemon):
-    def __init__(self, monid, cluster=CEPH_CLUSTER):
-        super(_CephMonDaemon, self).__init__('mon', monid, cluster)
+        :param etype: Only daemons of this type if not None, e.g. osd.
+        :return: A list of daemon names.
+        '''
+        names = self.sockets.keys()
 
-    def status(self):
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('daemon')
-        cmd.append(self.name)
-        cmd.append('mon_status')
+        if etype is not None:
+            names = [x for x in names if x.split('.', 1)[0] == etype]
 
-        (code, _, stderr) = _run(cmd)
+        return sorted(names)
 
-        # TODO: Read ceph source to verify this errno.
-        if code:
-            if code == errno.EINVAL:
-                return _CephMonDaemonState.DEAD
-            raise RuntimeError(cmd, stderr, code)
 
-        return _CephMonDaemonState.RUNNING
+class _CephFingerprint(object):
+    '''
+    Fingerprint of a converged state, lets later runs of the same state
+    return without detecting anything or forking any ceph tool.
+
+    A fingerprint hashes the state arguments, mtime and content of ceph.conf
+    and cheap identities of what the state manages: inode, mtime and size of
+    files (e.g. tag files), device number and partition GUID of devices.
+    The admin socket of the daemon, if any, is the only liveness check of
+    the fast path. Fingerprints expire after 'ceph_deploy.fingerprint_ttl'
+    seconds of config, 0 disables them.
+    '''
+    BY_PARTUUID = '/dev/disk/by-partuuid'
 
-    def is_running(self):
-        return self.status() != _CephMonDaemonState.DEAD
+    def __init__(self, op, subject, cluster=CEPH_CLUSTER, **kwargs):
+        '''
+        :param op: Operation, e.g. 'osd_manage'.
+        :param subject: What the operation manages, e.g. OSD data path.
+        :param cluster: Cluster name.
+        :param kwargs: Other arguments of the operation.
+        '''
+        super(_CephFingerprint, self).__init__()
 
+        cfg = _CephConf(cluster)
 
-class _CephOsdState(object):
-    FREE = 0,
-    PREPARED = 1,       # data and journal device prepared, tag: 'magic'
-    CREATED = 2,        # osd id generated, tag: 'whoami'
-    READY = 3,          # ceph-osd --mkfs finished, tag: 'ready'
-    ACTIVE = 4,         # entity authenticated, tag: 'active'
+        self.op = op
+        self.subject = subject
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.args = json.dumps([op, subject, cfg.cluster, kwargs],
+                               sort_keys=True)
 
+        name = hashlib.sha256(
+            json.dumps([cfg.cluster, subject])).hexdigest()
+        self.path = os.path.join(FINGERPRINT_DIR,
+                                 '{0}.{1}'.format(op, name))
 
-class _CephOsd(object):
-    def __init__(self, data, journal='', cluster=CEPH_CLUSTER):
-        super(_CephOsd, self).__init__()
+    @classmethod
+    def clear_all(cls, op):
+        '''
+        Remove fingerprints of an operation.
 
-        if journal is None:
-            journal = ''
-        if cluster is None:
-            cluster = CEPH_CLUSTER
+        :param op: Operation, e.g. 'auth_manage_batch'.
+        :return: None.
+        '''
+        try:
+            for fname in os.listdir(FINGERPRINT_DIR):
+                if fname.startswith(op + '.'):
+                    os.remove(os.path.join(FINGERPRINT_DIR, fname))
+        except OSError:
+            pass
 
-        cfg = _CephConf(cluster)
+    @classmethod
+    def __file_id(cls, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return [path, None]
 
-        if not os.path.exists(cfg.conf):
-            raise AssertionError('ceph conf file does not exist')
+        return [path, st.st_ino, st.st_mtime, st.st_size]
 
-        fsid_str = cfg.get_conf('fsid')
-        fsid = None
+    def __conf_id(self):
         try:
-            fsid = uuid.UUID(fsid_str)
-        except:
-            raise AssertionError('fsid is not valid')
+            st = os.stat(self.conf)
+            with open(self.conf, 'rb') as fobj:
+                digest = hashlib.sha256(fobj.read()).hexdigest()
+        except (IOError, OSError):
+            return None
 
-        if fsid.int == 0:
-            raise AssertionError('fsid not configured')
+        return [st.st_mtime, digest]
 
-        fstype = self.__get_fs_type(cfg)
-        if not self.__check_fs(fstype):
-            raise AssertionError('Not supported OSD filesystem type configured')
+    @classmethod
+    def __partuuids(cls):
+        # device path -> partition GUID, no need to fork blkid
+        partuuids = {}
 
-        (ddev, jdev) = self.__check_dev(data, journal)
+        if not os.path.isdir(cls.BY_PARTUUID):
+            return partuuids
 
-        self.cluster = cfg.cluster
-        self.conf = cfg.conf
-        self.cfg = cfg
-        self.fsid = fsid
+        for fname in os.listdir(cls.BY_PARTUUID):
+            path = os.path.join(cls.BY_PARTUUID, fname)
+            partuuids[os.path.realpath(path)] = fname
 
-        self.data = data
-        self.journal = journal
-        self.dtype = ddev.type
-        self.jtype = jdev.type if jdev else (ddev.type if journal else '')
-        self.ddev = ddev
-        self.jdev = jdev
+        return partuuids
 
-        self._state = None
+    @classmethod
+    def __dev_id(cls, path, partuuids):
+        rpath = os.path.realpath(path)
 
-        self.__old_id = None
-        self.__old_duuid = None
-        self.__old_juuid = None
-        self.__old_fstype = None
-        self.__old_signature = None
+        try:
+            rdev = os.stat(rpath).st_rdev
+        except OSError:
+            return [path, None]
 
-    @property
-    def state(self):
-        return self._state
+        return [path, rpath, rdev, partuuids.get(rpath)]
 
-    @classmethod
-    def __check_data_type(cls, dtype):
-        if dtype not in (_CephDevType.DISK, _CephDevType.PART, _CephDevType.DIR):
+    def digest(self, files=(), devices=()):
+        '''
+        Compute the fingerprint.
+
+        :param files: Paths of files identified by inode, mtime and size.
+        :param devices: Paths of devices identified by device number and
+                        partition GUID.
+        :return: Hex digest.
+        '''
+        partuuids = self.__partuuids() if devices else {}
+
+        ident = [
+            self.args,
+            self.__conf_id(),
+            [self.__file_id(x) for x in files],
+            [self.__dev_id(x, partuuids) for x in devices],
+        ]
+
+        return hashlib.sha256(json.dumps(ident)).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fobj:
+                record = json.load(fobj)
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(record, dict):
+            return None
+
+        return record
+
+    def check(self, probe=None):
+        '''
+        Check the state is still converged as fingerprinted.
+
+        :param probe: Callable returns True if what the state manages is
+                      still there, the liveness check of states without a
+                      daemon, e.g. one 'auth get' over the pooled session.
+        :return: True if the fingerprint matches and the daemon, if any,
+                 answers on its admin socket, and the probe, if any, passes.
+        '''
+        ttl = _fingerprint_ttl()
+        if ttl <= 0:
             return False
 
-        return True
+        record = self.load()
+        if record is None:
+            return False
 
-    @classmethod
-    def __check_journal_type(cls, jtype):
-        if jtype not in (_CephDevType.DISK, _CephDevType.PART, _CephDevType.FILE):
+        try:
+            age = time.time() - record['saved']
+            if age < 0 or age > ttl:
+                return False
+
+            if record['digest'] != self.digest(record['files'],
+                                               record['devices']):
+                return False
+
+            if record['asok']:
+                asok = _CephAdminSocket(record['asok'])
+                if not asok.is_alive():
+                    return False
+        except (KeyError, TypeError):
             return False
 
+        if probe is not None:
+            try:
+                if not probe():
+                    return False
+            except Exception:
+                return False
+
         return True
 
-    @classmethod
-    def __check_dev(cls, data, journal):
-        if not data:
-            raise ValueError('OSD data must not be None')
-        if not os.path.isabs(data):
-            raise ValueError('OSD data: {0} is not an abs path'.format(data))
-        if not os.path.exists(data):
-            raise ValueError('OSD data: {0} does not exist'.format(data))
+    def save(self, files=(), devices=(), asok=''):
+        '''
+        Record the fingerprint of a converged state.
 
-        if journal:
-            if not os.path.isabs(data):
-                raise ValueError(
-                    'OSD journal: {0} is not an abs path'.format(journal)
-                )
-            if not os.path.exists(journal):
-                raise ValueError(
-                    'OSD journal: {0} does not exist'.format(journal)
-                )
+        :param files: See digest.
+        :param devices: See digest.
+        :param asok: Admin socket path of the daemon managed, if any.
+        :return: None.
+        '''
+        if _fingerprint_ttl() <= 0:
+            return
+
+        record = {
+            'op': self.op,
+            'subject': self.subject,
+            'saved': time.time(),
+            'digest': self.digest(files, devices),
+            'files': list(files),
+            'devices': list(devices),
+            'asok': asok,
+        }
 
-        # d: data
-        # j: journal
+        # errors are ignored, a missing fingerprint only costs a full run
+        pdir = os.path.dirname(self.path)
 
-        (ddev, jdev) = (None, None)
+        try:
+            if not os.path.exists(pdir):
+                os.makedirs(pdir, 0700)
+
+            (fd, path) = tempfile.mkstemp(prefix='fp.', dir=pdir)
+            with os.fdopen(fd, 'wb') as fobj:
+                json.dump(record, fobj)
+            os.rename(path, self.path)
+        except (IOError, OSError):
+            pass
 
-        dtype = _CephDev.get_dev_type(data)
-        ddev = _CephDev(data, dtype)
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
-        if not cls.__check_data_type(dtype):
-            raise ValueError(
-                'Type: {t} of data device: {d} is not supported'
-                .format(d=data, t=dtype)
-            )
+    def update(self, ret, identity=None):
+        '''
+        Save the fingerprint if the state return shows the state converged,
+        i.e. succeeded without changes, clear it otherwise.
 
-        if journal:
-            jtype = _CephDev.get_dev_type(journal)
-            jdev = _CephDev(journal, jtype)
+        :param ret: Salt state return.
+        :param identity: Callable returns kwargs of save, or None if the
+                         state can not be fingerprinted.
+        :return: None.
+        '''
+        if ret['result'] and not ret['changes']:
+            kwargs = identity() if identity is not None else {}
+            if kwargs is not None:
+                self.save(**kwargs)
+                return
 
-            if not cls.__check_journal_type(jtype):
-                raise ValueError(
-                    'Type: {t} of journal device: {j} is not supported'
-                    .format(j=journal, t=jtype)
-                )
+        self.clear()
 
-            if jdev.is_part():
-                disk = jdev.get_part_disk()
-                if disk == ddev.dev:
-                    raise ValueError(
-                        'Data device: {d} and journal device: {j} conflict'
-                        .format(d=data, j=journal))
 
-            if ddev.dev == jdev.dev:
-                jdev = None
+class _CephMonSession(object):
+    '''
+    Monitor commands sent as an entity, in process by librados if the
+    python bindings are installed, or by the ceph CLI otherwise.
 
-        return ddev, jdev
+    Sessions are pooled per (cluster, name, key hash), so one monitor
+    connection and one admin credential serve all the calls of a state run.
+    The CLI fallback keeps the credential in an unlinked tmpfs file held
+    open by this process, it is gone as soon as the process exits.
 
-    @classmethod
-    def __detect_osd(cls, dev):
-        (state, osdid, duuid, juuid, fstype, signature) = \
-            (None, None, None, None, None, None)
-        dummy = (None, None, None, None, None, None)
+    Auth entries fetched are cached for AUTH_CACHE_TTL seconds, callers
+    changing an entity must forget it.
+    '''
+    AUTH_CACHE_TTL = 60                 # 60 seconds
+    PRIVATE_DIR = '/dev/shm'            # tmpfs, keys never hit the disk
 
-        rddev = None
-        fstype = None
+    _lock = threading.Lock()
+    _sessions = {}
 
-        if dev.is_disk():
-            label = dev.get_disk_label()
-            if label == _CephPartType.NONE:
-                return dummy
+    def __init__(self, name='', key='', cluster=CEPH_CLUSTER):
+        super(_CephMonSession, self).__init__()
 
-            if label != _CephPartType.GPT:
-                return dummy
+        cfg = _CephConf(cluster)
 
-            parts = dev.get_disk_part_list()
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.cfg = cfg
+        self.name = name
+        self.key = key
 
-            if parts == set():
-                return dummy
+        self.__lock = threading.Lock()
+        self.__rados = None
+        self.__keyfd = None
+        self.__auth = {}
+        self.__auth_all = None
 
-            if parts not in (set([1]), set([1, 2])):
-                return dummy
+    @classmethod
+    def get(cls, name='', key='', cluster=CEPH_CLUSTER):
+        '''
+        Get the pooled session of an entity.
 
-            # may have been prepared by ceph-disk
-            rdata = dev.get_disk_part(1)
+        :param name: Entity to authenticate as, empty for the defaults of
+                     ceph.conf, i.e. client.admin and its keyring.
+        :param key: Key of the entity, empty to use the keyring of ceph.conf.
+        :param cluster: Cluster name.
+        :return: _CephMonSession.
+        '''
+        skey = (cluster, name, hashlib.sha256(key).hexdigest())
 
-            if not os.path.exists(rdata):
-                raise AssertionError('Kernel not sync with disk?')
+        with cls._lock:
+            session = cls._sessions.get(skey)
+            if session is None:
+                session = cls(name, key, cluster)
+                cls._sessions[skey] = session
 
-            rddev = _CephDev(rdata, _CephDevType.PART)
+            return session
 
-            (_, typecode, _) = rddev.get_part_info()
+    @classmethod
+    def close_all(cls):
+        '''
+        Close all pooled sessions.
 
-            if typecode != OSD_UUID:
-                return dummy
+        :return: None.
+        '''
+        with cls._lock:
+            sessions = cls._sessions.values()
+            cls._sessions = {}
 
-            fstype = rddev.get_part_fs()
+        for session in sessions:
+            session.close()
 
-            if not cls.__check_fs(fstype):
-                return dummy
+    def close(self):
+        '''
+        Disconnect from the monitors and drop the credential and the cache.
 
-            if parts == set([1, 2]):
-                rjournal = dev.get_disk_part(2)
+        :return: None.
+        '''
+        with self.__lock:
+            (conn, self.__rados) = (self.__rados, None)
+            (keyfd, self.__keyfd) = (self.__keyfd, None)
+            self.__auth = {}
+            self.__auth_all = None
+
+        if conn is not None:
+            conn.shutdown()
+        if keyfd is not None:
+            os.close(keyfd)
+
+    def __connect(self):
+        with self.__lock:
+            if self.__rados is None:
+                conf = {}
+                if self.key:
+                    conf['key'] = self.key
+
+                conn = rados.Rados(name=self.name or None,
+                                   clustername=self.cluster,
+                                   conffile=self.conf,
+                                   conf=conf)
+                try:
+                    conn.connect(timeout=CEPH_CONNECT_TIMEOUT)
+                except rados.Error:
+                    conn.shutdown()
+                    raise
+
+                self.__rados = conn
+
+            return self.__rados
+
+    def __disconnect(self, conn):
+        with self.__lock:
+            if self.__rados is conn:
+                self.__rados = None
+
+        conn.shutdown()
 
-                if not os.path.exists(rjournal):
-                    raise AssertionError('Kernel not sync with disk?')
+    @classmethod
+    def __private_file(cls, data):
+        # unlinked right away, only reachable through /proc/<pid>/fd/<fd>
+        pdir = cls.PRIVATE_DIR if os.path.isdir(cls.PRIVATE_DIR) else None
 
-                rjdev = _CephDev(rjournal, _CephDevType.PART)
+        (fd, path) = tempfile.mkstemp(prefix='ceph-formula.', dir=pdir)
+        try:
+            os.remove(path)
+            os.write(fd, data)
+        except Exception:
+            os.close(fd)
+            raise
 
-                (_, typecode, _) = rjdev.get_part_info()
+        return fd
 
-                if typecode != JOURNAL_UUID:
-                    return dummy
-        elif dev.is_part():
-            rddev = dev
+    @staticmethod
+    def __fd_path(fd):
+        return '/proc/{0}/fd/{1}'.format(os.getpid(), fd)
 
-            fstype = rddev.get_part_fs()
+    def __get_keyring(self):
+        with self.__lock:
+            if self.__keyfd is None:
+                auth = _CephAuth(self.name, self.key, cluster=self.cluster)
+                self.__keyfd = self.__private_file(auth.keyring().dumps())
 
-            if not cls.__check_fs(fstype):
-                return dummy
+            return self.__fd_path(self.__keyfd)
 
-        mount = False   # data device mounted by us manually
-        path = ''       # location of OSD fs
+    def __rados_command(self, cmd, inbuf):
+        argv = ['mon_command', json.dumps(cmd, sort_keys=True)]
+        started = time.time()
 
+        conn = self.__connect()
         try:
-            if dev.is_disk() or dev.is_part():
-                (path, _, _) = rddev.get_mount_info()
+            (code, outbuf, outs) = conn.mon_command(json.dumps(cmd), inbuf,
+                                                    timeout=COMMAND_TIMEOUT)
+        except rados.Error as e:
+            # the connection may be broken, do not reuse it
+            self.__disconnect(conn)
+
+            _CephTrace.record_call(argv, started, time.time() - started,
+                                   errno.EIO, '', str(e))
+            raise RuntimeError(argv, str(e))
+
+        _CephTrace.record_call(argv, started, time.time() - started,
+                               -code, outbuf, outs)
+
+        return -code, outbuf, outs
+
+    def __cli_command(self, cmd, inbuf):
+        args = cmd.copy()
+        prefix = args.pop('prefix')
+
+        argv = ['ceph']
+        argv.extend(['--cluster', self.cluster])
+        argv.extend(['--conf', self.conf])
+        argv.extend(['--connect-timeout', str(CEPH_CONNECT_TIMEOUT)])
+        if self.name:
+            argv.extend(['--name', self.name])
+        if self.key:
+            argv.extend(['--keyring', self.__get_keyring()])
+        argv.extend(['--format', args.pop('format', 'json')])
+
+        infd = None
+        try:
+            if inbuf:
+                infd = self.__private_file(inbuf)
 
-                if path is None:
-                    # not mounted, mount to a tmp location manually
-                    path = rddev.mount_tmp(fstype)
-                    mount = True
-            else:
-                # data device is a directory
-                path = dev.dev
+                argv.extend(['--in-file', self.__fd_path(infd)])
 
-            # check
-            state = cls.__get_state(path)
-            osdid = cls.__get_id(path)
-            duuid = cls.__get_data_uuid(path)
-            juuid = cls.__get_journal_uuid(path)
-            signature = cls.__read_signature(path)
+            argv.extend(prefix.split())
+            for (_, val) in sorted(args.items(), key=self.__arg_order):
+                if isinstance(val, list):
+                    argv.extend(str(x) for x in val)
+                else:
+                    argv.append(str(val))
 
-            return state, osdid, duuid, juuid, fstype, signature
+            return _run(argv)
         finally:
-            if mount:
-                rddev.umount(path)
-                os.rmdir(path)
-
-    @classmethod
-    def __clear_dev(cls, dev):
-        if dev.is_disk():
-            if dev.get_disk_label() != _CephPartType.GPT:
-                dev.make_disk_label()
-            else:
-                dev.clear_disk()
+            if infd is not None:
+                os.close(infd)
 
-            cmd = ['partprobe']
-            cmd.append(dev.dev)
-            _run(cmd)
-        elif dev.is_part():
-            dev.clear_part()
-        elif dev.is_dir():
-            dev.clear_dir()
+    # the CLI takes arguments by position, in the order of the command
+    # signatures, e.g. 'osd crush create-or-move <id> <weight> <args>...'
+    CLI_ARG_ORDER = ('entity', 'id', 'name', 'weight', 'args')
 
     @classmethod
-    def __check_fs(cls, fstype):
-        if fstype not in (_CephFsType.EXT4, _CephFsType.XFS, _CephFsType.BTRFS):
-            return False
+    def __arg_order(cls, item):
+        if item[0] in cls.CLI_ARG_ORDER:
+            return (cls.CLI_ARG_ORDER.index(item[0]), item[0])
+        return (len(cls.CLI_ARG_ORDER), item[0])
 
-        return True
+    def command(self, prefix, inbuf='', **kwargs):
+        '''
+        Send a command to the monitors.
 
-    @classmethod
-    def __get_state(cls, path):
-        state = None
+        :param prefix: Command, e.g. 'auth get'.
+        :param inbuf: Input of the command, e.g. a keyring to import.
+        :param kwargs: Arguments of the command, e.g. entity='client.admin'.
+        :return: (code, outbuf, outs) 3-tuples, code is 0 or an errno.
+        '''
+        cmd = dict(kwargs)
+        cmd['prefix'] = prefix
+        cmd.setdefault('format', 'json')
 
-        tag = _CephOneLineTag(os.path.join(path, 'magic'))
-        magic = tag.read()
-        tag = _CephOneLineTag(os.path.join(path, 'whoami'))
-        whoami = tag.read()
-        tag = _CephOneLineTag(os.path.join(path, 'ready'))
-        ready = tag.read()
-        tag = _CephOneLineTag(os.path.join(path, 'active'))
-        active = tag.read()
+        if HAS_RADOS:
+            return self.__rados_command(cmd, inbuf)
 
-        if magic is not None:
-            state = _CephOsdState.PREPARED
-        elif whoami is not None:
-            raise AssertionError('corrupted osd filesystem')
-        if whoami is not None:
-            state = _CephOsdState.CREATED
-        elif ready is not None:
-            raise AssertionError('corrupted osd filesystem')
-        if ready is not None:
-            state = _CephOsdState.READY
-        elif active is not None:
-            raise AssertionError('corrupted osd filesystem')
-        if active is not None:
-            state = _CephOsdState.ACTIVE
+        return self.__cli_command(cmd, inbuf)
 
-        return state
+    def check_command(self, prefix, inbuf='', **kwargs):
+        '''
+        Send a command to the monitors, fail if the command failed.
 
-    @classmethod
-    def __get_id(cls, path):
-        tag = _CephOneLineTag(os.path.join(path, 'whoami'))
-        whoami = tag.read()
+        :return: Reply decoded from JSON, or the raw reply if not JSON.
+        '''
+        (code, outbuf, outs) = self.command(prefix, inbuf, **kwargs)
 
-        if whoami is None:
-            return None
+        if code:
+            raise RuntimeError(prefix, kwargs, outs, code)
 
         try:
-            osdid = int(whoami)
+            return json.loads(outbuf)
         except ValueError:
-            raise AssertionError('corrupted whoami: {0}'.format(whoami))
+            return outbuf
 
-        return osdid
+    def __auth_fresh(self, fetched):
+        return time.time() - fetched < self.AUTH_CACHE_TTL
 
-    @classmethod
-    def __get_fsid(cls, path):
-        tag = _CephOneLineTag(os.path.join(path, 'ceph_fsid'))
+    def auth_get(self, name):
+        '''
+        Get the auth entry of an entity, cached.
 
-        return tag.read()
+        :param name: Entity name.
+        :return: A dict with 'key' and 'caps', or None if the entity is not
+                 authenticated.
+        '''
+        with self.__lock:
+            if self.__auth_all is not None \
+                    and self.__auth_fresh(self.__auth_all):
+                return self.__auth.get(name, (None, None))[1]
 
-    @classmethod
-    def __get_data_uuid(cls, path):
-        tag = _CephOneLineTag(os.path.join(path, 'fsid'))
+            if name in self.__auth and self.__auth_fresh(self.__auth[name][0]):
+                return self.__auth[name][1]
 
-        return tag.read()
+        fetched = time.time()
+        (code, outbuf, outs) = self.command('auth get', entity=name)
 
-    @classmethod
-    def __get_journal_uuid(cls, path):
-        tag = _CephOneLineTag(os.path.join(path, 'journal_uuid'))
+        if code:
+            if code != errno.ENOENT:
+                raise RuntimeError('auth get', name, outs, code)
+            entry = None
+        else:
+            try:
+                entries = json.loads(outbuf)
+            except ValueError:
+                raise RuntimeError('auth get', name, 'Invalid JSON output')
 
-        return tag.read()
+            entry = _CephKeyring.from_export(entries).get(name)
 
-    @classmethod
-    def __read_signature(cls, path):
-        tag = _CephMultiLineTag(os.path.join(path, 'signature'))
+        with self.__lock:
+            self.__auth[name] = (fetched, entry)
 
-        return tag.read()
+        return entry
+
+    def auth_list(self):
+        '''
+        Get the whole auth database, cached.
+
+        :return: _CephKeyring of all authenticated entities.
+        '''
+        with self.__lock:
+            if self.__auth_all is not None \
+                    and self.__auth_fresh(self.__auth_all):
+                keyring = _CephKeyring()
+                for (name, (_, entry)) in sorted(self.__auth.iteritems()):
+                    if entry is not None:
+                        keyring.set(name, entry['key'], entry['caps'])
+
+                return keyring
+
+        fetched = time.time()
+        data = self.check_command('auth list')
+
+        if isinstance(data, dict):
+            data = data.get('auth_dump', [])
+        if not isinstance(data, list):
+            raise RuntimeError('auth list', 'Invalid JSON output')
+
+        keyring = _CephKeyring.from_export(data)
+
+        with self.__lock:
+            self.__auth = dict((x, (fetched, keyring.get(x)))
+                               for x in keyring.names)
+            self.__auth_all = fetched
+
+        return keyring
+
+    def auth_forget(self, names=None):
+        '''
+        Drop cached auth entries, e.g. after the entities changed.
+
+        :param names: Entity names, None for all.
+        :return: None.
+        '''
+        with self.__lock:
+            if names is None:
+                self.__auth = {}
+            else:
+                for name in names:
+                    self.__auth.pop(name, None)
+
+            self.__auth_all = None
+
+
+atexit.register(_CephMonSession.close_all)
+
+
+class _CephCluster(object):
+    '''
+    Cluster wide queries through the monitor session of the default entity,
+    replies are JSON.
+    '''
+    def __init__(self, cluster=CEPH_CLUSTER):
+        super(_CephCluster, self).__init__()
+
+        cfg = _CephConf(cluster)
+
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.cfg = cfg
+        self.session = _CephMonSession.get(cluster=cluster)
+
+    def command(self, prefix, **kwargs):
+        '''
+        Run a monitor command with JSON output.
+
+        :param prefix: Command, e.g. 'osd dump'.
+        :param kwargs: Arguments of the command.
+        :return: Reply decoded from JSON.
+        '''
+        data = self.session.check_command(prefix, **kwargs)
+
+        if isinstance(data, basestring):
+            raise RuntimeError(prefix, 'Invalid JSON output', data)
+
+        return data
+
+    def osd_map(self):
+        '''
+        Get the OSD map.
+
+        :return: (flags, osds) 2-tuple, flags is a set of cluster flags,
+        e.g. noout, osds is a dict of osd id -> entry of the OSD map.
+        '''
+        data = self.command('osd dump')
+
+        flags = set(x for x in data.get('flags', '').split(',') if x)
+        osds = dict((osd['osd'], osd) for osd in data.get('osds', []))
+
+        return flags, osds
+
+    def osd_dump(self):
+        '''
+        Get the OSD map.
+
+        :return: A dict of osd id -> (up, in) 2-tuples.
+        '''
+        (_, osds) = self.osd_map()
+
+        return dict((osdid, (bool(osd.get('up')), bool(osd.get('in'))))
+                    for osdid, osd in osds.iteritems())
+
+    def set_flag(self, flag):
+        '''
+        Set a cluster flag, e.g. noout.
+
+        :param flag: Flag name.
+        :return: None.
+        '''
+        self.command('osd set', key=flag)
+
+    def unset_flag(self, flag):
+        '''
+        Unset a cluster flag.
+
+        :param flag: Flag name.
+        :return: None.
+        '''
+        self.command('osd unset', key=flag)
+
+    def pg_states(self):
+        '''
+        Get PG states of the whole cluster.
+
+        :return: A dict of PG state, e.g. 'active+clean' -> count.
+        '''
+        data = self.command('status')
+
+        pgmap = data.get('pgmap', {})
+
+        return dict((x['state_name'], x['count'])
+                    for x in pgmap.get('pgs_by_state', []))
+
+    def is_clean(self):
+        '''
+        Check if all PGs are active+clean.
+
+        :return: True if clean.
+        '''
+        return all(state == 'active+clean' for state in self.pg_states())
+
+    def recovering(self):
+        '''
+        Get the recovery load of the cluster.
+
+        :return: Number of PGs backfilling or recovering, or waiting to.
+        '''
+        return sum(count for state, count in self.pg_states().iteritems()
+                   if 'backfill' in state or 'recover' in state)
+
+    def osd_create(self, osd_uuid):
+        '''
+        Allocate an OSD id for an OSD uuid, the same id is returned if the
+        uuid is already allocated, as 'ceph-disk activate' does.
+
+        :param osd_uuid: OSD uuid, i.e. the fsid tag of the OSD.
+        :return: OSD id.
+        '''
+        data = self.session.check_command('osd create', uuid=osd_uuid)
+
+        if isinstance(data, dict):
+            data = data.get('osdid')
+
+        return int(data)
+
+    def crush_weights(self):
+        '''
+        Get CRUSH weights of all OSDs in the CRUSH map.
+
+        :return: A dict of osd id -> weight.
+        '''
+        data = self.command('osd tree')
+
+        return dict((node['id'], float(node.get('crush_weight', 0)))
+                    for node in data.get('nodes', [])
+                    if node.get('type') == 'osd')
+
+    def crush_add(self, osdid, weight, location):
+        '''
+        Add an OSD to the CRUSH map with a weight, an OSD already in the map
+        is only moved and keeps its weight.
+
+        :param osdid: OSD id.
+        :param weight: CRUSH weight.
+        :param location: A list of 'type=name', e.g. ['host=a', 'root=b'].
+        :return: None.
+        '''
+        self.command('osd crush create-or-move',
+                     id='osd.{0}'.format(osdid), weight=float(weight),
+                     args=location)
+
+    def inject_osds(self, options):
+        '''
+        Inject options into all running OSDs, 'ceph tell osd.* injectargs'.
+
+        :param options: A dict of option key -> value.
+        :return: None.
+        '''
+        args = ' '.join('--{0} {1}'.format(key, val)
+                        for key, val in sorted(options.iteritems()))
+
+        def tell(target):
+            cmd = ['ceph']
+            cmd.extend(['--cluster', self.cluster])
+            cmd.extend(['--conf', self.conf])
+            cmd.extend(['--connect-timeout', str(CEPH_CONNECT_TIMEOUT)])
+            cmd.extend(['tell', target, 'injectargs', '--', args])
+
+            return _run(cmd)
+
+        (code, _, err) = tell('osd.*')
+        if not code:
+            return
+
+        # OSDs down fail the tell too, only OSDs up must take the options
+        for osdid, (up, _in) in sorted(self.osd_dump().iteritems()):
+            if not up:
+                continue
+
+            (code, _, err) = tell('osd.{0}'.format(osdid))
+            if code:
+                raise RuntimeError('tell osd.{0} injectargs'.format(osdid),
+                                   options, err, code)
+
+    def crush_reweight(self, osdid, weight):
+        '''
+        Set the CRUSH weight of an OSD.
+
+        :param osdid: OSD id.
+        :param weight: CRUSH weight.
+        :return: None.
+        '''
+        self.command('osd crush reweight', name='osd.{0}'.format(osdid),
+                     weight=float(weight))
+
+    def osd_remove(self, osdid):
+        '''
+        Remove an OSD from the cluster, i.e. mark it down, remove its auth
+        entry, CRUSH item and id, what has been removed is skipped.
+
+        :param osdid: OSD id.
+        :return: None.
+        '''
+        name = 'osd.{0}'.format(osdid)
+
+        # the id can only be removed once the OSD is down
+        for (prefix, kwargs) in (('osd down', {'ids': [name]}),
+                                 ('auth del', {'entity': name}),
+                                 ('osd crush remove', {'name': name}),
+                                 ('osd rm', {'ids': [name]})):
+            (code, _, outs) = self.session.command(prefix, **kwargs)
+            if code and code != errno.ENOENT:
+                raise RuntimeError(prefix, kwargs, outs, code)
+
+        self.session.auth_forget([name])
+        _CephCrushRamp.forget([osdid], self.cluster)
+
+
+class _CephConfLive(object):
+    '''
+    Push changed ceph.conf options to the running daemons on this host by
+    'config set' on their admin sockets, instead of restarting them.
+
+    Options read only at startup are not pushed. For the others the daemon
+    tells whether the change took effect: options nobody observes at
+    runtime are reported as "not observed, change may require restart".
+    Options not applied are recorded as pending until the daemon restarts,
+    i.e. until its admin socket is newer than the record.
+    '''
+    STARTUP_OPTIONS = ('fsid', 'mon_host', 'mon_initial_members',
+                       'public_network', 'cluster_network', 'public_addr',
+                       'cluster_addr', 'mon_data', 'osd_data', 'osd_journal',
+                       'osd_objectstore', 'keyring', 'run_dir',
+                       'admin_socket', 'pid_file', 'log_file')
+    STARTUP_PREFIXES = ('auth_', 'ms_')
+    RESTART_HINTS = ('not observed', 'unchangeable', 'require restart')
+
+    _lock = threading.Lock()
+
+    def __init__(self, cluster=CEPH_CLUSTER):
+        super(_CephConfLive, self).__init__()
+
+        cfg = _CephConf(cluster)
+
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.cfg = cfg
 
     @classmethod
-    def __write_signature(cls, path, sig):
-        tag = _CephMultiLineTag(os.path.join(path, 'signature'))
+    def is_startup(cls, key):
+        '''
+        Check if an option is known to be read only at daemon startup.
 
-        tag.write(sig)
+        :param key: Option key.
+        :return: True if a restart is needed to change it.
+        '''
+        key = _CephConf.normalize_key(key)
+
+        return key in cls.STARTUP_OPTIONS or key.startswith(cls.STARTUP_PREFIXES)
 
     @classmethod
-    def __remove_signature(cls, path):
-        tag = _CephMultiLineTag(os.path.join(path, 'signature'))
+    def __affects(cls, section, name):
+        etype = name.split('.', 1)[0]
 
-        tag.remove()
+        return section in ('global', etype, name)
+
+    def __config_set(self, asok, key, value):
+        '''
+        Set an option of a running daemon.
+
+        :return: None if applied, or why a restart is still needed.
+        '''
+        try:
+            reply = _CephAdminSocket(asok).command('config set', var=key,
+                                                   val=[value])
+        except (socket.error, ValueError) as e:
+            return 'config set failed: {0}'.format(e)
+
+        if not isinstance(reply, dict):
+            return 'config set failed: {0}'.format(reply)
+        if 'error' in reply:
+            return 'config set failed: {0}'.format(reply['error'])
+
+        success = str(reply.get('success', ''))
+        for hint in self.RESTART_HINTS:
+            if hint in success:
+                return 'not observed at runtime'
+
+        return None
+
+    def apply(self, changed):
+        '''
+        Apply changed options to the running daemons they affect, values are
+        read back from ceph.conf as each daemon sees it.
+
+        :param changed: A dict of section -> list of changed option keys.
+        :return: (applied, restart) 2-tuples, applied is a dict of daemon
+                 name -> list of 'key = value', restart is a dict of daemon
+                 name -> list of keys which still need a restart.
+        '''
+        status = _CephHostStatus.get(self.cluster)
+
+        applied = {}
+        restart = {}
+
+        for name in status.daemons():
+            if name.split('.', 1)[0] not in ('mon', 'osd', 'mds'):
+                continue
+
+            keys = set()
+            for section, skeys in changed.iteritems():
+                if self.__affects(section, name):
+                    keys.update(_CephConf.normalize_key(x) for x in skeys)
+
+            if not keys:
+                continue
+
+            if not status.status(name):
+                # a stopped daemon reads ceph.conf when it is started
+                continue
+
+            for key in sorted(keys):
+                if self.is_startup(key):
+                    restart.setdefault(name, []).append(key)
+                    continue
+
+                value = self.cfg.get_conf(key, name)
+                if value is None:
+                    restart.setdefault(name, []).append(key)
+                    continue
+
+                why = self.__config_set(status.sockets[name], key, value)
+                if why is None:
+                    applied.setdefault(name, []).append(
+                        '{0} = {1}'.format(key, value))
+                else:
+                    restart.setdefault(name, []).append(key)
+
+        if restart:
+            self.__record(restart)
+
+        return applied, restart
 
     @classmethod
-    def __parse_signature(cls, sig):
-        sig = [x.split('=', 1) for x in sig]
+    def __load(cls):
+        try:
+            with open(RESTART_FILE, 'rb') as fobj:
+                pending = json.load(fobj)
+        except (IOError, ValueError):
+            return {}
+
+        return pending if isinstance(pending, dict) else {}
+
+    def __record(self, restart):
+        # errors are ignored, pending restarts are reported by the state too
+        pdir = os.path.dirname(RESTART_FILE)
+
+        with self._lock:
+            pending = self.__load()
+            daemons = pending.setdefault(self.cluster, {})
+
+            now = time.time()
+            for name, keys in restart.iteritems():
+                entry = daemons.get(name)
+                if entry is None or self.__restarted(entry['since'], name):
+                    entry = {'since': now, 'keys': []}
+                entry['keys'] = sorted(set(entry['keys']) | set(keys))
+                daemons[name] = entry
+
+            try:
+                if not os.path.exists(pdir):
+                    os.makedirs(pdir, 0700)
+
+                (fd, path) = tempfile.mkstemp(prefix='restart.', dir=pdir)
+                with os.fdopen(fd, 'wb') as fobj:
+                    json.dump(pending, fobj)
+                os.rename(path, RESTART_FILE)
+            except (IOError, OSError):
+                pass
+
+    def __restarted(self, since, name=None):
+        if name is None:
+            return False
+
+        asok = _CephHostStatus.get(self.cluster).sockets.get(name)
+        if not asok:
+            return False
+
+        try:
+            return os.stat(asok).st_mtime > since
+        except OSError:
+            return False
+
+    def pending(self):
+        '''
+        Get options still waiting for a restart of their daemons.
+
+        :return: A dict of daemon name -> list of keys.
+        '''
+        daemons = self.__load().get(self.cluster, {})
+
+        return dict((name, entry['keys'])
+                    for name, entry in daemons.iteritems()
+                    if not self.__restarted(entry['since'], name))
+
+
+class _CephDaemon(object):
+    def __init__(self, etype, eid, cluster=CEPH_CLUSTER):
+        super(_CephDaemon, self).__init__()
+
+        if etype not in ['mon', 'osd', 'mds', 'client']:
+            raise ValueError('Invalid daemon type: {0}'.format(etype))
+
+        cfg = _CephConf(cluster)
+
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.cfg = cfg
+        self.type = etype
+        self.id = eid
+        self.name = '{type}.{id}'.format(type=etype, id=eid)
+
+    @classmethod
+    def start_mon(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('start')
+        cmd.append('mon')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def start_osd(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('start')
+        cmd.append('osd')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def start_mds(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('start')
+        cmd.append('mds')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def start_all(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('start')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def stop_mon(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('stop')
+        cmd.append('mon')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def stop_osd(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('stop')
+        cmd.append('osd')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def stop_mds(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('stop')
+        cmd.append('mds')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def stop_all(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('stop')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def restart_mon(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('restart')
+        cmd.append('mon')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def restart_osd(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('restart')
+        cmd.append('osd')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def restart_mds(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('restart')
+        cmd.append('mds')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    @classmethod
+    def restart_all(cls, cluster=CEPH_CLUSTER):
+        cfg = _CephConf(cluster)
+
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('restart')
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    def start(self):
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.append('start')
+        cmd.append(self.name)
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    def stop(self):
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.append('stop')
+        cmd.append(self.name)
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    def restart(self):
+        cmd = ['/etc/init.d/ceph']
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.append('restart')
+        cmd.append(self.name)
+
+        try:
+            _check_run(cmd)
+        finally:
+            _CephHostStatus.invalidate()
+
+    def status(self):
+        pass
+
+    def is_running(self):
+        pass
+
+
+class _CephOsdDaemonState(object):
+    DEAD = 0
+    RUNNING = 1
+
+
+class _CephOsdDaemon(_CephDaemon):
+    def __init__(self, osdid, cluster=CEPH_CLUSTER):
+        super(_CephOsdDaemon, self).__init__('osd', osdid, cluster)
+
+    def status(self):
+        running = _CephHostStatus.get(self.cluster).status(self.name)
+
+        if running is not None:
+            return _CephOsdDaemonState.RUNNING if running else _CephOsdDaemonState.DEAD
+
+        cmd = ['ceph']
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.append('daemon')
+        cmd.append(self.name)
+        cmd.append('status')
+
+        (code, _, stderr) = _run(cmd)
+
+        # TODO: Read ceph source to verify this errno.
+        if code:
+            if code == errno.EINVAL:
+                return _CephOsdDaemonState.DEAD
+            raise RuntimeError(cmd, stderr, code)
+
+        return _CephOsdDaemonState.RUNNING
+
+    def is_running(self):
+        return self.status() != _CephOsdDaemonState.DEAD
+
+
+class _CephMonDaemonState(object):
+    DEAD = 0
+    RUNNING = 1
+
+
+class _CephMonDaemon(_CephDaemon):
+    def __init__(self, monid, cluster=CEPH_CLUSTER):
+        super(_CephMonDaemon, self).__init__('mon', monid, cluster)
+
+    def status(self):
+        running = _CephHostStatus.get(self.cluster).status(self.name)
+
+        if running is not None:
+            return _CephMonDaemonState.RUNNING if running else _CephMonDaemonState.DEAD
+
+        cmd = ['ceph']
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
+        cmd.append('daemon')
+        cmd.append(self.name)
+        cmd.append('mon_status')
+
+        (code, _, stderr) = _run(cmd)
+
+        # TODO: Read ceph source to verify this errno.
+        if code:
+            if code == errno.EINVAL:
+                return _CephMonDaemonState.DEAD
+            raise RuntimeError(cmd, stderr, code)
+
+        return _CephMonDaemonState.RUNNING
+
+    def is_running(self):
+        return self.status() != _CephMonDaemonState.DEAD
+
+    def mon_status(self):
+        '''
+        Get mon_status from the admin socket of the MON.
+
+        :return: mon_status decoded from JSON.
+        '''
+        asok = self.cfg.get_conf('admin_socket', self.name)
+
+        data = _CephAdminSocket(asok).command('mon_status')
+
+        if not isinstance(data, dict):
+            raise RuntimeError('Invalid mon_status: {0}'.format(data))
+
+        return data
+
+    @classmethod
+    def quorum_names(cls, status):
+        '''
+        Get names of MONs in quorum from mon_status.
+
+        :param status: mon_status.
+        :return: A list of MON names.
+        '''
+        mons = status.get('monmap', {}).get('mons', [])
+
+        return [x['name'] for x in mons
+                if x.get('rank') in status.get('quorum', [])]
+
+    def wait_quorum(self, timeout=MON_QUORUM_TIMEOUT):
+        '''
+        Wait for the MON to join a quorum, mon_status is polled with
+        exponential backoff, the MON may still be starting.
+
+        :param timeout: Max seconds to wait.
+        :return: mon_status of the MON in quorum.
+        '''
+        deadline = time.time() + timeout
+        delay = MON_QUORUM_MIN_DELAY
+
+        status = None
+        error = None
+
+        while True:
+            try:
+                status = self.mon_status()
+                error = None
+                if status.get('state') in ('leader', 'peon'):
+                    return status
+            except (socket.error, ValueError, RuntimeError) as e:
+                error = e
+
+            now = time.time()
+            if now >= deadline:
+                break
+
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, MON_QUORUM_MAX_DELAY)
+
+        if status is None or error is not None:
+            raise RuntimeError('{0} is not responding after {1}s: {2}'
+                               .format(self.name, timeout, error))
+
+        # tell which MONs are missing, these are the ones to look at
+        mons = [x['name'] for x in status.get('monmap', {}).get('mons', [])]
+        quorum = self.quorum_names(status)
+
+        raise RuntimeError('{0} is not in quorum after {1}s, state: {2}, '
+                           'MONs in monmap: {3}, in quorum: {4}'
+                           .format(self.name, timeout, status.get('state'),
+                                   ', '.join(mons) or 'none',
+                                   ', '.join(quorum) or 'none'))
+
+
+class _CephOsdState(object):
+    FREE = 0,
+    PREPARED = 1,       # data and journal device prepared, tag: 'magic'
+    CREATED = 2,        # osd id generated, tag: 'whoami'
+    READY = 3,          # ceph-osd --mkfs finished, tag: 'ready'
+    ACTIVE = 4,         # entity authenticated, tag: 'active'
+
+
+class _CephOsdCache(object):
+    '''
+    Persistent cache of OSD detection results on this host.
+
+    An entry is keyed by the partition unique GUID of the OSD data partition
+    and is valid as long as the filesystem UUID recorded does not change,
+    i.e. the partition has not been re-created or re-formatted. Entries are
+    removed by us whenever we change the state of the OSD.
+    '''
+    def __init__(self, dev):
+        '''
+        Init _CephOsdCache object.
+
+        :param dev: _CephDev of the OSD data partition.
+        :return: None.
+        '''
+        super(_CephOsdCache, self).__init__()
+
+        (guid, _, _) = dev.get_part_info()
+
+        self.guid = guid
+        self.fsuuid = dev.get_part_fs_uuid()
+        self.path = os.path.join(OSD_CACHE_DIR, guid) if guid else None
+
+    def read(self):
+        '''
+        Read the cached detection result.
+
+        :return: A dict of the last observed state, id, fsid, data uuid,
+        journal uuid, fstype and signature, None if no valid entry.
+        '''
+        if self.path is None or self.fsuuid is None:
+            return None
+
+        try:
+            with open(self.path, 'rb') as fobj:
+                entry = json.load(fobj)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('fsuuid') != self.fsuuid:
+            return None
+
+        # _CephOsdState values are tuples
+        if entry['state'] is not None:
+            entry['state'] = tuple(entry['state'])
+
+        return entry
+
+    def write(self, state, osdid, fsid, duuid, juuid, fstype, signature):
+        '''
+        Record the detection result, errors are ignored since the cache is
+        only an optimization.
+
+        :return: None.
+        '''
+        if self.path is None or self.fsuuid is None:
+            return
+
+        entry = {
+            'fsuuid': self.fsuuid,
+            'state': state,
+            'id': osdid,
+            'fsid': fsid,
+            'duuid': duuid,
+            'juuid': juuid,
+            'fstype': fstype,
+            'signature': signature,
+        }
+
+        try:
+            if not os.path.exists(OSD_CACHE_DIR):
+                os.makedirs(OSD_CACHE_DIR, 0700)
+
+            (fd, path) = tempfile.mkstemp(prefix='osd.', dir=OSD_CACHE_DIR)
+            with os.fdopen(fd, 'wb') as fobj:
+                json.dump(entry, fobj)
+            os.rename(path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def remove(self):
+        '''
+        Remove the cache entry.
+
+        :return: None.
+        '''
+        if self.path is None:
+            return
+
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @classmethod
+    def discard(cls, guid):
+        '''
+        Remove the cache entry of a partition, which may be gone.
+
+        :param guid: Partition GUID of the OSD data partition.
+        :return: None.
+        '''
+        try:
+            os.remove(os.path.join(OSD_CACHE_DIR, guid))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @classmethod
+    def entries(cls):
+        '''
+        Get all cache entries, valid or not.
+
+        :return: A dict of partition GUID -> entry.
+        '''
+        entries = {}
+
+        if not os.path.isdir(OSD_CACHE_DIR):
+            return entries
+
+        for guid in os.listdir(OSD_CACHE_DIR):
+            if guid.startswith('osd.'):
+                continue
+            try:
+                with open(os.path.join(OSD_CACHE_DIR, guid), 'rb') as fobj:
+                    entries[guid] = json.load(fobj)
+            except (IOError, ValueError):
+                continue
+
+        return entries
+
+
+class _CephOsd(object):
+    __ONE_LINE_TAGS = ('magic', 'whoami', 'ready', 'active',
+                       'ceph_fsid', 'fsid', 'journal_uuid')
+    __MULTI_LINE_TAGS = ('signature',)
+
+    def __init__(self, data, journal='', cluster=CEPH_CLUSTER,
+                 initial_weight=None):
+        super(_CephOsd, self).__init__()
+
+        if journal is None:
+            journal = ''
+        if cluster is None:
+            cluster = CEPH_CLUSTER
+
+        cfg = _CephConf(cluster)
+
+        if not os.path.exists(cfg.conf):
+            raise AssertionError('ceph conf file does not exist')
+
+        fsid_str = cfg.get_conf('fsid')
+        fsid = None
+        try:
+            fsid = uuid.UUID(fsid_str)
+        except:
+            raise AssertionError('fsid is not valid')
+
+        if fsid.int == 0:
+            raise AssertionError('fsid not configured')
+
+        fstype = self.__get_fs_type(cfg)
+        if not self.__check_fs(fstype):
+            raise AssertionError('Not supported OSD filesystem type configured')
+
+        (ddev, jdev) = self.__check_dev(data, journal)
+
+        self.cluster = cfg.cluster
+        self.conf = cfg.conf
+        self.cfg = cfg
+        self.fsid = fsid
+
+        self.data = data
+        self.journal = journal
+        self.dtype = ddev.type
+        self.jtype = jdev.type if jdev else (ddev.type if journal else '')
+        self.ddev = ddev
+        self.jdev = jdev
+        self.initial_weight = initial_weight
+
+        self._state = None
+
+        self.__old_id = None
+        self.__old_fsid = None
+        self.__old_duuid = None
+        self.__old_juuid = None
+        self.__old_fstype = None
+        self.__old_signature = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @classmethod
+    def __check_data_type(cls, dtype):
+        if dtype not in (_CephDevType.DISK, _CephDevType.PART, _CephDevType.DIR):
+            return False
+
+        return True
+
+    @classmethod
+    def __check_journal_type(cls, jtype):
+        if jtype not in (_CephDevType.DISK, _CephDevType.PART, _CephDevType.FILE):
+            return False
+
+        return True
+
+    @classmethod
+    def __check_dev(cls, data, journal):
+        if not data:
+            raise ValueError('OSD data must not be None')
+        if not os.path.isabs(data):
+            raise ValueError('OSD data: {0} is not an abs path'.format(data))
+        if not os.path.exists(data):
+            raise ValueError('OSD data: {0} does not exist'.format(data))
+
+        if journal:
+            if not os.path.isabs(data):
+                raise ValueError(
+                    'OSD journal: {0} is not an abs path'.format(journal)
+                )
+            if not os.path.exists(journal):
+                raise ValueError(
+                    'OSD journal: {0} does not exist'.format(journal)
+                )
+
+        # d: data
+        # j: journal
+
+        (ddev, jdev) = (None, None)
+
+        dtype = _CephDev.get_dev_type(data)
+        ddev = _CephDev(data, dtype)
+
+        if not cls.__check_data_type(dtype):
+            raise ValueError(
+                'Type: {t} of data device: {d} is not supported'
+                .format(d=data, t=dtype)
+            )
+
+        if journal:
+            jtype = _CephDev.get_dev_type(journal)
+            jdev = _CephDev(journal, jtype)
+
+            if not cls.__check_journal_type(jtype):
+                raise ValueError(
+                    'Type: {t} of journal device: {j} is not supported'
+                    .format(j=journal, t=jtype)
+                )
+
+            if jdev.is_part():
+                disk = jdev.get_part_disk()
+                if disk == ddev.dev:
+                    raise ValueError(
+                        'Data device: {d} and journal device: {j} conflict'
+                        .format(d=data, j=journal))
+
+            if ddev.dev == jdev.dev:
+                jdev = None
+
+        return ddev, jdev
+
+    @classmethod
+    def __data_part(cls, dev):
+        '''
+        Get the OSD data partition of a data device.
+
+        :param dev: _CephDev of the data device.
+        :return: _CephDev of the data partition, None if the data device is
+        a directory or the partition does not exist.
+        '''
+        if dev.is_part():
+            return dev
+
+        if dev.is_disk():
+            rdata = dev.get_disk_part(1)
+            if os.path.exists(rdata):
+                return _CephDev(rdata, _CephDevType.PART)
+
+        return None
+
+    @classmethod
+    def __forget(cls, dev):
+        '''
+        Remove cached detection result of a data device, must be called
+        before we change the state of the OSD.
+
+        :param dev: _CephDev of the data device.
+        :return: None.
+        '''
+        rddev = cls.__data_part(dev)
+
+        if rddev is not None:
+            _CephOsdCache(rddev).remove()
+
+    @classmethod
+    def __detect_osd(cls, dev, mount=True):
+        (state, osdid, fsid, duuid, juuid, fstype, signature) = \
+            (None, None, None, None, None, None, None)
+        dummy = (None, None, None, None, None, None, None)
+
+        rddev = None
+        fstype = None
+
+        if dev.is_disk():
+            label = dev.get_disk_label()
+            if label == _CephPartType.NONE:
+                return dummy
+
+            if label != _CephPartType.GPT:
+                return dummy
+
+            parts = dev.get_disk_part_list()
+
+            if parts == set():
+                return dummy
+
+            if parts not in (set([1]), set([1, 2])):
+                return dummy
+
+            # may have been prepared by ceph-disk
+            rdata = dev.get_disk_part(1)
+
+            if not os.path.exists(rdata):
+                raise AssertionError('Kernel not sync with disk?')
+
+            rddev = _CephDev(rdata, _CephDevType.PART)
+
+            (_, typecode, _) = rddev.get_part_info()
+
+            if typecode != OSD_UUID:
+                return dummy
+
+            fstype = rddev.get_part_fs()
+
+            if not cls.__check_fs(fstype):
+                return dummy
+
+            if parts == set([1, 2]):
+                rjournal = dev.get_disk_part(2)
+
+                if not os.path.exists(rjournal):
+                    raise AssertionError('Kernel not sync with disk?')
+
+                rjdev = _CephDev(rjournal, _CephDevType.PART)
+
+                (_, typecode, _) = rjdev.get_part_info()
+
+                if typecode != JOURNAL_UUID:
+                    return dummy
+        elif dev.is_part():
+            rddev = dev
+
+            fstype = rddev.get_part_fs()
+
+            if not cls.__check_fs(fstype):
+                return dummy
+
+        mounted = False # data device mounted by us manually
+        path = ''       # location of OSD fs
+        cache = None
+        tags = None     # tags of OSD fs
+
+        try:
+            if dev.is_disk() or dev.is_part():
+                cache = _CephOsdCache(rddev)
+
+                (path, _, _) = rddev.get_mount_info()
+
+                if path is None:
+                    entry = cache.read()
+                    if entry is not None:
+                        return (entry['state'], entry['id'], entry['fsid'],
+                                entry['duuid'], entry['juuid'], fstype,
+                                entry['signature'])
+
+                    tags = cls.__probe_tags(rddev, fstype)
+
+                    if tags is None and not mount:
+                        return None
+
+                    if tags is None:
+                        # not mounted, mount to a tmp location manually
+                        path = rddev.mount_tmp(fstype)
+                        mounted = True
+            else:
+                # data device is a directory
+                path = dev.dev
+
+            if tags is None:
+                tags = cls.__read_tags(path)
+
+            # check
+            state = cls.__get_state(tags)
+            osdid = cls.__get_id(tags)
+            fsid = cls.__get_fsid(tags)
+            duuid = cls.__get_data_uuid(tags)
+            juuid = cls.__get_journal_uuid(tags)
+            signature = cls.__read_signature(tags)
+
+            if cache is not None:
+                cache.write(state, osdid, fsid, duuid, juuid, fstype,
+                            signature)
+
+            return state, osdid, fsid, duuid, juuid, fstype, signature
+        finally:
+            if mounted:
+                rddev.umount(path)
+                os.rmdir(path)
+
+    @classmethod
+    def probe(cls, dev, mount=True):
+        '''
+        Detect the OSD on a device without managing it.
+
+        :param dev: _CephDev of the OSD data disk, partition or directory.
+        :param mount: Mount the data partition to a tmp location if its tags
+        can not be read otherwise.
+        :return: A dict of state, id, fsid, duuid, juuid and fstype, state
+        is None if no OSD found, or None if mount is False and the OSD can
+        not be detected without mounting.
+        '''
+        detected = cls.__detect_osd(dev, mount)
+        if detected is None:
+            return None
+
+        (state, osdid, fsid, duuid, juuid, fstype, _) = detected
+
+        return {
+            'state': state,
+            'id': osdid,
+            'fsid': fsid,
+            'duuid': duuid,
+            'juuid': juuid,
+            'fstype': fstype,
+        }
+
+    @classmethod
+    def locate(cls, osdid, cluster=CEPH_CLUSTER):
+        '''
+        Find the devices of an OSD on this host by the whoami and
+        journal_uuid tags of OSD data partitions, or by the OSD detection
+        cache if its data partition can not be read any more.
+
+        :param osdid: OSD id.
+        :param cluster: Cluster name.
+        :return: A dict of data, guid, juuid and journal, data and journal
+        are paths of the data and journal partitions, None if gone, or None
+        if the OSD is not found.
+        '''
+        fsid = str(_CephConf(cluster).get_conf('fsid')).lower()
+
+        found = None
+
+        blocks = _BlockInventory.get()
+
+        for part in sorted(blocks.parts):
+            dev = _CephDev(part, _CephDevType.PART)
+            (guid, typecode, _) = dev.get_part_info()
+
+            if typecode != OSD_UUID:
+                continue
+
+            try:
+                osd = cls.probe(dev)
+            except Exception:
+                # a failing disk, may be the one we are looking for
+                continue
+
+            if osd['id'] == osdid and str(osd['fsid']).lower() == fsid:
+                found = {'data': part, 'guid': guid, 'juuid': osd['juuid']}
+                break
+
+        if found is None:
+            for guid, entry in sorted(_CephOsdCache.entries().iteritems()):
+                if entry.get('id') != osdid \
+                        or str(entry.get('fsid')).lower() != fsid:
+                    continue
+
+                rdata = '/dev/disk/by-partuuid/{0}'.format(guid.lower())
+                found = {
+                    'data': os.path.realpath(rdata)
+                    if os.path.exists(rdata) else None,
+                    'guid': guid,
+                    'juuid': entry.get('juuid'),
+                }
+                break
+
+        if found is None:
+            return None
+
+        found['journal'] = None
+
+        if found['juuid']:
+            rjournal = '/dev/disk/by-partuuid/{0}'.format(
+                found['juuid'].lower())
+            if os.path.exists(rjournal):
+                found['journal'] = os.path.realpath(rjournal)
+
+        return found
+
+    @classmethod
+    def __clear_dev(cls, dev):
+        if dev.is_disk():
+            if dev.get_disk_label() != _CephPartType.GPT:
+                dev.make_disk_label()
+            else:
+                dev.clear_disk()
+
+            cmd = ['partprobe']
+            cmd.append(dev.dev)
+            _run(cmd)
+
+            _BlockInventory.invalidate()
+        elif dev.is_part():
+            dev.clear_part()
+        elif dev.is_dir():
+            dev.clear_dir()
+
+    @classmethod
+    def __check_fs(cls, fstype):
+        if fstype not in (_CephFsType.EXT4, _CephFsType.XFS, _CephFsType.BTRFS):
+            return False
+
+        return True
+
+    @classmethod
+    def __read_tags(cls, path):
+        '''
+        Read all tags from a mounted OSD filesystem or directory.
+
+        :param path: Location of the OSD filesystem.
+        :return: A dict of tag name -> content, None if not exist.
+        '''
+        tags = {}
+
+        for name in cls.__ONE_LINE_TAGS:
+            tags[name] = _CephOneLineTag(os.path.join(path, name)).read()
+        for name in cls.__MULTI_LINE_TAGS:
+            tags[name] = _CephMultiLineTag(os.path.join(path, name)).read()
+
+        return tags
+
+    @classmethod
+    def __probe_tags(cls, dev, fstype):
+        '''
+        Read all tags from an unmounted OSD filesystem without mounting it.
+
+        :param dev: _CephDev of the OSD data partition.
+        :param fstype: Filesystem type of the partition.
+        :return: A dict of tag name -> content, None if not exist, or None
+        if the filesystem can not be probed.
+        '''
+        names = cls.__ONE_LINE_TAGS + cls.__MULTI_LINE_TAGS
+
+        data = _CephFsProbe(dev, fstype).read(names)
+
+        if data is None:
+            return None
+
+        tags = {}
+
+        try:
+            for name in cls.__ONE_LINE_TAGS:
+                tag = _CephOneLineTag(os.path.join(dev.dev, name))
+                tags[name] = None if data[name] is None \
+                    else tag.decode(data[name])
+            for name in cls.__MULTI_LINE_TAGS:
+                tag = _CephMultiLineTag(os.path.join(dev.dev, name))
+                tags[name] = None if data[name] is None \
+                    else tag.decode(data[name])
+        except AssertionError:
+            # garbage read, let the caller mount it and check
+            return None
+
+        return tags
+
+    @classmethod
+    def __get_state(cls, tags):
+        state = None
+
+        magic = tags['magic']
+        whoami = tags['whoami']
+        ready = tags['ready']
+        active = tags['active']
+
+        if magic is not None:
+            state = _CephOsdState.PREPARED
+        elif whoami is not None:
+            raise AssertionError('corrupted osd filesystem')
+        if whoami is not None:
+            state = _CephOsdState.CREATED
+        elif ready is not None:
+            raise AssertionError('corrupted osd filesystem')
+        if ready is not None:
+            state = _CephOsdState.READY
+        elif active is not None:
+            raise AssertionError('corrupted osd filesystem')
+        if active is not None:
+            state = _CephOsdState.ACTIVE
+
+        return state
+
+    @classmethod
+    def __get_id(cls, tags):
+        whoami = tags['whoami']
+
+        if whoami is None:
+            return None
+
+        try:
+            osdid = int(whoami)
+        except ValueError:
+            raise AssertionError('corrupted whoami: {0}'.format(whoami))
+
+        return osdid
+
+    @classmethod
+    def __get_fsid(cls, tags):
+        return tags['ceph_fsid']
+
+    @classmethod
+    def __get_data_uuid(cls, tags):
+        return tags['fsid']
+
+    @classmethod
+    def __get_journal_uuid(cls, tags):
+        return tags['journal_uuid']
+
+    @classmethod
+    def __read_signature(cls, tags):
+        return tags['signature']
+
+    @classmethod
+    def __write_signature(cls, path, sig):
+        tag = _CephMultiLineTag(os.path.join(path, 'signature'))
+
+        tag.write(sig)
+
+    @classmethod
+    def __remove_signature(cls, path):
+        tag = _CephMultiLineTag(os.path.join(path, 'signature'))
+
+        tag.remove()
+
+    @classmethod
+    def __parse_signature(cls, sig):
+        sig = [x.split('=', 1) for x in sig]
+
+        return dict(sig)
+
+    @classmethod
+    def __get_osd_data(cls, osdid, cfg):
+        # ignore ceph.conf and return osd_data always point to
+        # /var/lib/ceph/osd/$cluster.$id !!!
+        # it's not my fault, blame to ceph-disk :)
+        return '/var/lib/ceph/osd/{cluster}-{id}'\
+            .format(cluster=cfg.cluster, id=osdid)
+
+    @classmethod
+    def __get_fs_type(cls, cfg):
+        fstype = cfg.get_conf('osd_mkfs_type')
+
+        if fstype is None:
+            fstype = cfg.get_conf('osd_fs_type')
+
+        if fstype is None:
+            fstype = DEFAULT_FS_TYPE
+
+        return fstype
+
+    @classmethod
+    def __get_mkfs_options(cls, cfg):
+        fstype = cls.__get_fs_type(cfg)
+
+        options = cfg.get_conf('osd_mkfs_options_{0}'.format(fstype))
+
+        if options is None:
+            options = cfg.get_conf('osd_fs_mkfs_options_{0}'.format(fstype))
+
+        if options is None:
+            options = MKFS_OPTIONS.get(fstype, '')
+
+        return options
+
+    @classmethod
+    def __get_mount_options(cls, cfg):
+        fstype = cls.__get_fs_type(cfg)
+
+        options = cfg.get_conf('osd_mount_options_{0}'.format(fstype))
+
+        if options is None:
+            options = cfg.get_conf('osd_fs_mount_options_{0}'.format(fstype))
+
+        if options is None:
+            options = MOUNT_OPTIONS.get(fstype, '')
+
+        return options
+
+    @classmethod
+    def __unregister(cls, osdid, cfg):
+        name = 'osd.{0}'.format(osdid)
+
+        cmd = ['ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('osd')
+        cmd.append('crush')
+        cmd.append('rm')
+        cmd.append(name)
+
+        _check_run(cmd)
+
+    @classmethod
+    def __remove_crush(cls, osdid, cfg):
+        name = 'osd.{0}'.format(osdid)
+
+        cmd = ['ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('osd')
+        cmd.append('rm')
+        cmd.append(name)
+
+        _check_run(cmd)
+
+    @classmethod
+    def __remove_auth(cls, osdid, cfg):
+        name = 'osd.{0}'.format(osdid)
+
+        cmd = ['ceph']
+        cmd.extend(['--cluster', cfg.cluster])
+        cmd.extend(['--conf', cfg.conf])
+        cmd.append('auth')
+        cmd.append('del')
+        cmd.append(name)
+
+        _check_run(cmd)
+
+    def __signature(self):
+        return ['magic={0}'.format('\xe8\x8e\x8e\xe5\xad\x90'),
+                'version={0}'.format('v1'),
+                'cluster={0}'.format(self.cluster),
+                'fsid={0}'.format(self.fsid),
+                'data={0}'.format(self.data),
+                'journal={0}'.format(self.journal),
+                'dtype={0}'.format(self.dtype),
+                'jtype={0}'.format(self.jtype)]
+
+    def __compare_signature(self, sig):
+        if self.__signature() == sig:
+            return True
+
+        return False
+
+    def __prepare(self):
+        assert self._state == _CephOsdState.FREE
+
+        self.__forget(self.ddev)
+
+        parts_before = None
+        parts_after = None
+
+        diff = None
+        if self.jdev is not None and self.jdev.is_disk():
+            parts_before = self.jdev.get_disk_part_list()
+
+        # prepare
+
+        # ceph-disk does not support --conf
+        # uuid is chosen here so the OSD can be put in CRUSH before the
+        # init script does
+        osd_uuid = str(uuid.uuid4())
+
+        cmd = ['ceph-disk']
+        cmd.append('prepare')
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--osd-uuid', osd_uuid])
+        cmd.append(self.ddev.odev)
+        if self.jdev is not None:
+            cmd.append(self.jdev.odev)
+
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
+
+        # prepared, some checks
+
+        rddev = self.ddev
+
+        if self.ddev.is_disk():
+            rdata = self.ddev.get_disk_part(1)
+            rddev = _CephDev(rdata, _CephDevType.PART)
+
+        if self.jdev is not None and self.jdev.is_disk():
+            parts_after = self.jdev.get_disk_part_list()
+            diff = parts_after - parts_before
+            if len(diff) != 1:
+                raise AssertionError('Disk operation racing with others?')
+
+        # change state
+        self._state = _CephOsdState.PREPARED
+        self.__old_duuid = osd_uuid
+
+    def __crush_location(self, osdid):
+        location = self.cfg.get_conf('osd_crush_location',
+                                     'osd.{0}'.format(osdid))
+        if location:
+            return location.split()
+
+        # the init script default
+        return ['host={0}'.format(socket.gethostname().split('.', 1)[0]),
+                'root=default']
+
+    def __crush_add(self):
+        '''
+        Put a new OSD in CRUSH with the initial weight before activation,
+        the init script then only moves it and the weight is kept.
+        '''
+        if self.initial_weight is None or self.__old_duuid is None:
+            return
+
+        ceph = _CephCluster(self.cluster)
+
+        # ceph-disk activate gets the same id for the uuid
+        osdid = ceph.osd_create(self.__old_duuid)
+
+        # tracked before it is in CRUSH, osd_crush_ramp only ramps those
+        _CephCrushRamp.track(osdid, self.cluster)
+
+        ceph.crush_add(osdid, self.initial_weight,
+                       self.__crush_location(osdid))
+
+    def __activate(self):
+        assert self._state >= _CephOsdState.PREPARED
+
+        if self._state <= _CephOsdState.CREATED:
+            self.__crush_add()
+
+        self.__forget(self.ddev)
+
+        rdata = self.ddev.dev
+
+        if self.ddev.is_disk():
+            rdata = self.ddev.get_disk_part(1)
+
+        # ceph-disk activate does not support both --cluster and --conf
+        cmd = ['ceph-disk']
+        cmd.append('activate')
+        cmd.append(rdata)
+
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
+            _CephHostStatus.invalidate()
+
+    # ### interface ### #
+
+    def wants_journal_part(self):
+        '''
+        Check if a journal partition is to be created on the journal disk
+        when the OSD is managed, detect the OSD if not detected yet.
+
+        :return: True if the OSD is not prepared and its journal is a disk.
+        '''
+        if self._state is None:
+            self.init()
+
+        if self._state != _CephOsdState.FREE:
+            return False
+
+        return self.jdev is not None and self.jdev.is_disk()
+
+    def use_journal_part(self, part):
+        '''
+        Prepare the OSD with a journal partition created beforehand on the
+        journal disk, instead of letting ceph-disk create one.
+
+        :param part: Path of the journal partition.
+        :return: None.
+        '''
+        if not self.wants_journal_part():
+            raise AssertionError('OSD does not want a journal partition')
+
+        self.jdev = _CephDev(part, _CephDevType.PART)
+
+    def identity(self):
+        '''
+        Identity of an active OSD for _CephFingerprint.
+
+        :return: A dict of files, devices and asok, or None if the OSD is not
+                 active or its daemon has no admin socket.
+        '''
+        if self._state != _CephOsdState.ACTIVE:
+            return None
+
+        name = 'osd.{0}'.format(self.__old_id)
+        asok = _CephHostStatus.get(self.cluster).sockets.get(name)
+        if not asok:
+            return None
+
+        if self.dtype == _CephDevType.DIR:
+            osd_data = self.data
+            devices = []
+        else:
+            osd_data = self.__get_osd_data(self.__old_id, self.cfg)
+            devices = [self.data]
+
+        files = [os.path.join(osd_data, x)
+                 for x in ('whoami', 'fsid', 'ready', 'active')]
+
+        if self.journal:
+            if self.jtype == _CephDevType.FILE:
+                files.append(self.journal)
+            else:
+                devices.append(self.journal)
+
+        return {'files': files, 'devices': devices, 'asok': asok}
+
+    def init(self):
+        assert self._state is None
+
+        detected = self.__detect_osd(self.ddev)
+        if detected is None:
+            raise RuntimeError('OSD on: {0} can not be detected'.format(
+                self.data))
+
+        (state, osdid, fsid, duuid, juuid, fstype, signature) = detected
+
+        self.__old_id = osdid
+        self.__old_fsid = fsid
+        self.__old_duuid = duuid
+        self.__old_juuid = juuid
+        self.__old_fstype = fstype
+        self.__old_signature = signature
+
+        self._state = state or _CephOsdState.FREE
+
+    @_traced('_CephOsd.prepare')
+    def prepare(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) prepared'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        datachanges = []
+        journalchanges = []
+
+        # detect existing OSD
+        self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            # TODO: Umount or warn user if device is mounted
+            self.__clear_dev(self.ddev)
+            datachanges.append('Clear data device')
+
+            if self.jdev is not None and self.jdev.is_disk():
+                if self.jdev.get_disk_label() != _CephPartType.GPT:
+                    self.jdev.make_disk_label()
+                    journalchanges.append('Make gpt label')
+
+            self.__prepare()
+            datachanges.append('Prepare device')
+
+            changes[self.data] = datachanges
+            if journalchanges:
+                changes[self.journal] = journalchanges
+
+            return ret
+
+        ret['comment'] = 'OSD: ({d}, {j}) is prepared, skip'\
+            .format(d=self.data, j=self.journal)
+
+        return ret
+
+    @_traced('_CephOsd.activate')
+    def activate(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) activated'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        datachanges = []
+
+        # detect existing OSD
+        self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            return _error(ret, 'OSD: ({d}, {j}) is not prepared, skip'
+                          .format(d=self.data, j=self.journal))
+
+        # check if ever been activated
+
+        state = self._state
+
+        if state == _CephOsdState.PREPARED:
+            self.__activate()
+
+            if self.initial_weight is not None:
+                datachanges.append('Add to CRUSH with weight: {0}'.format(
+                    self.initial_weight))
+
+            datachanges.append('Create OSD entity')
+            datachanges.append('Make OSD filesystem')
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.CREATED:
+            self.__activate()
+
+            if self.initial_weight is not None:
+                datachanges.append('Add to CRUSH with weight: {0}'.format(
+                    self.initial_weight))
+
+            datachanges.append('Make OSD filesystem')
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.READY:
+            self.__activate()
+
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.ACTIVE:
+            daemon = _CephOsdDaemon(self.__old_id, self.cluster)
+            if daemon.is_running():
+                ret['comment'] = 'OSD: ({d}, {j}) is already activated, skip'\
+                                 .format(d=self.data, j=self.journal)
+
+                return ret
+
+            self.__activate()
+
+            datachanges.append('Start OSD daemon')
+
+        changes[self.data] = datachanges
+
+        return ret
+
+    @_traced('_CephOsd.manage')
+    def manage(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) managed'.format(d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        datachanges = []
+        journalchanges = []
+
+        # detect existing OSD, unless already detected by the journal planner
+        if self._state is None:
+            self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            # TODO: Umount or warn user if device is mounted
+            self.__clear_dev(self.ddev)
+            datachanges.append('Clear data device')
+
+            if self.jdev is not None and self.jdev.is_disk():
+                if self.jdev.get_disk_label() != _CephPartType.GPT:
+                    self.jdev.make_disk_label()
+                    journalchanges.append('Make gpt label')
+
+            self.__prepare()
+            datachanges.append('Prepare device')
+        
+        # new prepared device or has been prepared device
+
+        # check if ever been activated
+
+        state = self._state
+
+        if state == _CephOsdState.PREPARED:
+            self.__activate()
+
+            if self.initial_weight is not None:
+                datachanges.append('Add to CRUSH with weight: {0}'.format(
+                    self.initial_weight))
+
+            datachanges.append('Create OSD entity')
+            datachanges.append('Make OSD filesystem')
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.CREATED:
+            self.__activate()
+
+            if self.initial_weight is not None:
+                datachanges.append('Add to CRUSH with weight: {0}'.format(
+                    self.initial_weight))
+
+            datachanges.append('Make OSD filesystem')
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.READY:
+            self.__activate()
+
+            datachanges.append('Authenticate OSD entity')
+            datachanges.append('Start OSD daemon')
+        elif state == _CephOsdState.ACTIVE:
+            daemon = _CephOsdDaemon(self.__old_id, self.cluster)
+            if daemon.is_running():
+                ret['comment'] = 'OSD: ({d}, {j}) already managed, skip'\
+                                 .format(d=self.data, j=self.journal)
+
+                return ret
+
+            self.__activate()
+
+            datachanges.append('Start OSD daemon')
+
+        changes[self.data] = datachanges
+
+        return ret
+
+    @_traced('_CephOsd.unprepare')
+    def unprepare(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) unprepared'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        datachanges = []
+        journalchanges = []
+
+        # detect existing OSD
+        self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
+                .format(d=self.data, j=self.journal)
+
+            return ret
+
+        if self._state > _CephOsdState.PREPARED:
+            return _error(ret, 'OSD: ({d}, {j}) is activated, skip'
+                          .format(d=self.data, j=self.journal))
+
+        self.__forget(self.ddev)
+
+        if self.jdev is not None and self.jdev.is_disk():
+            if self.__old_juuid is None:
+                raise AssertionError('corrupted osd filesystem')
+
+            # journal device is created from another disk
+            rjournal = '/dev/disk/by-partuuid/{0}'.format(self.__old_juuid)
+            rjdev = _CephDev(rjournal, _CephDevType.PART)
+
+            journal = rjdev.get_part_disk()
+            num = rjdev.get_part_num()
+
+            jdev = _CephDev(journal, _CephDevType.DISK)
+            jdev.remove_disk_part(num)
+
+            cmd = ['partprobe']
+            cmd.append(self.jdev.dev)
+            _run(cmd)
+
+            _BlockInventory.invalidate()
+
+            journalchanges.append('Remove partition')
+
+        self.__clear_dev(self.ddev)
+
+        datachanges.append('Destroy device')
+
+        if journalchanges:
+            changes[self.journal] = journalchanges
+        changes[self.data] = datachanges
+
+        return ret
+
+    @_traced('_CephOsd.deactivate')
+    def deactivate(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) deactivated'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        daemonchanges = []
+
+        # detect existing OSD
+        self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
+                .format(d=self.data, j=self.journal)
+
+            return ret
+
+        if self._state == _CephOsdState.PREPARED:
+            # not activated
+            ret['comment'] = 'OSD: ({d}, {j}) is not activated, skip'\
+                .format(d=self.data, j=self.journal)
+
+            return ret
+
+        self.__forget(self.ddev)
+
+        osdid = self.__old_id
+        fstype = self.__old_fstype
+
+        rddev = None
+
+        if self.ddev.is_disk():
+            rdata = self.ddev.get_disk_part(1)
+            rddev = _CephDev(rdata, _CephDevType.PART)
+        elif self.ddev.is_part():
+            rddev = self.ddev
+
+        mount = False   # data device mounted by us manually
+        path = ''       # location of OSD fs
+
+        try:
+            if self.ddev.is_disk() or self.ddev.is_part():
+                (path, _, _) = rddev.get_mount_info()
+
+                if path is None:
+                    # not mounted, mount to a tmp location manually
+                    path = rddev.mount_tmp(fstype)
+                    mount = True
+            else:
+                # data device is a directory
+                path = self.ddev.dev
+
+            state = self._state
+
+            if state == _CephOsdState.ACTIVE:
+                daemon = _CephOsdDaemon(osdid, self.cluster)
+                if daemon.is_running():
+                    daemon.stop()
+
+                    daemonchanges.append('Stop OSD daemon')
+
+                self.__remove_auth(osdid, self.cfg)
+                self.__remove_crush(osdid, self.cfg)
+
+                tag = _CephOneLineTag(os.path.join(path, 'active'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD authentication')
+
+                state = _CephOsdState.READY
+            if state == _CephOsdState.READY:
+                shutil.rmtree(os.path.join(path, 'current'))
+                os.remove(os.path.join(path, 'superblock'))
+                os.remove(os.path.join(path, 'store_version'))
+
+                tag = _CephOneLineTag(os.path.join(path, 'ready'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD filesystem')
+
+                state = _CephOsdState.CREATED
+            if state == _CephOsdState.CREATED:
+                self.__unregister(osdid, self.cfg)
+
+                tag = _CephOneLineTag(os.path.join(path, 'whoami'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD entity')
+
+                state = _CephOsdState.PREPARED
+
+            self._state = state
+        finally:
+            if self.ddev.is_disk() or self.ddev.is_part():
+                rddev.umount(umount_all=True)
+                os.rmdir(path)
+
+        changes['osd.{0}'.format(osdid)] = daemonchanges
+
+        return ret
+
+    @_traced('_CephOsd.unmanage')
+    def unmanage(self):
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) unmanaged'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        changes = ret['changes']
+        datachanges = []
+        journalchanges = []
+        daemonchanges = []
+
+        # detect existing OSD
+        self.init()
+
+        if self._state == _CephOsdState.FREE:
+            # not prepared
+            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
+                .format(d=self.data, j=self.journal)
+
+            return ret
+
+        self.__forget(self.ddev)
+
+        osdid = self.__old_id
+        fstype = self.__old_fstype
+
+        rddev = None
+
+        if self.ddev.is_disk():
+            rdata = self.ddev.get_disk_part(1)
+            rddev = _CephDev(rdata, _CephDevType.PART)
+        elif self.ddev.is_part():
+            rddev = self.ddev
+
+        mount = False   # data device mounted by us manually
+        path = ''       # location of OSD fs
+
+        try:
+            if self.ddev.is_disk() or self.ddev.is_part():
+                (path, _, _) = rddev.get_mount_info()
+
+                if path is None:
+                    # not mounted, mount to a tmp location manually
+                    path = rddev.mount_tmp(fstype)
+                    mount = True
+            else:
+                # data device is a directory
+                path = self.ddev.dev
+
+            state = self._state
+
+            if state == _CephOsdState.ACTIVE:
+                daemon = _CephOsdDaemon(osdid, self.cluster)
+                if daemon.is_running():
+                    daemon.stop()
+
+                    daemonchanges.append('Stop OSD daemon')
+
+                self.__remove_auth(osdid, self.cfg)
+                self.__remove_crush(osdid, self.cfg)
+
+                tag = _CephOneLineTag(os.path.join(path, 'active'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD authentication')
+
+                state = _CephOsdState.READY
+            if state == _CephOsdState.READY:
+                tag = _CephOneLineTag(os.path.join(path, 'ready'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD filesystem')
+
+                state = _CephOsdState.CREATED
+            if state == _CephOsdState.CREATED:
+                self.__unregister(osdid, self.cfg)
+
+                tag = _CephOneLineTag(os.path.join(path, 'whoami'))
+                tag.remove()
+
+                daemonchanges.append('Remove OSD entity')
+
+                state = _CephOsdState.PREPARED
+            if state == _CephOsdState.PREPARED:
+                if self.jdev is not None and self.jdev.is_disk():
+                    if self.__old_juuid is None:
+                        raise AssertionError('corrupted osd filesystem')
+
+                    # journal device is created from another disk
+                    rjournal = '/dev/disk/by-partuuid/{0}'.format(self.__old_juuid)
+                    rjdev = _CephDev(rjournal, _CephDevType.PART)
+
+                    journal = rjdev.get_part_disk()
+                    num = rjdev.get_part_num()
+
+                    jdev = _CephDev(journal, _CephDevType.DISK)
+                    jdev.remove_disk_part(num)
+
+                    cmd = ['partprobe']
+                    cmd.append(self.jdev.dev)
+                    _run(cmd)
+
+                    _BlockInventory.invalidate()
+
+                    journalchanges.append('Remove partition')
+
+                self.__clear_dev(self.ddev)
+
+                datachanges.append('Destroy device')
+
+            self._state = state
+        finally:
+            if self.ddev.is_disk() or self.ddev.is_part():
+                rddev.umount(umount_all=True)
+                os.rmdir(path)
+
+        if datachanges:
+            changes[self.data] = datachanges
+        if journalchanges:
+            changes[self.journal] = journalchanges
+        if daemonchanges:
+            changes['osd.{0}'.format(osdid)] = daemonchanges
+
+        return ret
+
+    def takeover(self):
+        pass
+
+    @_traced('_CephOsd.zap')
+    def zap(self):
+        '''
+        Destroy whatever is on the data device, the journal is left alone,
+        the OSD must have been removed from the cluster.
+        '''
+        ret = {
+            'name': self.data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) zapped'.format(
+                d=self.data, j=self.journal),
+            'changes': {}
+        }
+
+        self.__forget(self.ddev)
+        self.__clear_dev(self.ddev)
+
+        self._state = None
+
+        ret['changes'][self.data] = ['Destroy device']
+
+        return ret
+
+
+@_traced('osd_prepare')
+def osd_prepare(data,
+                journal='',
+                cluster=CEPH_CLUSTER):
+    osd = _CephOsd(data, journal, cluster)
+
+    return osd.prepare()
+
+
+@_traced('osd_activate')
+def osd_activate(data,
+                 journal='',
+                 cluster=CEPH_CLUSTER,
+                 initial_weight=None):
+    osd = _CephOsd(data, journal, cluster, initial_weight)
+
+    return osd.activate()
+
+
+@_traced('osd_manage')
+def osd_manage(data,
+               journal='',
+               cluster=CEPH_CLUSTER,
+               initial_weight=None):
+    '''
+    Manage an OSD, i.e. prepare and activate it as needed.
+
+    :param data: Data device.
+    :param journal: Journal device, or '' to put the journal on data.
+    :param cluster: Cluster name.
+    :param initial_weight: CRUSH weight of a new OSD, e.g. 0 to bring it in
+    later by osd_crush_ramp, default is the init script's choice.
+    :return: Salt state return.
+    '''
+    journal = journal or ''
+
+    fp = _CephFingerprint('osd_manage', data, cluster, journal=journal)
+    if fp.check():
+        return {
+            'name': data,
+            'result': True,
+            'comment': 'OSD: ({d}, {j}) already managed, skip'.format(
+                d=data, j=journal),
+            'changes': {}
+        }
+
+    osd = _CephOsd(data, journal, cluster, initial_weight)
+
+    ret = osd.manage()
+    fp.update(ret, osd.identity)
+
+    return ret
+
+
+@_traced('osd_unprepare')
+def osd_unprepare(data,
+                  journal='',
+                  cluster=CEPH_CLUSTER):
+    _CephFingerprint('osd_manage', data, cluster).clear()
+
+    osd = _CephOsd(data, journal, cluster)
+
+    return osd.unprepare()
+
+
+@_traced('osd_deactivate')
+def osd_deactivate(data,
+                   journal='',
+                   cluster=CEPH_CLUSTER):
+    _CephFingerprint('osd_manage', data, cluster).clear()
+
+    osd = _CephOsd(data, journal, cluster)
+
+    return osd.deactivate()
+
+
+@_traced('osd_unmanage')
+def osd_unmanage(data,
+                 journal='',
+                 cluster=CEPH_CLUSTER):
+    _CephFingerprint('osd_manage', data, cluster).clear()
+
+    osd = _CephOsd(data, journal, cluster)
+
+    return osd.unmanage()
+
+
+@_traced('osd_status', record=False)
+def osd_status(cluster=CEPH_CLUSTER, cross_check=False):
+    '''
+    Get status of OSDs on this host in one pass, liveness is checked by
+    connecting to their admin sockets directly instead of forking the ceph
+    CLI per OSD.
+
+    :param cluster: Cluster name.
+    :param cross_check: Also get up and in of the OSDs from the OSD map by
+    one 'ceph osd dump'.
+    :return: A dict of OSD name -> dict of running, and up, in if cross
+    checked, up and in are None if the OSD is not in the OSD map.
+    '''
+    cfg = _CephConf(cluster)
+    status = _CephHostStatus.get(cfg.cluster)
+
+    names = set(status.daemons('osd'))
+
+    # OSDs not running may have no admin socket left, find their data
+    # directories by osd_data of a made-up OSD, e.g. /var/lib/ceph/osd/ceph-$id
+    marker = 'ID'
+    osd_data = cfg.get_conf('osd_data', 'osd.{0}'.format(marker)) or ''
+    (head, found, suffix) = osd_data.rpartition(marker)
+    (pdir, prefix) = os.path.split(head)
+    if found and '/' not in suffix and os.path.isdir(pdir):
+        for fname in os.listdir(pdir):
+            osdid = fname[len(prefix):len(fname) - len(suffix)]
+            if fname.startswith(prefix) and fname.endswith(suffix) \
+                    and osdid.isdigit():
+                names.add('osd.{0}'.format(osdid))
+
+    ret = {}
+    for name in names:
+        ret[name] = {'running': bool(status.status(name))}
+
+    if cross_check:
+        osds = _CephCluster(cfg.cluster).osd_dump()
+
+        for name, entry in ret.iteritems():
+            try:
+                (up, _in) = osds[int(name.split('.', 1)[1])]
+            except (KeyError, ValueError):
+                (up, _in) = (None, None)
+            entry['up'] = up
+            entry['in'] = _in
+
+    return ret
+
+
+class _CephOsdRolling(object):
+    '''
+    Restart OSDs on this host a few at a time, the cluster has to be back
+    to active+clean before the next ones go down, noout is held during the
+    whole run so nothing is remapped meanwhile.
+    '''
+    def __init__(self,
+                 cluster=CEPH_CLUSTER,
+                 parallel=1,
+                 timeout=OSD_ROLLING_TIMEOUT,
+                 interval=OSD_ROLLING_INTERVAL):
+        '''
+        Init _CephOsdRolling object.
+
+        :param cluster: Cluster name.
+        :param parallel: Number of OSDs restarted at a time.
+        :param timeout: Max seconds to wait for each step to become healthy.
+        :param interval: Seconds between health polls.
+        '''
+        super(_CephOsdRolling, self).__init__()
+
+        if parallel < 1:
+            raise ValueError('Invalid parallel: {0}'.format(parallel))
+
+        cfg = _CephConf(cluster)
+
+        self.cluster = cfg.cluster
+        self.cfg = cfg
+        self.parallel = parallel
+        self.timeout = timeout
+        self.interval = interval
+        self.ceph = _CephCluster(cluster)
+
+    def __wait(self, what, check):
+        deadline = time.time() + self.timeout
+
+        while not check():
+            if time.time() >= deadline:
+                raise RuntimeError('Timed out after {0}s waiting for {1}'
+                                   .format(self.timeout, what))
+            time.sleep(self.interval)
+
+    def __wait_up(self, up_from):
+        # an OSD is back once it booted again, i.e. up with a newer up_from,
+        # it may still be up in the map from before the restart
+        def check():
+            (_, osds) = self.ceph.osd_map()
+            for osdid, epoch in up_from.iteritems():
+                osd = osds.get(osdid, {})
+                if not osd.get('up') or osd.get('up_from', 0) <= epoch:
+                    return False
+            return True
+
+        self.__wait('osd(s) {0} up'.format(
+            ', '.join(str(x) for x in sorted(up_from))), check)
+
+    def __wait_clean(self):
+        self.__wait('PGs active+clean', self.ceph.is_clean)
+
+    def restart(self, osdids, restarted=None):
+        '''
+        Restart OSDs step by step.
+
+        :param osdids: OSD ids to restart.
+        :param restarted: A list the ids are appended to as they come back,
+        so callers know what is done if a step fails.
+        :return: None.
+        '''
+        if restarted is None:
+            restarted = []
+
+        (flags, _) = self.ceph.osd_map()
+
+        # leave noout alone if someone else set it
+        noout = 'noout' not in flags
+        if noout:
+            self.ceph.set_flag('noout')
+
+        try:
+            # never take OSDs down on a degraded cluster
+            self.__wait_clean()
+
+            osdids = sorted(osdids)
+            for i in xrange(0, len(osdids), self.parallel):
+                step = osdids[i:i + self.parallel]
+
+                (_, osds) = self.ceph.osd_map()
+                up_from = dict((x, osds.get(x, {}).get('up_from', 0))
+                               for x in step)
+
+                for osdid in step:
+                    _CephDaemon('osd', osdid, self.cluster).restart()
+
+                self.__wait_up(up_from)
+                self.__wait_clean()
+
+                restarted.extend(step)
+        finally:
+            if noout:
+                self.ceph.unset_flag('noout')
+
+
+@_traced('osd_rolling_restart')
+def osd_rolling_restart(osds=None,
+                        cluster=CEPH_CLUSTER,
+                        parallel=1,
+                        timeout=OSD_ROLLING_TIMEOUT):
+    '''
+    Restart OSDs on this host without degrading the cluster, parallel OSDs
+    at a time, each step waits for the restarted OSDs to be up and all PGs
+    to be active+clean. noout is set during the restart.
+
+    Run on OSD hosts one by one to roll out a change to the whole cluster,
+    e.g. salt -b 1 -G 'roles:ceph-osd' ceph_deploy.osd_rolling_restart
+
+    :param osds: OSD ids to restart, default is all OSDs running on this
+    host.
+    :param cluster: Cluster name.
+    :param parallel: Number of OSDs restarted at a time.
+    :param timeout: Max seconds to wait for each step to become healthy.
+    :return: Salt state return with the OSDs restarted.
+    '''
+    ret = {
+        'name': cluster,
+        'result': True,
+        'comment': '',
+        'changes': {}
+    }
+
+    if osds is None:
+        status = _CephHostStatus.get(_CephConf(cluster).cluster)
+        osds = [int(name.split('.', 1)[1]) for name in status.daemons('osd')
+                if status.status(name)]
+    else:
+        osds = [int(x) for x in osds]
+
+    if not osds:
+        ret['comment'] = 'No OSD to restart'
+        return ret
+
+    restarted = []
+
+    try:
+        _CephOsdRolling(cluster, int(parallel), timeout).restart(
+            osds, restarted)
+    except Exception as e:
+        _error(ret, 'Rolling restart failed: {0}'.format(e))
+    else:
+        ret['comment'] = '{0} OSD(s) restarted'.format(len(restarted))
+
+    if restarted:
+        ret['changes']['restarted'] = ['osd.{0}'.format(x)
+                                       for x in restarted]
+
+    return ret
+
+
+class _CephMaintenance(object):
+    '''
+    Maintenance window around a batch of OSD changes, e.g.
+
+        with _CephMaintenance(cluster, MAINTENANCE_ADD_FLAGS):
+            # add OSDs
+
+    Cluster flags are set and recovery is throttled on enter, all changes
+    made meanwhile are peered but data is moved once the flags are released
+    on exit, in one remap instead of one per OSD. The throttle is kept until
+    PGs are active+clean again or settle_timeout passes, so the remap runs
+    throttled. Flags set by someone else are left alone, and everything is
+    restored even if the batch fails.
+    '''
+    def __init__(self,
+                 cluster=CEPH_CLUSTER,
+                 flags=None,
+                 throttle=None,
+                 settle_timeout=MAINTENANCE_SETTLE_TIMEOUT,
+                 interval=MAINTENANCE_SETTLE_INTERVAL):
+        '''
+        Init _CephMaintenance object.
+
+        :param cluster: Cluster name.
+        :param flags: Cluster flags to hold, e.g. ['noout'].
+        :param throttle: A dict of OSD option key -> value to inject, values
+        in ceph.conf are injected back on exit, default is
+        MAINTENANCE_THROTTLE.
+        :param settle_timeout: Max seconds to keep the throttle after the
+        flags are released, waiting for PGs active+clean, 0 restores it at
+        once.
+        :param interval: Seconds between health polls.
+        '''
+        super(_CephMaintenance, self).__init__()
+
+        cfg = _CephConf(cluster)
+
+        self.cluster = cfg.cluster
+        self.cfg = cfg
+        self.flags = list(flags or [])
+        self.throttle = dict(MAINTENANCE_THROTTLE if throttle is None
+                             else throttle)
+        self.settle_timeout = settle_timeout
+        self.interval = interval
+        self.ceph = _CephCluster(cluster)
+
+        self.held = []      # flags set by us
+
+    def __enter__(self):
+        (flags, _) = self.ceph.osd_map()
+
+        try:
+            for flag in self.flags:
+                if flag in flags:
+                    continue
+                try:
+                    self.ceph.set_flag(flag)
+                except RuntimeError:
+                    # not supported by this ceph release
+                    continue
+                self.held.append(flag)
+
+            if self.throttle:
+                self.ceph.inject_osds(self.throttle)
+        except:
+            self.__restore(settle=False)
+            raise
+
+        return self
+
+    def __exit__(self, etype, value, tb):
+        try:
+            self.__restore()
+        except Exception:
+            # do not hide the failure of the batch
+            if etype is None:
+                raise
+
+        return False
+
+    def __settle(self):
+        # the remap starts as the flags are released, throttled until done
+        deadline = time.time() + self.settle_timeout
+
+        while not self.ceph.is_clean():
+            if time.time() >= deadline:
+                break
+            time.sleep(self.interval)
+
+    def __restore(self, settle=True):
+        errors = []
+
+        released = bool(self.held)
+
+        while self.held:
+            flag = self.held.pop()
+            try:
+                self.ceph.unset_flag(flag)
+            except Exception as e:
+                errors.append(e)
+
+        if self.throttle:
+            if settle and released and self.settle_timeout > 0:
+                try:
+                    self.__settle()
+                except Exception as e:
+                    errors.append(e)
+
+            # osd.* has no section of its own, i.e. values of [osd], [global]
+            # or compiled-in defaults
+            keys = [_CephConf.normalize_key(x) for x in self.throttle]
+            values = dict((key, val) for key, val in
+                          self.cfg.get_confs(keys, 'osd.*').iteritems()
+                          if val is not None)
+            if values:
+                try:
+                    self.ceph.inject_osds(values)
+                except Exception as e:
+                    errors.append(e)
+
+        if errors:
+            raise RuntimeError('Maintenance not fully restored', errors)
+
+
+class _CephCrushRamp(object):
+    '''
+    Raise CRUSH weights of OSDs to their targets step by step, a step is
+    taken only when few PGs are recovering, so data is moved to new OSDs at
+    a pace the cluster can take along with client I/O.
+
+    OSDs put in CRUSH with an initial weight by us are tracked in RAMP_FILE
+    until they reach full weight, weights of other OSDs, e.g. set by an
+    operator, are never touched unless asked for.
+    '''
+    _lock = threading.Lock()
+
+    def __init__(self,
+                 cluster=CEPH_CLUSTER,
+                 step=CRUSH_RAMP_STEP,
+                 max_recovering=CRUSH_RAMP_MAX_RECOVERING,
+                 interval=CRUSH_RAMP_INTERVAL,
+                 timeout=CRUSH_RAMP_TIMEOUT):
+        '''
+        Init _CephCrushRamp object.
 
-        return dict(sig)
+        :param cluster: Cluster name.
+        :param step: Weight added per step, as a fraction of the target.
+        :param max_recovering: Max PGs recovering to take a step.
+        :param interval: Seconds between load polls.
+        :param timeout: Max seconds to wait for the load to drop per step.
+        '''
+        super(_CephCrushRamp, self).__init__()
 
-    @classmethod
-    def __get_osd_data(cls, osdid, cfg):
-        # ignore ceph.conf and return osd_data always point to
-        # /var/lib/ceph/osd/$cluster.$id !!!
-        # it's not my fault, blame to ceph-disk :)
-        return '/var/lib/ceph/osd/{cluster}-{id}'\
-            .format(cluster=cfg.cluster, id=osdid)
+        if not 0 < step <= 1:
+            raise ValueError('Invalid step: {0}'.format(step))
 
-    @classmethod
-    def __get_fs_type(cls, cfg):
-        fstype = cfg.get_conf('osd_mkfs_type')
+        cfg = _CephConf(cluster)
 
-        if fstype is None:
-            fstype = cfg.get_conf('osd_fs_type')
+        self.cluster = cfg.cluster
+        self.cfg = cfg
+        self.step = step
+        self.max_recovering = max_recovering
+        self.interval = interval
+        self.timeout = timeout
+        self.ceph = _CephCluster(cluster)
 
-        if fstype is None:
-            fstype = DEFAULT_FS_TYPE
+    @classmethod
+    def __load(cls):
+        try:
+            with open(RAMP_FILE, 'rb') as fobj:
+                tracked = json.load(fobj)
+        except (IOError, ValueError):
+            return {}
 
-        return fstype
+        return tracked if isinstance(tracked, dict) else {}
 
     @classmethod
-    def __get_mkfs_options(cls, cfg):
-        fstype = cls.__get_fs_type(cfg)
+    def __update(cls, cluster, add=(), remove=()):
+        pdir = os.path.dirname(RAMP_FILE)
 
-        options = cfg.get_conf('osd_mkfs_options_{0}'.format(fstype))
+        with cls._lock:
+            tracked = cls.__load()
 
-        if options is None:
-            options = cfg.get_conf('osd_fs_mkfs_options_{0}'.format(fstype))
+            osdids = set(tracked.get(cluster, []))
+            osdids |= set(add)
+            osdids -= set(remove)
+            tracked[cluster] = sorted(osdids)
 
-        if options is None:
-            options = MKFS_OPTIONS.get(fstype, '')
+            if not os.path.exists(pdir):
+                os.makedirs(pdir, 0700)
 
-        return options
+            (fd, path) = tempfile.mkstemp(prefix='ramp.', dir=pdir)
+            with os.fdopen(fd, 'wb') as fobj:
+                json.dump(tracked, fobj)
+            os.rename(path, RAMP_FILE)
 
     @classmethod
-    def __get_mount_options(cls, cfg):
-        fstype = cls.__get_fs_type(cfg)
-
-        options = cfg.get_conf('osd_mount_options_{0}'.format(fstype))
+    def track(cls, osdid, cluster=CEPH_CLUSTER):
+        '''
+        Track an OSD put in CRUSH with an initial weight, to be ramped up.
 
-        if options is None:
-            options = cfg.get_conf('osd_fs_mount_options_{0}'.format(fstype))
+        :param osdid: OSD id.
+        :param cluster: Cluster name.
+        :return: None.
+        '''
+        cls.__update(_CephConf(cluster).cluster, add=[int(osdid)])
 
-        if options is None:
-            options = MOUNT_OPTIONS.get(fstype, '')
+    @classmethod
+    def forget(cls, osdids, cluster=CEPH_CLUSTER):
+        '''
+        Stop tracking OSDs, e.g. at full weight or removed.
 
-        return options
+        :param osdids: OSD ids.
+        :param cluster: Cluster name.
+        :return: None.
+        '''
+        cls.__update(_CephConf(cluster).cluster,
+                     remove=[int(x) for x in osdids])
 
     @classmethod
-    def __unregister(cls, osdid, cfg):
-        name = 'osd.{0}'.format(osdid)
-
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('osd')
-        cmd.append('crush')
-        cmd.append('rm')
-        cmd.append(name)
+    def tracked(cls, cluster=CEPH_CLUSTER):
+        '''
+        Get OSDs tracked to be ramped up.
 
-        _check_run(cmd)
+        :param cluster: Cluster name.
+        :return: A list of OSD ids.
+        '''
+        return list(cls.__load().get(_CephConf(cluster).cluster, []))
 
     @classmethod
-    def __remove_crush(cls, osdid, cfg):
-        name = 'osd.{0}'.format(osdid)
+    def target_weight(cls, osdid, cluster=CEPH_CLUSTER):
+        '''
+        Get the weight an OSD on this host has at full capacity, i.e. size of
+        its filesystem in TiB with 2 decimals, as the init script weighs new
+        OSDs.
 
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('osd')
-        cmd.append('rm')
-        cmd.append(name)
+        :param osdid: OSD id.
+        :param cluster: Cluster name.
+        :return: Weight, None if the OSD data is not mounted here.
+        '''
+        path = _CephConf(cluster).get_conf('osd_data',
+                                           'osd.{0}'.format(osdid))
+        if not path:
+            return None
 
-        _check_run(cmd)
+        try:
+            st = os.statvfs(path)
+        except OSError:
+            return None
 
-    @classmethod
-    def __remove_auth(cls, osdid, cfg):
-        name = 'osd.{0}'.format(osdid)
+        return round(float(st.f_blocks * st.f_frsize) / (1 << 40), 2)
 
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(cfg.cluster))
-        cmd.append('--conf {0}'.format(cfg.conf))
-        cmd.append('auth')
-        cmd.append('del')
-        cmd.append(name)
+    def __wait_load(self):
+        deadline = time.time() + self.timeout
 
-        _check_run(cmd)
+        while self.ceph.recovering() > self.max_recovering:
+            if time.time() >= deadline:
+                raise RuntimeError('Timed out after {0}s waiting for recovery '
+                                   'to settle'.format(self.timeout))
+            time.sleep(self.interval)
 
-    def __signature(self):
-        return ['magic={0}'.format('\xe8\x8e\x8e\xe5\xad\x90'),
-                'version={0}'.format('v1'),
-                'cluster={0}'.format(self.cluster),
-                'fsid={0}'.format(self.fsid),
-                'data={0}'.format(self.data),
-                'journal={0}'.format(self.journal),
-                'dtype={0}'.format(self.dtype),
-                'jtype={0}'.format(self.jtype)]
+    def ramp(self, targets, changes=None):
+        '''
+        Ramp OSDs up to their target weights, all OSDs take a step together,
+        tracked OSDs are forgotten once at full weight or out of CRUSH.
 
-    def __compare_signature(self, sig):
-        if self.__signature() == sig:
-            return True
+        :param targets: A dict of osd id -> target weight.
+        :param changes: A dict the weights set are recorded to, osd name ->
+        'old -> new', so callers know what is done if a step fails.
+        :return: None.
+        '''
+        if changes is None:
+            changes = {}
 
-        return False
+        while True:
+            weights = self.ceph.crush_weights()
 
-    def __prepare(self):
-        assert self._state == _CephOsdState.FREE
+            pending = dict((osdid, target)
+                           for osdid, target in targets.iteritems()
+                           if osdid in weights and weights[osdid] < target)
 
-        parts_before = None
-        parts_after = None
+            done = set(targets) - set(pending)
+            if done:
+                self.forget(done, self.cluster)
 
-        diff = None
-        if self.jdev is not None and self.jdev.is_disk():
-            parts_before = self.jdev.get_disk_part_list()
+            if not pending:
+                break
 
-        # prepare
+            self.__wait_load()
 
-        # ceph-disk does not support --conf
-        cmd = ['ceph-disk']
-        cmd.append('prepare')
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append(self.ddev.odev)
-        if self.jdev is not None:
-            cmd.append(self.jdev.odev)
+            for osdid, target in sorted(pending.iteritems()):
+                weight = round(min(target,
+                                   weights[osdid] + target * self.step), 4)
+                self.ceph.crush_reweight(osdid, weight)
 
-        _check_run(cmd)
+                name = 'osd.{0}'.format(osdid)
+                old = changes.get(name, '{0} -> '.format(weights[osdid]))
+                changes[name] = '{0} -> {1}'.format(
+                    old.split(' -> ', 1)[0], weight)
 
-        # prepared, some checks
+            # let peering start before the load is polled again
+            time.sleep(self.interval)
 
-        rddev = self.ddev
 
-        if self.ddev.is_disk():
-            rdata = self.ddev.get_disk_part(1)
-            rddev = _CephDev(rdata, _CephDevType.PART)
+@_traced('osd_crush_ramp')
+def osd_crush_ramp(osds=None,
+                   cluster=CEPH_CLUSTER,
+                   step=CRUSH_RAMP_STEP,
+                   max_recovering=CRUSH_RAMP_MAX_RECOVERING,
+                   timeout=CRUSH_RAMP_TIMEOUT):
+    '''
+    Raise CRUSH weights of OSDs on this host to their full capacity step by
+    step, e.g. OSDs activated with initial_weight 0. A step is taken only
+    when at most max_recovering PGs are recovering or backfilling.
+
+    :param osds: OSD ids to ramp up, default is OSDs on this host activated
+    with initial_weight and not yet at full weight, weights set otherwise
+    are left alone.
+    :param cluster: Cluster name.
+    :param step: Weight added per step, as a fraction of the target.
+    :param max_recovering: Max PGs recovering to take a step.
+    :param timeout: Max seconds to wait for the load to drop per step.
+    :return: Salt state return with the weights changed.
+    '''
+    ret = {
+        'name': cluster,
+        'result': True,
+        'comment': 'CRUSH weights at full capacity',
+        'changes': {}
+    }
 
-        if self.jdev is not None and self.jdev.is_disk():
-            parts_after = self.jdev.get_disk_part_list()
-            diff = parts_after - parts_before
-            if len(diff) != 1:
-                raise AssertionError('Disk operation racing with others?')
+    cfg = _CephConf(cluster)
 
-        # change state
-        self._state = _CephOsdState.PREPARED
+    if osds is None:
+        osds = _CephCrushRamp.tracked(cfg.cluster)
+    else:
+        osds = [int(x) for x in osds]
 
-    def __activate(self):
-        assert self._state >= _CephOsdState.PREPARED
+    targets = {}
+    for osdid in osds:
+        target = _CephCrushRamp.target_weight(osdid, cfg.cluster)
+        if target is not None:
+            targets[osdid] = target
 
-        rdata = self.ddev.dev
+    if not targets:
+        ret['comment'] = 'No OSD to ramp up'
+        return ret
 
-        if self.ddev.is_disk():
-            rdata = self.ddev.get_disk_part(1)
+    try:
+        _CephCrushRamp(cluster, float(step), int(max_recovering),
+                       timeout=timeout).ramp(targets, ret['changes'])
+    except Exception as e:
+        _error(ret, 'CRUSH ramp failed: {0}'.format(e))
 
-        # ceph-disk activate does not support both --cluster and --conf
-        cmd = ['ceph-disk']
-        cmd.append('activate')
-        cmd.append(rdata)
+    return ret
 
-        _check_run(cmd)
 
-    # ### interface ### #
+@_traced('inventory', record=False)
+def inventory(cluster=CEPH_CLUSTER):
+    '''
+    Get a compact inventory of ceph on this host: block devices and the
+    OSDs on them, the local MON and liveness of local daemons, gathered by
+    one lsblk run and the OSD detection cache, suitable as a mine function
+    so the master can plan without probing hosts, e.g.
+
+        mine_functions:
+          ceph_deploy.inventory: []
+
+    :param cluster: Cluster name.
+    :return: A dict of host, cluster, devices, osds and mon. devices is a
+    dict of device path -> dict of type (disk, osd-data, osd-journal or
+    partition), disk, fstype, and osd, state, fsid, journal of OSD data
+    partitions, state is 'unknown' if an OSD data partition is neither
+    mounted nor cached and its tags can not be read without mounting it,
+    nothing is mounted. osds is a dict of OSD name -> dict of data, journal, state
+    and running. mon is a dict of id, state and running, or None.
+    '''
+    osd_states = {
+        _CephOsdState.FREE: 'free',
+        _CephOsdState.PREPARED: 'prepared',
+        _CephOsdState.CREATED: 'created',
+        _CephOsdState.READY: 'ready',
+        _CephOsdState.ACTIVE: 'active',
+    }
+    mon_states = {
+        _CephMonState.FREE: 'free',
+        _CephMonState.READY: 'ready',
+        _CephMonState.ACTIVE: 'active',
+    }
 
-    def init(self):
-        assert self._state is None
+    cfg = _CephConf(cluster)
+    blocks = _BlockInventory.get()
+    status = _CephHostStatus.get(cfg.cluster)
 
-        (state, osdid, duuid, juuid, fstype, signature) = \
-            self.__detect_osd(self.ddev)
+    devices = {}
+    osds = {}
+    journals = {}       # journal partuuid -> OSD name
 
-        self.__old_id = osdid
-        self.__old_duuid = duuid
-        self.__old_juuid = juuid
-        self.__old_fstype = fstype
-        self.__old_signature = signature
+    for disk in blocks.disks:
+        devices[disk] = {'type': 'disk'}
 
-        self._state = state or _CephOsdState.FREE
+    for part, (disk, _) in blocks.parts.iteritems():
+        dev = _CephDev(part, _CephDevType.PART)
+        (guid, typecode, _) = dev.get_part_info()
 
-    def prepare(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) prepared'.format(
-                d=self.data, j=self.journal),
-            'changes': {}
+        fstype = dev.get_part_fs()
+
+        entry = {
+            'type': 'partition',
+            'disk': disk,
+            'fstype': None if fstype == _CephFsType.NONE else fstype,
         }
+        devices[part] = entry
 
-        changes = ret['changes']
-        datachanges = []
-        journalchanges = []
+        if typecode == JOURNAL_UUID:
+            entry['type'] = 'osd-journal'
+            entry['partuuid'] = guid
+            continue
+        if typecode != OSD_UUID:
+            continue
 
-        # detect existing OSD
-        self.init()
+        entry['type'] = 'osd-data'
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            # TODO: Umount or warn user if device is mounted
-            self.__clear_dev(self.ddev)
-            datachanges.append('Clear data device')
+        # never mount here, a mine function must not touch the devices
+        try:
+            osd = _CephOsd.probe(dev, mount=False)
+        except Exception as e:
+            entry['error'] = str(e)
+            continue
+
+        if osd is None:
+            entry['state'] = 'unknown'
+            continue
+
+        entry['state'] = osd_states.get(osd['state'])
+        entry['osd'] = osd['id']
+        entry['fsid'] = osd['fsid']
+
+        if osd['id'] is None:
+            continue
+
+        name = 'osd.{0}'.format(osd['id'])
+        osds[name] = {
+            'data': part,
+            'journal': None,
+            'state': entry['state'],
+            'running': bool(status.status(name)),
+        }
+        if osd['juuid']:
+            journals[osd['juuid']] = name
 
-            if self.jdev is not None and self.jdev.is_disk():
-                if self.jdev.get_disk_label() != _CephPartType.GPT:
-                    self.jdev.make_disk_label()
-                    journalchanges.append('Make gpt label')
+    # map journals by partition GUID, they may be on another disk
+    for path, entry in devices.iteritems():
+        name = journals.get(entry.get('partuuid'))
+        if name is not None:
+            entry['osd'] = int(name.split('.', 1)[1])
+            osds[name]['journal'] = path
+            devices[osds[name]['data']]['journal'] = path
+
+    for entry in devices.itervalues():
+        entry.pop('partuuid', None)
+
+    mon = None
+    mon_id = __grains__['id']
+    if os.path.exists(cfg.conf):
+        state = _CephMon.probe(mon_id, cfg.cluster)
+        if state is not None:
+            name = 'mon.{0}'.format(mon_id)
+            mon = {
+                'id': mon_id,
+                'state': mon_states.get(state),
+                'running': bool(status.status(name)),
+            }
+
+    return {
+        'host': __grains__['host'],
+        'cluster': cfg.cluster,
+        'devices': devices,
+        'osds': osds,
+        'mon': mon,
+    }
 
-            self.__prepare()
-            datachanges.append('Prepare device')
 
-            changes[self.data] = datachanges
-            if journalchanges:
-                changes[self.journal] = journalchanges
+class _CephJournalPlanner(object):
+    '''
+    Lay out journal partitions of several OSDs on a shared journal disk, the
+    partition table is read once and all partitions are created by one
+    sgdisk run followed by one partprobe, or partx if partprobe fails.
+    '''
+    def __init__(self, jdev, cluster=CEPH_CLUSTER):
+        '''
+        Init _CephJournalPlanner object.
 
-            return ret
+        :param jdev: _CephDev of the journal disk.
+        :param cluster: Cluster name.
+        :return: None.
+        '''
+        super(_CephJournalPlanner, self).__init__()
 
-        ret['comment'] = 'OSD: ({d}, {j}) is prepared, skip'\
-            .format(d=self.data, j=self.journal)
+        if not jdev.is_disk():
+            raise AssertionError('Not a disk')
 
-        return ret
+        self.jdev = jdev
+        self.cfg = _CephConf(cluster)
 
-    def activate(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) activated'.format(
-                d=self.data, j=self.journal),
-            'changes': {}
-        }
+    def __get_size(self):
+        # the same as ceph-disk, which asks for the value of osd.admin
+        size = self.cfg.get_conf('osd_journal_size', 'osd.admin')
 
-        changes = ret['changes']
-        datachanges = []
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise AssertionError('osd_journal_size is not valid')
 
-        # detect existing OSD
-        self.init()
+        if size <= 0:
+            raise AssertionError(
+                'osd_journal_size must be set to share a journal disk'
+            )
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            return _error(ret, 'OSD: ({d}, {j}) is not prepared, skip'
-                          .format(d=self.data, j=self.journal))
+        return size
 
-        # check if ever been activated
+    def create(self, count):
+        '''
+        Create journal partitions.
 
-        state = self._state
+        :param count: Number of journal partitions to create.
+        :return: (parts, changes) 2-tuples, parts is a list of paths of the
+        new partitions, changes is a list of changes made to the disk.
+        '''
+        changes = []
 
-        if state == _CephOsdState.PREPARED:
-            self.__activate()
+        size = self.__get_size()
 
-            datachanges.append('Create OSD entity')
-            datachanges.append('Make OSD filesystem')
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.CREATED:
-            self.__activate()
+        if self.jdev.get_disk_label() != _CephPartType.GPT:
+            self.jdev.make_disk_label()
+            changes.append('Make gpt label')
 
-            datachanges.append('Make OSD filesystem')
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.READY:
-            self.__activate()
+        used = self.jdev.get_disk_part_list()
 
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.ACTIVE:
-            daemon = _CephOsdDaemon(self.__old_id, self.cluster)
-            if daemon.is_running():
-                ret['comment'] = 'OSD: ({d}, {j}) is already activated, skip'\
-                                 .format(d=self.data, j=self.journal)
+        nums = []
+        num = 1
+        while len(nums) < count:
+            if num not in used:
+                nums.append(num)
+            num += 1
 
-                return ret
+        cmd = ['sgdisk']
+        for num in nums:
+            cmd.append('--new={num}:0:+{size}M'.format(num=num, size=size))
+            cmd.append('--partition-guid={num}:{guid}'.format(
+                num=num, guid=uuid.uuid4()))
+            cmd.append('--typecode={num}:{typecode}'.format(
+                num=num, typecode=JOURNAL_UUID))
+            cmd.append('--change-name={num}:ceph journal'.format(num=num))
+        cmd.append('--mbrtogpt')
+        cmd.append('--')
+        cmd.append(self.jdev.dev)
 
-            self.__activate()
+        try:
+            _check_run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
-            datachanges.append('Start OSD daemon')
+        try:
+            cmd = ['partprobe']
+            cmd.append(self.jdev.dev)
 
-        changes[self.data] = datachanges
+            (code, _, _) = _run(cmd)
 
-        return ret
+            if code:
+                # partprobe fails if other partitions of the disk are in
+                # use, e.g. journals of running OSDs, add the new ones only
+                for num in nums:
+                    cmd = ['partx']
+                    cmd.append('--add')
+                    cmd.extend(['--nr', str(num)])
+                    cmd.append('--')
+                    cmd.append(self.jdev.dev)
 
-    def manage(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) managed'.format(d=self.data, j=self.journal),
-            'changes': {}
-        }
+                    _check_run(cmd)
 
-        changes = ret['changes']
-        datachanges = []
-        journalchanges = []
+            # udev creates the device nodes, as ceph-disk we wait for it
+            cmd = ['udevadm']
+            cmd.append('settle')
+            cmd.append('--timeout={0}'.format(UDEV_SETTLE_TIMEOUT))
+            _run(cmd)
+        finally:
+            _BlockInventory.invalidate()
 
-        # detect existing OSD
-        self.init()
+        parts = []
+        for num in nums:
+            part = self.jdev.get_disk_part(num)
+            if not os.path.exists(part):
+                raise AssertionError('Kernel not sync with disk?')
+            parts.append(part)
+            changes.append('New journal partition: {0}'.format(part))
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            # TODO: Umount or warn user if device is mounted
-            self.__clear_dev(self.ddev)
-            datachanges.append('Clear data device')
+        return parts, changes
 
-            if self.jdev is not None and self.jdev.is_disk():
-                if self.jdev.get_disk_label() != _CephPartType.GPT:
-                    self.jdev.make_disk_label()
-                    journalchanges.append('Make gpt label')
 
-            self.__prepare()
-            datachanges.append('Prepare device')
-        
-        # new prepared device or has been prepared device
+def _osd_batch_key(data, journal):
+    '''
+    Get the group key of an OSD in a batch.
 
-        # check if ever been activated
+    Journal partitions of OSDs have their journals on the same disk are
+    planned together, see _CephJournalPlanner.
 
-        state = self._state
+    :param data: OSD data device.
+    :param journal: OSD journal device.
+    :return: Real path of the journal disk if shared, or the data device.
+    '''
+    rdata = os.path.realpath(data)
 
-        if state == _CephOsdState.PREPARED:
-            self.__activate()
+    if not journal:
+        return rdata
 
-            datachanges.append('Create OSD entity')
-            datachanges.append('Make OSD filesystem')
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.CREATED:
-            self.__activate()
+    rjournal = os.path.realpath(journal)
 
-            datachanges.append('Make OSD filesystem')
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.READY:
-            self.__activate()
+    if rjournal == rdata:
+        return rdata
 
-            datachanges.append('Authenticate OSD entity')
-            datachanges.append('Start OSD daemon')
-        elif state == _CephOsdState.ACTIVE:
-            daemon = _CephOsdDaemon(self.__old_id, self.cluster)
-            if daemon.is_running():
-                ret['comment'] = 'OSD: ({d}, {j}) already managed, skip'\
-                                 .format(d=self.data, j=self.journal)
+    jtype = _CephDev.get_dev_type(journal)
 
-                return ret
+    if jtype == _CephDevType.DISK:
+        return rjournal
+    if jtype == _CephDevType.PART:
+        return _CephDev(journal, jtype).get_part_disk()
 
-            self.__activate()
+    return rdata
 
-            datachanges.append('Start OSD daemon')
 
-        changes[self.data] = datachanges
+@_traced('osd_manage_batch')
+def osd_manage_batch(osds,
+                     cluster=CEPH_CLUSTER,
+                     max_workers=OSD_BATCH_WORKERS,
+                     initial_weight=None,
+                     maintenance=False):
+    '''
+    Manage a batch of OSDs concurrently.
+
+    OSDs are grouped by the disk their journals are on. Journal partitions
+    of new OSDs sharing a journal disk are created beforehand with one
+    sgdisk run per disk, after that all OSDs are managed by a pool of
+    workers concurrently.
+
+    :param osds: A dict of data device -> journal device.
+    :param cluster: Cluster name.
+    :param max_workers: Max number of OSDs to manage concurrently.
+    :param initial_weight: CRUSH weight of new OSDs, see osd_manage.
+    :param maintenance: Hold norebalance and nobackfill while OSDs are
+    managed, so data moves once for all new OSDs, and throttle recovery
+    until PGs are active+clean again, see _CephMaintenance.
+    :return: Salt state return with changes of all devices.
+    '''
+    ret = {
+        'name': cluster,
+        'result': True,
+        'comment': 'OSD batch: {0} OSD(s) managed'.format(len(osds or {})),
+        'changes': {}
+    }
 
-        return ret
+    if osds is None:
+        osds = {}
+    if not isinstance(osds, dict):
+        raise ValueError('osds must be a dict type')
 
-    def unprepare(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) unprepared'.format(
-                d=self.data, j=self.journal),
-            'changes': {}
-        }
+    comments = []
+    groups = {}
 
-        changes = ret['changes']
-        datachanges = []
-        journalchanges = []
+    items = []
 
-        # detect existing OSD
-        self.init()
+    for data, journal in sorted(osds.iteritems()):
+        journal = journal or ''
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
-                .format(d=self.data, j=self.journal)
+        # converged OSDs are not even grouped
+        fp = _CephFingerprint('osd_manage', data, cluster, journal=journal)
+        if fp.check():
+            items.append({
+                'name': data,
+                'result': True,
+                'comment': 'OSD: ({d}, {j}) already managed, skip'
+                           .format(d=data, j=journal),
+                'changes': {}
+            })
+            continue
 
-            return ret
+        try:
+            key = _osd_batch_key(data, journal)
+        except Exception as e:
+            ret['result'] = False
+            comments.append('OSD: ({d}, {j}) failed: {e}'.format(
+                d=data, j=journal, e=e))
+            continue
 
-        if self._state > _CephOsdState.PREPARED:
-            return _error(ret, 'OSD: ({d}, {j}) is activated, skip'
-                          .format(d=self.data, j=self.journal))
+        groups.setdefault(key, []).append((data, journal))
 
-        if self.jdev is not None and self.jdev.is_disk():
-            if self.__old_juuid is None:
-                raise AssertionError('corrupted osd filesystem')
+    def failed(data, journal, e):
+        return _error({'name': data, 'changes': {}},
+                      'OSD: ({d}, {j}) failed: {e}'.format(
+                          d=data, j=journal, e=e))
 
-            # journal device is created from another disk
-            rjournal = '/dev/disk/by-partuuid/{0}'.format(self.__old_juuid)
-            rjdev = _CephDev(rjournal, _CephDevType.PART)
+    def plan_group(group):
+        # a list of _CephOsd to manage or state returns of failed OSDs
+        items = []
+        pending = []
 
-            journal = rjdev.get_part_disk()
-            num = rjdev.get_part_num()
+        for data, journal in group:
+            try:
+                osd = _CephOsd(data, journal, cluster, initial_weight)
+                if osd.wants_journal_part():
+                    pending.append(osd)
+                items.append(osd)
+            except Exception as e:
+                items.append(failed(data, journal, e))
 
-            jdev = _CephDev(journal, _CephDevType.DISK)
-            jdev.remove_disk_part(num)
+        # ceph-disk creates the journal partition if only one is wanted
+        if len(pending) < 2:
+            return items
 
-            cmd = ['partprobe']
-            cmd.append(self.jdev.dev)
-            _run(cmd)
+        journal = pending[0].journal
 
-            journalchanges.append('Remove partition')
+        try:
+            planner = _CephJournalPlanner(pending[0].jdev, cluster)
+            (parts, jchanges) = planner.create(len(pending))
+        except Exception as e:
+            return [failed(osd.data, osd.journal, e) if osd in pending
+                    else osd for osd in items]
 
-        self.__clear_dev(self.ddev)
+        for osd, part in zip(pending, parts):
+            osd.use_journal_part(part)
 
-        datachanges.append('Destroy device')
+        items.append({'name': journal, 'result': True, 'comment': None,
+                      'changes': {journal: jchanges}})
 
-        if journalchanges:
-            changes[self.journal] = journalchanges
-        changes[self.data] = datachanges
+        return items
 
-        return ret
+    def manage(item):
+        if isinstance(item, dict):
+            return item
+        try:
+            r = item.manage()
+        except Exception as e:
+            return failed(item.data, item.journal, e)
 
-    def deactivate(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) deactivated'.format(
-                d=self.data, j=self.journal),
-            'changes': {}
-        }
+        fp = _CephFingerprint('osd_manage', item.data, cluster,
+                              journal=item.journal)
+        fp.update(r, item.identity)
 
-        changes = ret['changes']
-        daemonchanges = []
+        return r
 
-        # detect existing OSD
-        self.init()
+    for planned, exc in _pool_map(plan_group,
+                                  [groups[key] for key in sorted(groups)],
+                                  max_workers):
+        if exc is not None:
+            ret['result'] = False
+            comments.append('OSD batch: {0}'.format(exc))
+            continue
+        items.extend(planned)
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
-                .format(d=self.data, j=self.journal)
+    # journal partitions are created, no OSD changes a shared partition
+    # table from now on
+    results = []
 
-            return ret
+    # results are kept if only restoring the maintenance window fails
+    try:
+        # OSDs already active move no data, no window for them
+        if maintenance and any(not isinstance(x, dict)
+                               and x.state < _CephOsdState.ACTIVE
+                               for x in items):
+            with _CephMaintenance(cluster, MAINTENANCE_ADD_FLAGS):
+                results = _pool_map(manage, items, max_workers)
+        else:
+            results = _pool_map(manage, items, max_workers)
+    except Exception as e:
+        ret['result'] = False
+        comments.append('OSD batch: {0}'.format(e))
 
-        if self._state == _CephOsdState.PREPARED:
-            # not activated
-            ret['comment'] = 'OSD: ({d}, {j}) is not activated, skip'\
-                .format(d=self.data, j=self.journal)
+    for r, exc in results:
+        if exc is not None:
+            ret['result'] = False
+            comments.append('OSD batch: {0}'.format(exc))
+            continue
 
-            return ret
+        _merge_changes(ret['changes'], r['changes'])
+        if not r['result']:
+            ret['result'] = False
+        if r['comment']:
+            comments.append(r['comment'])
 
-        osdid = self.__old_id
-        fstype = self.__old_fstype
+    if comments:
+        ret['comment'] = '\n'.join(comments)
 
-        rddev = None
+    return ret
 
-        if self.ddev.is_disk():
-            rdata = self.ddev.get_disk_part(1)
-            rddev = _CephDev(rdata, _CephDevType.PART)
-        elif self.ddev.is_part():
-            rddev = self.ddev
 
-        mount = False   # data device mounted by us manually
-        path = ''       # location of OSD fs
+@_traced('osd_unmanage_batch')
+def osd_unmanage_batch(osds,
+                       cluster=CEPH_CLUSTER,
+                       max_workers=OSD_BATCH_WORKERS,
+                       maintenance=True):
+    '''
+    Unmanage a batch of OSDs concurrently.
+
+    OSDs with journals on the same disk are unmanaged one by one, as their
+    journal partitions are removed from the same partition table.
+
+    :param osds: A dict of data device -> journal device.
+    :param cluster: Cluster name.
+    :param max_workers: Max number of journal disks to work on concurrently.
+    :param maintenance: Hold noout, norebalance and nobackfill while OSDs
+    are removed, so data moves once for all of them, and throttle recovery
+    until PGs are active+clean again, see _CephMaintenance.
+    :return: Salt state return with changes of all devices.
+    '''
+    ret = {
+        'name': cluster,
+        'result': True,
+        'comment': 'OSD batch: {0} OSD(s) unmanaged'.format(len(osds or {})),
+        'changes': {}
+    }
 
-        try:
-            if self.ddev.is_disk() or self.ddev.is_part():
-                (path, _, _) = rddev.get_mount_info()
+    if osds is None:
+        osds = {}
+    if not isinstance(osds, dict):
+        raise ValueError('osds must be a dict type')
 
-                if path is None:
-                    # not mounted, mount to a tmp location manually
-                    path = rddev.mount_tmp(fstype)
-                    mount = True
-            else:
-                # data device is a directory
-                path = self.ddev.dev
+    comments = []
+    groups = {}
 
-            state = self._state
+    for data, journal in sorted(osds.iteritems()):
+        journal = journal or ''
 
-            if state == _CephOsdState.ACTIVE:
-                daemon = _CephOsdDaemon(osdid, self.cluster)
-                if daemon.is_running():
-                    daemon.stop()
+        try:
+            key = _osd_batch_key(data, journal)
+        except Exception as e:
+            ret['result'] = False
+            comments.append('OSD: ({d}, {j}) failed: {e}'.format(
+                d=data, j=journal, e=e))
+            continue
 
-                    daemonchanges.append('Stop OSD daemon')
+        groups.setdefault(key, []).append((data, journal))
 
-                self.__remove_auth(osdid, self.cfg)
-                self.__remove_crush(osdid, self.cfg)
+    def unmanage_group(group):
+        rets = []
 
-                tag = _CephOneLineTag(os.path.join(path, 'active'))
-                tag.remove()
+        for data, journal in group:
+            _CephFingerprint('osd_manage', data, cluster).clear()
+            try:
+                rets.append(_CephOsd(data, journal, cluster).unmanage())
+            except Exception as e:
+                rets.append(_error({'name': data, 'changes': {}},
+                                   'OSD: ({d}, {j}) failed: {e}'.format(
+                                       d=data, j=journal, e=e)))
 
-                daemonchanges.append('Remove OSD authentication')
+        return rets
 
-                state = _CephOsdState.READY
-            if state == _CephOsdState.READY:
-                shutil.rmtree(os.path.join(path, 'current'))
-                os.remove(os.path.join(path, 'superblock'))
-                os.remove(os.path.join(path, 'store_version'))
+    work = [groups[key] for key in sorted(groups)]
 
-                tag = _CephOneLineTag(os.path.join(path, 'ready'))
-                tag.remove()
+    results = []
 
-                daemonchanges.append('Remove OSD filesystem')
+    # results are kept if only restoring the maintenance window fails
+    try:
+        if maintenance and work:
+            with _CephMaintenance(cluster, MAINTENANCE_REMOVE_FLAGS):
+                results = _pool_map(unmanage_group, work, max_workers)
+        else:
+            results = _pool_map(unmanage_group, work, max_workers)
+    except Exception as e:
+        ret['result'] = False
+        comments.append('OSD batch: {0}'.format(e))
 
-                state = _CephOsdState.CREATED
-            if state == _CephOsdState.CREATED:
-                self.__unregister(osdid, self.cfg)
+    for rets, exc in results:
+        if exc is not None:
+            ret['result'] = False
+            comments.append('OSD batch: {0}'.format(exc))
+            continue
 
-                tag = _CephOneLineTag(os.path.join(path, 'whoami'))
-                tag.remove()
+        for r in rets:
+            _merge_changes(ret['changes'], r['changes'])
+            if not r['result']:
+                ret['result'] = False
+            if r['comment']:
+                comments.append(r['comment'])
 
-                daemonchanges.append('Remove OSD entity')
+    if comments:
+        ret['comment'] = '\n'.join(comments)
 
-                state = _CephOsdState.PREPARED
+    return ret
 
-            self._state = state
-        finally:
-            if self.ddev.is_disk() or self.ddev.is_part():
-                rddev.umount(umount_all=True)
-                os.rmdir(path)
 
-        changes['osd.{0}'.format(osdid)] = daemonchanges
+def _osd_hotplug_refusal(dev):
+    '''
+    Check a hotplugged disk may be managed as an OSD data disk, i.e. it is
+    blank, or only carries ceph-disk OSD data and journal partitions.
 
-        return ret
+    :param dev: Real path of the disk.
+    :return: None if it may be managed, or why it is refused.
+    '''
+    if _CephDev.get_dev_type(dev) != _CephDevType.DISK:
+        return 'not a disk'
 
-    def unmanage(self):
-        ret = {
-            'name': self.data,
-            'result': True,
-            'comment': 'OSD: ({d}, {j}) unmanaged'.format(
-                d=self.data, j=self.journal),
-            'changes': {}
-        }
+    disk = _CephDev(dev, _CephDevType.DISK)
+    label = disk.get_disk_label()
 
-        changes = ret['changes']
-        datachanges = []
-        journalchanges = []
-        daemonchanges = []
+    if label == _CephPartType.NONE:
+        (_, fstype) = _BlockInventory.get().get_info(disk.dev, 'fstype')
+        if fstype:
+            return 'carries a {0} filesystem'.format(fstype)
+        return None
 
-        # detect existing OSD
-        self.init()
+    if label != _CephPartType.GPT:
+        return 'has a non-GPT partition table'
 
-        if self._state == _CephOsdState.FREE:
-            # not prepared
-            ret['comment'] = 'OSD: ({d}, {j}) is not prepared, skip'\
-                .format(d=self.data, j=self.journal)
+    for num in sorted(disk.get_disk_part_list()):
+        part = _CephDev(disk.get_disk_part(num), _CephDevType.PART)
+        (_, typecode, _) = part.get_part_info()
 
-            return ret
+        if typecode not in (OSD_UUID, JOURNAL_UUID):
+            return 'has a partition not made by ceph-disk: {0}'.format(
+                part.dev)
 
-        osdid = self.__old_id
-        fstype = self.__old_fstype
+    return None
 
-        rddev = None
 
-        if self.ddev.is_disk():
-            rdata = self.ddev.get_disk_part(1)
-            rddev = _CephDev(rdata, _CephDevType.PART)
-        elif self.ddev.is_part():
-            rddev = self.ddev
+@_traced('osd_hotplug')
+def osd_hotplug(dev,
+                action='add',
+                osds=None,
+                cluster=None,
+                initial_weight=None):
+    '''
+    Handle a disk added to or removed from this host, run by the reactor on
+    a clove/osd/hotplug event, see reactor/osd.sls.
+
+    The disk is matched against the OSD data devices of ceph:osds in the
+    pillar, the OSD of an added disk is managed by osd_manage, nothing else
+    on this host is touched. An added disk is refused unless it is blank or
+    only carries ceph-disk OSD partitions, osd_manage would wipe it.
+
+    :param dev: Disk added or removed, e.g. /dev/sdb.
+    :param action: 'add' or 'remove'.
+    :param osds: A dict of data device -> journal device, default is
+    ceph:osds in the pillar.
+    :param cluster: Cluster name, default is ceph:cluster in the pillar.
+    :param initial_weight: CRUSH weight of a new OSD, default is
+    ceph:osd_initial_weight in the pillar.
+    :return: Salt state return.
+    '''
+    if action not in ('add', 'remove'):
+        raise ValueError('Invalid action: {0}'.format(action))
 
-        mount = False   # data device mounted by us manually
-        path = ''       # location of OSD fs
+    pillar = __salt__['pillar.get']('ceph', {})
 
-        try:
-            if self.ddev.is_disk() or self.ddev.is_part():
-                (path, _, _) = rddev.get_mount_info()
+    if osds is None:
+        osds = pillar.get('osds') or {}
+    if cluster is None:
+        cluster = pillar.get('cluster') or CEPH_CLUSTER
+    if initial_weight is None:
+        initial_weight = pillar.get('osd_initial_weight')
 
-                if path is None:
-                    # not mounted, mount to a tmp location manually
-                    path = rddev.mount_tmp(fstype)
-                    mount = True
-            else:
-                # data device is a directory
-                path = self.ddev.dev
+    ret = {
+        'name': dev,
+        'result': True,
+        'comment': 'Disk: {0} is not an OSD data device, skip'.format(dev),
+        'changes': {}
+    }
 
-            state = self._state
+    # pillar may name disks by /dev/disk/by-* links, udev by kernel names
+    rdev = os.path.realpath(dev)
 
-            if state == _CephOsdState.ACTIVE:
-                daemon = _CephOsdDaemon(osdid, self.cluster)
-                if daemon.is_running():
-                    daemon.stop()
+    if action == 'remove':
+        # udev removes by-* links of the disk before the event arrives, a
+        # data device gone is a removed disk too
+        matched = sorted((data, journal or '')
+                         for data, journal in osds.iteritems()
+                         if os.path.realpath(data) == rdev
+                         or not os.path.exists(data))
 
-                    daemonchanges.append('Stop OSD daemon')
+        if not matched:
+            return ret
 
-                self.__remove_auth(osdid, self.cfg)
-                self.__remove_crush(osdid, self.cfg)
+        # the OSD of a removed disk goes down by itself, later runs must
+        # detect the disk again
+        for data, journal in matched:
+            _CephFingerprint('osd_manage', data, cluster).clear()
 
-                tag = _CephOneLineTag(os.path.join(path, 'active'))
-                tag.remove()
+        ret['comment'] = '\n'.join(
+            'OSD: ({d}, {j}) disk removed'.format(d=data, j=journal)
+            for data, journal in matched)
+        return ret
 
-                daemonchanges.append('Remove OSD authentication')
+    matched = [(data, journal or '') for data, journal in osds.iteritems()
+               if os.path.realpath(data) == rdev]
 
-                state = _CephOsdState.READY
-            if state == _CephOsdState.READY:
-                tag = _CephOneLineTag(os.path.join(path, 'ready'))
-                tag.remove()
+    if not matched:
+        return ret
 
-                daemonchanges.append('Remove OSD filesystem')
+    (data, journal) = matched[0]
 
-                state = _CephOsdState.CREATED
-            if state == _CephOsdState.CREATED:
-                self.__unregister(osdid, self.cfg)
+    _BlockInventory.invalidate()
 
-                tag = _CephOneLineTag(os.path.join(path, 'whoami'))
-                tag.remove()
+    refusal = _osd_hotplug_refusal(rdev)
+    if refusal is not None:
+        return _error(ret, 'Disk: {d} {r}, refused to manage it as OSD '
+                           'data device: {o}'.format(d=dev, r=refusal,
+                                                     o=data))
 
-                daemonchanges.append('Remove OSD entity')
+    _CephFingerprint('osd_manage', data, cluster).clear()
 
-                state = _CephOsdState.PREPARED
-            if state == _CephOsdState.PREPARED:
-                if self.jdev is not None and self.jdev.is_disk():
-                    if self.__old_juuid is None:
-                        raise AssertionError('corrupted osd filesystem')
+    return osd_manage(data, journal, cluster, initial_weight)
 
-                    # journal device is created from another disk
-                    rjournal = '/dev/disk/by-partuuid/{0}'.format(self.__old_juuid)
-                    rjdev = _CephDev(rjournal, _CephDevType.PART)
 
-                    journal = rjdev.get_part_disk()
-                    num = rjdev.get_part_num()
+@_traced('osd_replace')
+def osd_replace(osdid,
+                data='',
+                journal=None,
+                cluster=CEPH_CLUSTER,
+                initial_weight=None):
+    '''
+    Replace a failed OSD on this host by a new data disk.
+
+    The OSD is located by the whoami and journal_uuid tags of the OSD data
+    partitions, or by the OSD detection cache if its disk is gone. It is
+    removed from auth, CRUSH and the OSD map, then the new data disk is
+    prepared with the existing journal partition and activated. Monitors
+    give the lowest free id to a new OSD, so it gets the old id back unless
+    another OSD is created meanwhile, and it is put back in CRUSH with the
+    old weight, so data only moves back to it. norebalance and nobackfill
+    are held meanwhile, see _CephMaintenance.
+
+    :param osdid: Id of the OSD to replace.
+    :param data: New data device, default is the disk of the old data
+    partition, which must still be there, i.e. rebuild the OSD in place.
+    :param journal: Journal device, default is the old journal partition,
+    or '' to put the journal on data.
+    :param cluster: Cluster name.
+    :param initial_weight: CRUSH weight of the new OSD, default is the
+    weight of the old OSD.
+    :return: Salt state return.
+    '''
+    osdid = int(osdid)
+    name = 'osd.{0}'.format(osdid)
 
-                    jdev = _CephDev(journal, _CephDevType.DISK)
-                    jdev.remove_disk_part(num)
+    ret = {
+        'name': name,
+        'result': True,
+        'comment': '',
+        'changes': {}
+    }
 
-                    cmd = ['partprobe']
-                    cmd.append(self.jdev.dev)
-                    _run(cmd)
+    changes = ret['changes']
+    daemonchanges = []
 
-                    journalchanges.append('Remove partition')
+    cfg = _CephConf(cluster)
+    fsid = str(cfg.get_conf('fsid')).lower()
 
-                self.__clear_dev(self.ddev)
+    old = _CephOsd.locate(osdid, cluster)
 
-                datachanges.append('Destroy device')
+    if old is None:
+        if not data:
+            return _error(ret, 'OSD: {0} not found on this host'.format(name))
+        old = {'data': None, 'guid': None, 'juuid': None, 'journal': None}
 
-            self._state = state
-        finally:
-            if self.ddev.is_disk() or self.ddev.is_part():
-                rddev.umount(umount_all=True)
-                os.rmdir(path)
+    if not data:
+        if old['data'] is None:
+            return _error(ret, 'OSD: {0} data device is gone, '
+                               'new data device required'.format(name))
+        data = _CephDev(old['data'], _CephDevType.PART).get_part_disk()
 
-        if datachanges:
-            changes[self.data] = datachanges
-        if journalchanges:
-            changes[self.journal] = journalchanges
-        if daemonchanges:
-            changes['osd.{0}'.format(osdid)] = daemonchanges
+    rdata = os.path.realpath(data)
 
-        return ret
+    if journal is None:
+        journal = old['journal'] or ''
 
-    def takeover(self):
-        pass
+        # a journal on the old data disk is gone with it
+        if journal and _CephDev(journal, _CephDevType.PART) \
+                .get_part_disk() == rdata:
+            journal = ''
 
-    def zap(self):
-        pass
+    # the new data device must not carry another OSD
+    ddev = _CephDev(data, _CephDev.get_dev_type(data))
 
+    zap = False     # the old OSD is still on the data device
 
-def osd_prepare(data,
-                journal='',
-                cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+    try:
+        probed = _CephOsd.probe(ddev)
+    except Exception as e:
+        # the old data disk may be too broken to be detected
+        if old['data'] is None \
+                or _CephDev(old['data'], _CephDevType.PART) \
+                .get_part_disk() != rdata:
+            return _error(ret, 'Data device: {d} failed to detect: {e}'
+                          .format(d=data, e=e))
+        zap = True
+    else:
+        if probed['state'] is not None:
+            if probed['id'] != osdid \
+                    or str(probed['fsid']).lower() != fsid:
+                return _error(ret, 'Data device: {d} carries another OSD, '
+                                   'skip'.format(d=data))
+            zap = True
 
-    return osd.prepare()
+    ceph = _CephCluster(cluster)
 
+    # the old weight is full weight already, nothing to ramp up
+    keep_weight = initial_weight is None
+    if keep_weight:
+        initial_weight = ceph.crush_weights().get(osdid)
 
-def osd_activate(data,
-                 journal='',
-                 cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+    # data moves once the new OSD is in, not also when the old one goes
+    with _CephMaintenance(cluster, MAINTENANCE_ADD_FLAGS):
+        daemon = _CephOsdDaemon(osdid, cluster)
+        if daemon.is_running():
+            daemon.stop()
 
-    return osd.activate()
+            daemonchanges.append('Stop OSD daemon')
 
+        # the old data partition may be left mounted, even if its disk is gone
+        osd_data = cfg.get_conf('osd_data', name)
+        if osd_data and any(x[1] == osd_data
+                            for x in _BlockInventory.get().mounts):
+            try:
+                _check_run(['umount', '--lazy', '--', osd_data])
+            finally:
+                _BlockInventory.invalidate()
 
-def osd_manage(data,
-               journal='',
-               cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+            daemonchanges.append('Unmount OSD data')
 
-    return osd.manage()
+        ceph.osd_remove(osdid)
 
+        daemonchanges.append('Remove OSD authentication')
+        daemonchanges.append('Remove OSD from CRUSH')
+        daemonchanges.append('Remove OSD entity')
 
-def osd_unprepare(data,
-                  journal='',
-                  cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+        changes[name] = daemonchanges
 
-    return osd.unprepare()
+        if old['guid']:
+            _CephOsdCache.discard(old['guid'])
 
+        _CephFingerprint('osd_manage', data, cluster).clear()
+        _BlockInventory.invalidate()
+        _CephHostStatus.invalidate()
 
-def osd_deactivate(data,
-                   journal='',
-                   cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+        osd = _CephOsd(data, journal, cluster, initial_weight)
 
-    return osd.deactivate()
+        if zap:
+            _merge_changes(changes, osd.zap()['changes'])
 
+        r = osd.manage()
+        _merge_changes(changes, r['changes'])
 
-def osd_unmanage(data,
-                 journal='',
-                 cluster=CEPH_CLUSTER):
-    osd = _CephOsd(data, journal, cluster)
+        if not r['result']:
+            return _error(ret, r['comment'])
 
-    return osd.unmanage()
+    newid = _CephOsd.probe(osd.ddev)['id']
+
+    if keep_weight and newid is not None:
+        _CephCrushRamp.forget([newid], cluster)
+
+    ret['comment'] = 'OSD: {o} replaced by ({d}, {j}) as osd.{n}'.format(
+        o=name, d=data, j=journal, n=newid)
+    if newid != osdid:
+        ret['comment'] += ', id {0} was taken'.format(osdid)
+
+    return ret
 
 
 class _CephMonState(object):
@@ -2490,6 +7122,42 @@ class _CephMon(object):
 
         self.__old_signature = None
 
+    def identity(self):
+        '''
+        Identity of an active MON for _CephFingerprint.
+
+        :return: A dict of files and asok, or None if the MON is not active or
+                 its daemon has no admin socket.
+        '''
+        if self._state != _CephMonState.ACTIVE:
+            return None
+
+        asok = _CephHostStatus.get(self.cluster).sockets.get(self.name)
+        if not asok:
+            return None
+
+        files = [os.path.join(self.mon_data, x)
+                 for x in ('signature', 'ready', 'active')]
+
+        return {'files': files, 'asok': asok}
+
+    @classmethod
+    def probe(cls, mon_id, cluster=CEPH_CLUSTER):
+        '''
+        Detect the state of a MON on this host without managing it.
+
+        :param mon_id: MON id.
+        :param cluster: Cluster name.
+        :return: _CephMonState, None if no MON store found.
+        '''
+        mon_data = _CephConf(cluster).get_conf('mon_data',
+                                               'mon.{0}'.format(mon_id))
+
+        if not mon_data or not os.path.isdir(mon_data):
+            return None
+
+        return cls.__get_state(mon_data)
+
     @classmethod
     def __detect_mon(cls, path):
         (state, signature) = (None, None)
@@ -2577,14 +7245,14 @@ class _CephMon(object):
 
             # mkfs
             cmd = ['ceph-mon']
-            cmd.append('--cluster {0}'.format(self.cluster))
-            cmd.append('--conf {0}'.format(self.conf))
-            cmd.append('--id {0}'.format(self.mon_id))
+            cmd.extend(['--cluster', self.cluster])
+            cmd.extend(['--conf', self.conf])
+            cmd.extend(['--id', self.mon_id])
             cmd.append('--mkfs')
             if keyring:
-                cmd.append('--keyring {0}'.format(keyring))
+                cmd.extend(['--keyring', keyring])
             if self.mon_addr:
-                cmd.append('--public-addr {0}'.format(self.mon_addr))
+                cmd.extend(['--public-addr', self.mon_addr])
 
             _check_run(cmd)
 
@@ -2596,8 +7264,8 @@ class _CephMon(object):
 
     def __register(self):
         cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
         cmd.append('mon')
         cmd.append('add')
         cmd.append(self.mon_id)
@@ -2606,8 +7274,8 @@ class _CephMon(object):
 
     def __unregister(self):
         cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
+        cmd.extend(['--cluster', self.cluster])
+        cmd.extend(['--conf', self.conf])
         cmd.append('mon')
         cmd.append('remove')
         cmd.append(self.mon_id)
@@ -2624,6 +7292,7 @@ class _CephMon(object):
         self.__old_signature = signature
         self._state = state or _CephMonState.FREE
 
+    @_traced('_CephMon.prepare')
     def prepare(self):
         ret = {
             'name': self.mon_id,
@@ -2715,6 +7384,7 @@ class _CephMon(object):
 
         return ret
 
+    @_traced('_CephMon.activate')
     def activate(self, **kwargs):
         ret = {
             'name': self.mon_id,
@@ -2853,6 +7523,7 @@ class _CephMon(object):
 
         return ret
 
+    @_traced('_CephMon.manage')
     def manage(self, **kwargs):
         ret = {
             'name': self.mon_id,
@@ -3018,6 +7689,7 @@ class _CephMon(object):
 
         return ret
 
+    @_traced('_CephMon.unprepare')
     def unprepare(self):
         ret = {
             'name': self.mon_id,
@@ -3087,6 +7759,7 @@ class _CephMon(object):
 
         return ret
 
+    @_traced('_CephMon.deactivate')
     def deactivate(self):
         ret = {
             'name': self.mon_id,
@@ -3183,6 +7856,7 @@ class _CephMon(object):
 
         return ret
 
+    @_traced('_CephMon.unmanage')
     def unmanage(self):
         ret = {
             'name': self.mon_id,
@@ -3288,11 +7962,39 @@ class _CephMon(object):
         pass
 
 
-def mon_prepare(mon_id='',
-                auth_type='none',
-                mon_key='',
-                mon_addr='',
-                cluster=CEPH_CLUSTER):
+@_traced('mon_prepare')
+def mon_prepare(mon_id=None,
+                auth_type=None,
+                mon_key=None,
+                mon_addr=None,
+                cluster=None):
+    '''
+    Make the MON store, without starting the MON.
+
+    Options not given are read from ceph in the pillar of this host, with
+    the same defaults as ceph/mon.sls, so the orchestrate runner needs not
+    know the pillar of every MON host.
+
+    :param mon_id: MON id, default is ceph:mon_id or the minion id.
+    :param auth_type: 'cephx' or 'none'.
+    :param mon_key: MON key.
+    :param mon_addr: MON address.
+    :param cluster: Cluster name.
+    :return: Salt state return.
+    '''
+    pillar = __salt__['pillar.get']('ceph', {})
+
+    if mon_id is None:
+        mon_id = pillar.get('mon_id')
+    if auth_type is None:
+        auth_type = pillar.get('auth_type', 'cephx') or 'none'
+    if mon_key is None:
+        mon_key = pillar.get('mon_key') or ''
+    if mon_addr is None:
+        mon_addr = pillar.get('mon_addr') or ''
+    if cluster is None:
+        cluster = pillar.get('cluster') or CEPH_CLUSTER
+
     mon_id = mon_id or __grains__['id']
 
     mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
@@ -3300,6 +8002,7 @@ def mon_prepare(mon_id='',
     return mon.prepare()
 
 
+@_traced('mon_activate')
 def mon_activate(mon_id='',
                  auth_type='none',
                  mon_key='',
@@ -3308,117 +8011,390 @@ def mon_activate(mon_id='',
     mon_id = mon_id or __grains__['id']
     host = __grains__['host']
 
-    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+
+    return mon.activate(host=host)
+
+
+@_traced('mon_manage')
+def mon_manage(mon_id='',
+               auth_type='none',
+               mon_key='',
+               mon_addr='',
+               cluster=CEPH_CLUSTER):
+    mon_id = mon_id or __grains__['id']
+    host = __grains__['host']
+
+    fp = _CephFingerprint('mon_manage', mon_id, cluster,
+                          auth_type=auth_type, mon_key=mon_key,
+                          mon_addr=mon_addr, host=host)
+    if fp.check():
+        return {
+            'name': mon_id,
+            'result': True,
+            'comment': 'MON: mon.{0} is already managed, skip'.format(mon_id),
+            'changes': {}
+        }
+
+    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+
+    ret = mon.manage(host=host)
+    fp.update(ret, mon.identity)
+
+    return ret
+
+
+@_traced('mon_unprepare')
+def mon_unprepare(mon_id='',
+                  auth_type='none',
+                  mon_key='',
+                  mon_addr='',
+                  cluster=CEPH_CLUSTER):
+    mon_id = mon_id or __grains__['id']
+
+    _CephFingerprint('mon_manage', mon_id, cluster).clear()
+
+    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+
+    return mon.unprepare()
+
+
+@_traced('mon_deactivate')
+def mon_deactivate(mon_id='',
+                   auth_type='none',
+                   mon_key='',
+                   mon_addr='',
+                   cluster=CEPH_CLUSTER):
+    mon_id = mon_id or __grains__['id']
+
+    _CephFingerprint('mon_manage', mon_id, cluster).clear()
+
+    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+
+    return mon.deactivate()
+
+
+@_traced('mon_unmanage')
+def mon_unmanage(mon_id='',
+                 auth_type='none',
+                 mon_key='',
+                 mon_addr='',
+                 cluster=CEPH_CLUSTER):
+    mon_id = mon_id or __grains__['id']
+
+    _CephFingerprint('mon_manage', mon_id, cluster).clear()
+
+    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+
+    return mon.unmanage()
+
+
+@_traced('mon_running', record=False)
+def mon_running(mon_id, cluster=CEPH_CLUSTER):
+    daemon = _CephMonDaemon(mon_id, cluster)
+
+    return daemon.is_running()
+
+
+@_traced('mon_start', record=False)
+def mon_start(mon_id, cluster=CEPH_CLUSTER):
+    daemon = _CephMonDaemon(mon_id, cluster)
+
+    daemon.start()
+
+
+@_traced('mon_stop', record=False)
+def mon_stop(mon_id, cluster=CEPH_CLUSTER):
+    daemon = _CephMonDaemon(mon_id, cluster)
+
+    daemon.stop()
+
+
+@_traced('mon_restart', record=False)
+def mon_restart(mon_id, cluster=CEPH_CLUSTER):
+    daemon = _CephMonDaemon(mon_id, cluster)
+
+    daemon.restart()
+
+
+@_traced('mon_wait_quorum')
+def mon_wait_quorum(mon_id='',
+                    cluster=CEPH_CLUSTER,
+                    timeout=MON_QUORUM_TIMEOUT):
+    '''
+    Wait for the local MON to join a quorum.
+
+    :param mon_id: MON id, default is the minion id.
+    :param cluster: Cluster name.
+    :param timeout: Max seconds to wait.
+    :return: Salt state return, the comment tells which MONs are not in
+    quorum if timed out.
+    '''
+    mon_id = mon_id or __grains__['id']
+
+    ret = {
+        'name': mon_id,
+        'result': True,
+        'comment': '',
+        'changes': {}
+    }
+
+    started = time.time()
+
+    try:
+        status = _CephMonDaemon(mon_id, cluster).wait_quorum(timeout)
+    except RuntimeError as e:
+        return _error(ret, 'MON: {0}'.format(e))
+
+    quorum = _CephMonDaemon.quorum_names(status)
+
+    ret['comment'] = 'MON: mon.{0} is {1} of quorum {2} after {3:.1f}s'.format(
+        mon_id, status['state'], ', '.join(quorum), time.time() - started)
+
+    return ret
+
+
+def gen_key():
+    key = os.urandom(16)
+    header = struct.pack(
+        '<hiih',
+        1,                 # le16 type: CEPH_CRYPTO_AES
+        int(time.time()),  # le32 created: seconds
+        0,                 # le32 created: nanoseconds,
+        len(key),          # le16: len(key)
+    )
+    return base64.b64encode(header + key)
+
+
+class _CephKeyring(object):
+    '''
+    In-memory keyring in the plain text format of ceph-authtool, i.e.
+
+        [client.admin]
+        \tkey = AQ...==
+        \tcaps mon = "allow *"
+
+    Entities keep their order, caps are written sorted by daemon type.
+    '''
+    HEADER = '<hiih'            # le16 type, le32 sec, le32 nsec, le16 len
+    KEY_TYPES = [0, 1]          # CEPH_CRYPTO_NONE, CEPH_CRYPTO_AES
+
+    def __init__(self):
+        super(_CephKeyring, self).__init__()
+
+        self.names = []
+        self.entries = {}
+
+    @classmethod
+    def check_key(cls, key):
+        '''
+        Check a key has the layout gen_key produces.
+
+        :param key: Base64 encoded key.
+        :return: None, raise ValueError if the key is invalid.
+        '''
+        try:
+            raw = base64.b64decode(key)
+        except TypeError:
+            raise ValueError('Invalid key: {0}, not base64'.format(key))
+
+        size = struct.calcsize(cls.HEADER)
+        if len(raw) < size:
+            raise ValueError('Invalid key: {0}, too short'.format(key))
 
-    return mon.activate(host=host)
+        (ktype, _, _, klen) = struct.unpack(cls.HEADER, raw[:size])
 
+        if ktype not in cls.KEY_TYPES:
+            raise ValueError('Invalid key: {0}, unknown type: {1}'
+                             .format(key, ktype))
+        if klen != len(raw) - size:
+            raise ValueError('Invalid key: {0}, bad secret length'.format(key))
 
-def mon_manage(mon_id='',
-               auth_type='none',
-               mon_key='',
-               mon_addr='',
-               cluster=CEPH_CLUSTER):
-    mon_id = mon_id or __grains__['id']
-    host = __grains__['host']
+    @classmethod
+    def loads(cls, text):
+        '''
+        Parse a keyring.
 
-    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+        :param text: Keyring content.
+        :return: _CephKeyring.
+        '''
+        keyring = cls()
 
-    return mon.manage(host=host)
+        name = None
+        for (lineno, line) in enumerate(text.splitlines(), 1):
+            line = line.strip()
 
+            if not line or line[0] in '#;':
+                continue
 
-def mon_unprepare(mon_id='',
-                  auth_type='none',
-                  mon_key='',
-                  mon_addr='',
-                  cluster=CEPH_CLUSTER):
-    mon_id = mon_id or __grains__['id']
+            if line.startswith('['):
+                if not line.endswith(']'):
+                    raise ValueError('Invalid keyring line {0}: {1}'
+                                     .format(lineno, line))
 
-    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+                name = line[1:-1].strip()
+                keyring.set(name, '')
+                continue
 
-    return mon.unprepare()
+            if name is None or '=' not in line:
+                raise ValueError('Invalid keyring line {0}: {1}'
+                                 .format(lineno, line))
 
+            (opt, val) = [x.strip() for x in line.split('=', 1)]
+            opt = ' '.join(opt.split())
+            if len(val) > 1 and val[0] == val[-1] and val[0] in '"\'':
+                val = val[1:-1]
 
-def mon_deactivate(mon_id='',
-                   auth_type='none',
-                   mon_key='',
-                   mon_addr='',
-                   cluster=CEPH_CLUSTER):
-    mon_id = mon_id or __grains__['id']
+            entry = keyring.entries[name]
 
-    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+            if opt == 'key':
+                entry['key'] = val
+            elif opt.startswith('caps '):
+                entry['caps'][opt[len('caps '):]] = val
+            elif opt == 'auid':
+                entry['auid'] = val
 
-    return mon.deactivate()
+        return keyring
 
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a keyring file.
 
-def mon_unmanage(mon_id='',
-                 auth_type='none',
-                 mon_key='',
-                 mon_addr='',
-                 cluster=CEPH_CLUSTER):
-    mon_id = mon_id or __grains__['id']
+        :param path: Keyring path, a missing file is an empty keyring.
+        :return: _CephKeyring.
+        '''
+        if not os.path.exists(path):
+            return cls()
 
-    mon = _CephMon(mon_id, auth_type, mon_key, mon_addr, cluster)
+        with open(path, 'rb') as fobj:
+            return cls.loads(fobj.read())
 
-    return mon.unmanage()
+    @classmethod
+    def from_export(cls, entries):
+        '''
+        Build a keyring from auth entries exported by the monitors.
 
+        :param entries: A list of dicts with 'entity', 'key' and 'caps'.
+        :return: _CephKeyring.
+        '''
+        keyring = cls()
 
-def mon_running(mon_id, cluster=CEPH_CLUSTER):
-    daemon = _CephMonDaemon(mon_id, cluster)
+        for entry in entries:
+            keyring.set(entry['entity'], entry.get('key', ''),
+                        entry.get('caps', {}))
 
-    return daemon.is_running()
+        return keyring
 
+    def get(self, name):
+        '''
+        Get an entity.
 
-def mon_start(mon_id, cluster=CEPH_CLUSTER):
-    daemon = _CephMonDaemon(mon_id, cluster)
+        :param name: Entity name.
+        :return: A dict with 'key' and 'caps', or None if no such entity.
+        '''
+        return self.entries.get(name)
 
-    daemon.start()
+    def set(self, name, key, caps=None):
+        '''
+        Add an entity, or replace the key and caps of an existing one.
+
+        :param name: Entity name.
+        :param key: Key of the entity.
+        :param caps: A dict of daemon type -> caps.
+        :return: None.
+        '''
+        if name not in self.entries:
+            self.names.append(name)
 
+        self.entries[name] = {
+            'key': key,
+            'caps': dict(caps or {}),
+        }
 
-def mon_stop(mon_id, cluster=CEPH_CLUSTER):
-    daemon = _CephMonDaemon(mon_id, cluster)
+    def remove(self, name):
+        '''
+        Remove an entity.
 
-    daemon.stop()
+        :param name: Entity name.
+        :return: True if the entity existed.
+        '''
+        if name not in self.entries:
+            return False
 
+        self.names.remove(name)
+        del self.entries[name]
 
-def mon_restart(mon_id, cluster=CEPH_CLUSTER):
-    daemon = _CephMonDaemon(mon_id, cluster)
+        return True
 
-    daemon.restart()
+    def diff(self, other):
+        '''
+        Compare with another keyring.
 
+        :param other: _CephKeyring compare to.
+        :return: (added, changed, removed) 3-tuples of entity name lists,
+                 from this keyring to the other one.
+        '''
+        added = [x for x in other.names if x not in self.entries]
+        removed = [x for x in self.names if x not in other.entries]
+        changed = [x for x in self.names
+                   if x in other.entries
+                   and self.entries[x] != other.entries[x]]
 
-class _CephIniFile(object):
-    '''
-    ConfigParser module of python 2.x does not support leading space
-    in the ini file, so feed this to ConfigParser
-    '''
-    def __init__(self, fpath):
-        super(_CephIniFile, self).__init__()
-        self.fpath = fpath
+        return added, changed, removed
 
-    def __enter__(self):
-        self.fobj = open(self.fpath, 'rb')
-        return self
+    def dumps(self):
+        '''
+        Serialize the keyring.
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.fobj.close()
-        return False
+        :return: Keyring content.
+        '''
+        lines = []
 
-    def readline(self):
-        line = self.fobj.readline()
+        for name in self.names:
+            entry = self.entries[name]
 
-        return line.lstrip(' \t')
+            lines.append('[{0}]'.format(name))
+            lines.append('\tkey = {0}'.format(entry['key']))
+            if 'auid' in entry:
+                lines.append('\tauid = {0}'.format(entry['auid']))
+            for (etype, caps) in sorted(entry['caps'].iteritems()):
+                lines.append('\tcaps {0} = "{1}"'.format(etype, caps))
 
+        return ''.join(x + '\n' for x in lines)
 
-def gen_key():
-    key = os.urandom(16)
-    header = struct.pack(
-        '<hiih',
-        1,                 # le16 type: CEPH_CRYPTO_AES
-        int(time.time()),  # le32 created: seconds
-        0,                 # le32 created: nanoseconds,
-        len(key),          # le16: len(key)
-    )
-    return base64.b64encode(header + key)
+    def write(self, path, mode=0600):
+        '''
+        Write the keyring atomically, the mode and owner of an existing file
+        are kept.
+
+        :param path: Keyring path, symbolic links are followed.
+        :param mode: Mode of a new file.
+        :return: None.
+        '''
+        path = os.path.realpath(path)
+        pdir = os.path.dirname(path)
+
+        owner = None
+        if os.path.isfile(path):
+            st = os.stat(path)
+            mode = stat.S_IMODE(st.st_mode)
+            owner = (st.st_uid, st.st_gid)
+
+        (fd, tmp) = tempfile.mkstemp(prefix='.kr.', dir=pdir)
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                if owner is not None:
+                    os.fchown(fobj.fileno(), *owner)
+                os.fchmod(fobj.fileno(), mode)
+                fobj.write(self.dumps())
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
 
 class _CephAuth(object):
@@ -3438,6 +8414,9 @@ class _CephAuth(object):
             if etype not in ['mon', 'osd', 'mds', 'client']:
                 raise ValueError('Invalid entity type: {0}'.format(etype))
 
+        if key:
+            _CephKeyring.check_key(key)
+
         cfg = _CephConf(cluster)
 
         self.cluster = cfg.cluster
@@ -3462,187 +8441,110 @@ class _CephAuth(object):
 
         return cls(name, key, mon_caps, osd_caps, mds_caps, cluster)
 
-    @classmethod
-    def open_keyring(cls, keyring):
-        parser = ConfigParser.SafeConfigParser()
-
-        with _CephIniFile(keyring) as fobj:
-            parser.readfp(fobj)
-
-        return parser
-
-    @classmethod
-    def write_keyring(cls, parser, keyring):
-        with open(keyring, 'wb') as fobj:
-            parser.write(fobj)
-
-    @classmethod
-    def compare_keyring(cls, kr1, kr2):
-        parser1 = cls.open_keyring(kr1)
-        parser2 = cls.open_keyring(kr2)
-
-        sections1 = parser1.sections()
-        sections2 = parser2.sections()
+    def caps(self):
+        '''
+        Caps of the entity.
 
-        if set(sections1) != set(sections2):
-            return False
+        :return: A dict of daemon type -> caps, empty caps are omitted.
+        '''
+        caps = {}
+        if self.mon_caps:
+            caps['mon'] = self.mon_caps
+        if self.osd_caps:
+            caps['osd'] = self.osd_caps
+        if self.mds_caps:
+            caps['mds'] = self.mds_caps
 
-        for section in sections1:
-            if set(parser1.items(section)) != set(parser2.items(section)):
-                return False
+        return caps
 
-        return True
+    def compare_auth(self, entry):
+        '''
+        Compare the entity with an auth entry exported from the monitors.
 
-    @classmethod
-    def compare_key(cls, name, kr1, kr2):
-        parser1 = cls.open_keyring(kr1)
-        parser2 = cls.open_keyring(kr2)
+        :param entry: Auth entry, i.e. a dict with 'key' and 'caps'.
+        :return: (key_match, caps_match) 2-tuples.
+        '''
+        return (entry.get('key') == self.key,
+                entry.get('caps', {}) == self.caps())
 
-        key1 = parser1.get(name, 'key')
-        key2 = parser2.get(name, 'key')
+    def keyring(self):
+        '''
+        Keyring of the entity.
 
-        if key1 == key2:
-            return True
+        :return: _CephKeyring with the entity only.
+        '''
+        keyring = _CephKeyring()
+        keyring.set(self.name, self.key, self.caps())
 
-        return False
+        return keyring
 
+    @_traced('_CephAuth.gen_keyring')
     def gen_keyring(self, keyring):
-        if not os.path.exists(keyring):
-            with open(keyring, 'wb'):
-                pass
-
-        cmd = ['ceph-authtool']
-        cmd.append(keyring)
-        cmd.append('--name {0}'.format(self.name))
-        cmd.append('--add-key {0}'.format(self.key))
-        if self.mon_caps:
-            cmd.append('--cap mon "{0}"'.format(self.mon_caps))
-        if self.osd_caps:
-            cmd.append('--cap osd "{0}"'.format(self.osd_caps))
-        if self.mds_caps:
-            cmd.append('--cap mds "{0}"'.format(self.mds_caps))
-
-        _check_run(cmd)
+        kr = _CephKeyring.load(keyring)
+        kr.set(self.name, self.key, self.caps())
+        kr.write(keyring)
 
-    def auth(self, name, keyring):
-        tmpkr = ''
+    @_traced('_CephAuth.auth')
+    def auth(self, session):
         try:
-            (fd, tmpkr) = tempfile.mkstemp(prefix='kr.')
-            os.close(fd)
-
-            self.gen_keyring(tmpkr)
-
-            cmd = ['ceph']
-            cmd.append('--cluster {0}'.format(self.cluster))
-            cmd.append('--conf {0}'.format(self.conf))
-            cmd.append('--connect-timeout {0}'.format(CEPH_CONNECT_TIMEOUT))
-            cmd.append('--name {0}'.format(name))
-            cmd.append('--keyring {0}'.format(keyring))
-            cmd.append('--in-file {0}'.format(tmpkr))
-            cmd.append('auth')
-            cmd.append('add')
-            cmd.append(self.name)
-
-            _check_run(cmd)
+            session.check_command('auth add', self.keyring().dumps(),
+                                  entity=self.name)
         finally:
-            if os.path.exists(tmpkr):
-                os.remove(tmpkr)
-
-    def unauth(self, name, keyring):
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('--connect-timeout {0}'.format(CEPH_CONNECT_TIMEOUT))
-        cmd.append('--name {0}'.format(name))
-        cmd.append('--keyring {0}'.format(keyring))
-        cmd.append('auth')
-        cmd.append('del')
-        cmd.append(self.name)
+            session.auth_forget([self.name])
 
-        _check_run(cmd)
+    @_traced('_CephAuth.unauth')
+    def unauth(self, session):
+        try:
+            session.check_command('auth del', entity=self.name)
+        finally:
+            session.auth_forget([self.name])
 
-    def export_auth(self, okeyring, name, keyring):
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('--connect-timeout {0}'.format(CEPH_CONNECT_TIMEOUT))
-        cmd.append('--name {0}'.format(name))
-        cmd.append('--keyring {0}'.format(keyring))
-        cmd.append('--out-file {0}'.format(okeyring))
-        cmd.append('auth')
-        cmd.append('export')
-        cmd.append(self.name)
+    @_traced('_CephAuth.export_auth')
+    def export_auth(self, session):
+        '''
+        Export the auth entry of the entity from the monitors.
 
-        _check_run(cmd)
+        :param session: _CephMonSession of an admin entity.
+        :return: Auth entry, i.e. a dict with 'key' and 'caps', or None if
+                 the entity is not authenticated.
+        '''
+        return session.auth_get(self.name)
 
-    def update_caps(self, name, keyring,
+    @_traced('_CephAuth.update_caps')
+    def update_caps(self, session,
                     mon_caps='', osd_caps='', mds_caps=''):
         caps = []
         if mon_caps:
-            caps.append('mon "{0}"'.format(mon_caps))
+            caps.extend(['mon', mon_caps])
         if osd_caps:
-            caps.append('osd "{0}"'.format(osd_caps))
+            caps.extend(['osd', osd_caps])
         if mds_caps:
-            caps.append('mds "{0}"'.format(mds_caps))
+            caps.extend(['mds', mds_caps])
 
         if caps:
-            cmd = ['ceph']
-            cmd.append('--cluster {0}'.format(self.cluster))
-            cmd.append('--conf {0}'.format(self.conf))
-            cmd.append('--connect-timeout {0}'.format(CEPH_CONNECT_TIMEOUT))
-            cmd.append('--name {0}'.format(name))
-            cmd.append('--keyring {0}'.format(keyring))
-            cmd.append('auth')
-            cmd.append('caps')
-            cmd.append(self.name)
-            cmd.extend(caps)
-
-            _check_run(cmd)
+            try:
+                session.check_command('auth caps', entity=self.name,
+                                      caps=caps)
+            finally:
+                session.auth_forget([self.name])
         else:
-            self.unauth(name, keyring)
+            self.unauth(session)
 
             self.mon_caps = mon_caps
             self.osd_caps = osd_caps
             self.mds_caps = mds_caps
-            self.auth(name, keyring)
-
-    def is_authed(self, name, keyring):
-        cmd = ['ceph']
-        cmd.append('--cluster {0}'.format(self.cluster))
-        cmd.append('--conf {0}'.format(self.conf))
-        cmd.append('--connect-timeout {0}'.format(CEPH_CONNECT_TIMEOUT))
-        cmd.append('--name {0}'.format(name))
-        cmd.append('--keyring {0}'.format(keyring))
-        cmd.append('auth')
-        cmd.append('get')
-        cmd.append(self.name)
-
-        (code, _, stderr) = _run(cmd)
-
-        if code:
-            if code == errno.ENOENT:
-                return False
-            raise RuntimeError(cmd, stderr, code)
+            self.auth(session)
 
-        return True
+    @_traced('_CephAuth.is_authed')
+    def is_authed(self, session):
+        return self.export_auth(session) is not None
 
+    @_traced('_CephAuth.auth_by_key')
     def auth_by_key(self, name, key):
-        # construct an admin entity
-        adm = _CephAuth(name, key)
-
-        admkr = ''
-        try:
-            (fd, admkr) = tempfile.mkstemp(prefix='kr.')
-            os.close(fd)
-
-            adm.gen_keyring(admkr)
-
-            self.auth(name, admkr)
-        finally:
-            if os.path.exists(admkr):
-                os.remove(admkr)
+        self.auth(_CephMonSession.get(name, key, self.cluster))
 
 
+@_traced('keyring_manage')
 def keyring_manage(keyring,
                    entity_name,
                    entity_key,
@@ -3705,19 +8607,10 @@ def keyring_manage(keyring,
 
                     krchanges.append('A dir is here, remove')
             else:
-                parser = _CephAuth.open_keyring(keyring)
-
-                if parser.has_section(entity_name):
-                    fcont = parser.items(entity_name)
-                    cont = [('key', entity_key)]
-                    if mon_caps:
-                        cont.append(('caps mon', '"{0}"'.format(mon_caps)))
-                    if osd_caps:
-                        cont.append(('caps osd', '"{0}"'.format(osd_caps)))
-                    if mds_caps:
-                        cont.append(('caps mds', '"{0}"'.format(mds_caps)))
-
-                    if set(cont) == set(fcont):
+                entry = _CephKeyring.load(keyring).get(entity_name)
+
+                if entry is not None:
+                    if auth.compare_auth(entry) == (True, True):
                         ret['comment'] = 'Keyring already managed, skip'
                         return ret
 
@@ -3725,29 +8618,14 @@ def keyring_manage(keyring,
                 else:
                     add = True
 
-    # TODO: right?
-    if update:
-        cmd = ['ceph-authtool']
-        cmd.append(keyring)
-        cmd.append('--name {0}'.format(entity_name))
-        cmd.append('--add-key {0}'.format(entity_key))
-        if mon_caps:
-            cmd.append('--cap mon "{0}"'.format(mon_caps))
-        if osd_caps:
-            cmd.append('--cap osd "{0}"'.format(osd_caps))
-        if mds_caps:
-            cmd.append('--cap mds "{0}"'.format(mds_caps))
-
-        _check_run(cmd)
+    auth.gen_keyring(keyring)
 
+    if update:
         krchanges.append('Keyring updated')
+    elif add:
+        krchanges.append('Add entity to keyring')
     else:
-        auth.gen_keyring(keyring)
-
-        if add:
-            krchanges.append('Add entity to keyring')
-        else:
-            krchanges.append('Generate new keyring')
+        krchanges.append('Generate new keyring')
 
     # TODO: manage keyring file perms
 
@@ -3759,6 +8637,7 @@ def keyring_manage(keyring,
     return ret
 
 
+@_traced('keyring_unmanage')
 def keyring_unmanage(keyring,
                      name=''):
     ret = {
@@ -3782,12 +8661,11 @@ def keyring_unmanage(keyring,
         ret['changes'][keyring] = 'Remove keyring file'
         return ret
 
-    parser = _CephAuth.open_keyring(keyring)
+    kr = _CephKeyring.load(keyring)
 
-    if parser.has_section(name):
-        if len(parser.sections()) > 1:
-            parser.remove_section(name)
-            _CephAuth.write_keyring(parser, keyring)
+    if kr.remove(name):
+        if kr.names:
+            kr.write(keyring)
 
             ret['changes'][keyring] = 'Entity: {0} removed'.format(name)
             return ret
@@ -3802,6 +8680,7 @@ def keyring_unmanage(keyring,
     return ret
 
 
+@_traced('auth_manage')
 def auth_manage(entity_name,
                 entity_key,
                 admin_name,
@@ -3820,57 +8699,57 @@ def auth_manage(entity_name,
     changes = ret['changes']
     authchanges = []
 
-    admkr = ''
-    tmpkr = ''
-    ourkr = ''
+    fp = _CephFingerprint('auth_manage', entity_name, cluster,
+                          entity_key=entity_key, admin_name=admin_name,
+                          admin_key=admin_key, mon_caps=mon_caps,
+                          osd_caps=osd_caps, mds_caps=mds_caps)
 
-    try:
-        (fd, admkr) = tempfile.mkstemp(prefix='kr.')
-        os.close(fd)
+    def authed():
+        # an entity deleted or rekeyed out of band is not managed any more
+        session = _CephMonSession.get(admin_name, admin_key, cluster)
+        entry = session.auth_get(entity_name)
+        return entry is not None and entry['key'] == entity_key
 
-        adm = _CephAuth(admin_name, admin_key)
-        adm.gen_keyring(admkr)
+    if fp.check(authed):
+        ret['comment'] = 'Entity: {0} already managed, skip'\
+                         .format(entity_name)
+        return ret
 
-        (fd, ourkr) = tempfile.mkstemp(prefix='kr.')
-        os.close(fd)
+    auth = _CephAuth(entity_name, entity_key, mon_caps, osd_caps, mds_caps,
+                     cluster)
 
-        auth = _CephAuth(entity_name, entity_key, mon_caps, osd_caps, mds_caps)
-        auth.gen_keyring(ourkr)
+    session = _CephMonSession.get(admin_name, admin_key, cluster)
 
-        if auth.is_authed(admin_name, admkr):
-            (fd, tmpkr) = tempfile.mkstemp(prefix='kr.')
-            os.close(fd)
+    entry = auth.export_auth(session)
 
-            auth.export_auth(tmpkr, admin_name, admkr)
-            if _CephAuth.compare_keyring(tmpkr, ourkr):
-                ret['comment'] = 'Entity: {0} already managed, skip'\
-                                 .format(entity_name)
-                return ret
+    if entry is not None:
+        (key_match, caps_match) = auth.compare_auth(entry)
 
-            if _CephAuth.compare_key(entity_name, tmpkr, ourkr):
-                auth.update_caps(admin_name, admkr, mon_caps, osd_caps, mds_caps)
-                changes[entity_name] = 'Entity authenticated, update caps'
-                return ret
+        if key_match and caps_match:
+            fp.save()
+
+            ret['comment'] = 'Entity: {0} already managed, skip'\
+                             .format(entity_name)
+            return ret
 
-            # key not match
-            auth.unauth(admin_name, admkr)
-            authchanges.append('Del auth entity')
+        if key_match:
+            auth.update_caps(session, mon_caps, osd_caps, mds_caps)
+            changes[entity_name] = 'Entity authenticated, update caps'
+            return ret
 
-        auth.auth(admin_name, admkr)
-        authchanges.append('New auth entity')
-        changes[entity_name] = authchanges
-        ret['comment'] = 'New entity: {0} authenticated'.format(entity_name)
+        # key not match
+        auth.unauth(session)
+        authchanges.append('Del auth entity')
 
-        return ret
-    finally:
-        if os.path.exists(admkr):
-            os.remove(admkr)
-        if os.path.exists(tmpkr):
-            os.remove(tmpkr)
-        if os.path.exists(ourkr):
-            os.remove(ourkr)
+    auth.auth(session)
+    authchanges.append('New auth entity')
+    changes[entity_name] = authchanges
+    ret['comment'] = 'New entity: {0} authenticated'.format(entity_name)
+
+    return ret
 
 
+@_traced('auth_unmanage')
 def auth_unmanage(entity_name,
                   admin_name,
                   admin_key,
@@ -3884,30 +8763,134 @@ def auth_unmanage(entity_name,
 
     changes = ret['changes']
 
-    admkr = ''
+    _CephFingerprint('auth_manage', entity_name, cluster).clear()
+    _CephFingerprint.clear_all('auth_manage_batch')
 
-    try:
-        (fd, admkr) = tempfile.mkstemp(prefix='kr.')
-        os.close(fd)
+    auth = _CephAuth(entity_name, cluster=cluster)
+
+    session = _CephMonSession.get(admin_name, admin_key, cluster)
 
-        adm = _CephAuth(admin_name, admin_key)
-        adm.gen_keyring(admkr)
+    if auth.is_authed(session):
+        auth.unauth(session)
+        changes[entity_name] = 'Auth entity removed'
+        return ret
 
-        auth = _CephAuth(entity_name)
+    ret['comment'] = 'Entity: {0} does not exist, skip'.format(entity_name)
 
-        if auth.is_authed(admin_name, admkr):
-            auth.unauth(admin_name, admkr)
-            changes[entity_name] = 'Auth entity removed'
-            return ret
+    return ret
+
+
+@_traced('auth_manage_batch')
+def auth_manage_batch(entities,
+                      admin_name,
+                      admin_key,
+                      cluster=CEPH_CLUSTER):
+    '''
+    Manage a batch of auth entities.
+
+    The auth database is fetched once, entities are compared with it in
+    memory, then all new and changed entities are imported at once.
+
+    :param entities: A dict of entity name -> a dict of key, mon_caps,
+                     osd_caps and mds_caps, key is required.
+    :param admin_name: Entity to authenticate as.
+    :param admin_key: Key of the admin entity.
+    :param cluster: Cluster name.
+    :return: Salt state return with changes of all entities.
+    '''
+    ret = {
+        'name': cluster,
+        'result': True,
+        'comment': 'Auth batch: {0} entity(s) managed'
+                   .format(len(entities or {})),
+        'changes': {}
+    }
+
+    if entities is None:
+        entities = {}
+    if not isinstance(entities, dict):
+        raise ValueError('entities must be a dict type')
+
+    changes = ret['changes']
+
+    auths = []
+    for name, ent in sorted(entities.iteritems()):
+        ent = ent or {}
+        if not isinstance(ent, dict):
+            raise ValueError('Entity: {0} must be a dict type'.format(name))
+
+        # auth_manage requires a key too, an empty one fails the import
+        if not ent.get('key'):
+            raise ValueError('Entity: {0} has no key'.format(name))
+
+        auths.append(_CephAuth(name, ent['key'],
+                               ent.get('mon_caps', ''),
+                               ent.get('osd_caps', ''),
+                               ent.get('mds_caps', ''),
+                               cluster))
+
+    fp = _CephFingerprint('auth_manage_batch',
+                          ','.join(x.name for x in auths), cluster,
+                          entities=entities, admin_name=admin_name,
+                          admin_key=admin_key)
+
+    def authed():
+        # one 'auth list' tells if any entity was deleted out of band
+        session = _CephMonSession.get(admin_name, admin_key, cluster)
+        names = set(session.auth_list().names)
+        return all(x.name in names for x in auths)
+
+    if fp.check(authed):
+        ret['comment'] = 'Auth batch: all entity(s) already managed, skip'
+        return ret
+
+    session = _CephMonSession.get(admin_name, admin_key, cluster)
 
-        ret['comment'] = 'Entity: {0} does not exist, skip'.format(entity_name)
+    exported = session.auth_list()
 
+    pending = []
+    for auth in auths:
+        entry = exported.get(auth.name)
+
+        if entry is None:
+            pending.append(auth)
+            changes[auth.name] = ['New auth entity']
+            continue
+
+        (key_match, caps_match) = auth.compare_auth(entry)
+
+        if key_match and caps_match:
+            continue
+
+        pending.append(auth)
+        if key_match:
+            changes[auth.name] = 'Entity authenticated, update caps'
+        else:
+            # import replaces the key of an existing entity
+            changes[auth.name] = ['Del auth entity', 'New auth entity']
+
+    if not pending:
+        fp.save()
+
+        ret['comment'] = 'Auth batch: all entity(s) already managed, skip'
         return ret
+
+    kr = _CephKeyring()
+    for auth in pending:
+        kr.set(auth.name, auth.key, auth.caps())
+
+    try:
+        session.check_command('auth import', kr.dumps())
     finally:
-        if os.path.exists(admkr):
-            os.remove(admkr)
+        session.auth_forget([x.name for x in pending])
+
+    ret['comment'] = 'Auth batch: {0} of {1} entity(s) updated'.format(
+        len(pending), len(auths))
+
+    return ret
 
 
+@_traced('conf_manage')
 def conf_manage(ctx,
                 cluster=CEPH_CLUSTER):
     ret = {
@@ -3920,6 +8903,7 @@ def conf_manage(ctx,
     changes = ret['changes']
     filechanges = []
     cfgchanges = {}
+    livechanges = {}    # section -> keys to push to running daemons
 
     if ctx is None:
         raise ValueError('Ctx must not be None')
@@ -3967,84 +8951,138 @@ def conf_manage(ctx,
         with open(conf, 'wb'):
             pass
 
-    parser = cfg.open()
-
-    # sections in input dict
-    sections = ctx.keys()
-    # sections already exists in ceph.conf
-    fsections = parser.sections()
-
-    add = set(sections)
-    remove = set(fsections)
-
-    sec_remain = add & remove
-    sec_add = add - remove
+    doc = cfg.open()
 
-    # if we remove existing sections then our newly added MON section
-    # will be removed
-    # sec_remove = remove - add
+    # existing sections not in input dict are kept, or our newly added MON
+    # section will be removed
 
-    # for sec in sec_remove:
-    #     fopts = parser.items(sec)
-    #
-    #     parser.remove_section(sec)
-    #
-    #     cfgchanges[sec] = []
-    #     cfgchanges[sec].append('Remove section: {0}'.format(sec))
-    #
-    #     for opt, val in fopts:
-    #         cfgchanges[sec].append('Remove option: {opt} = {val}'.format(
-    #             opt=opt, val=val))
+    # global first, so a new file reads as usual
+    for sec in sorted(ctx, key=lambda x: (x != 'global', x)):
+        opts = ctx[sec].items()
 
-    for sec in sec_add:
-        parser.add_section(sec)
+        if not doc.has_section(sec):
+            doc.add_section(sec)
 
-        cfgchanges[sec] = []
-        cfgchanges[sec].append('New section: {0}'.format(sec))
+            cfgchanges[sec] = []
+            cfgchanges[sec].append('New section: {0}'.format(sec))
 
-        opts = ctx[sec].items()
+            for opt, val in sorted(opts):
+                doc.set(sec, opt, val)
+                cfgchanges[sec].append('New option: {opt} = {val}'.format(
+                    opt=opt, val=val))
+            livechanges[sec] = [opt for opt, _ in opts]
+            continue
 
-        for opt, val in opts:
-            # SafeConfigParser only accepts str type
-            parser.set(sec, opt, str(val))
-            cfgchanges[sec].append('New option: {opt} = {val}'.format(
-                opt=opt, val=val))
+        # normalized key -> (key, value), values in ceph.conf are strings
+        want = dict((_CephConf.normalize_key(opt), (opt, str(val)))
+                    for opt, val in opts)
+        have = dict((_CephConf.normalize_key(opt), (opt, val))
+                    for opt, val in doc.items(sec))
 
-    for sec in sec_remain:
-        # a list of (opt, value) tuples
-        opts = ctx[sec].items()
-        fopts = parser.items(sec)
+        sectionchanges = []
 
-        add = set(opts)
-        remove = set(fopts)
+        for key in sorted(set(have) - set(want)):
+            (opt, val) = have[key]
+            doc.remove_option(sec, opt)
 
-        if add != remove:
-            opts_add = add - remove
-            opts_remove = remove - add
+            sectionchanges.append('Remove option: {opt} = {val}'.format(
+                opt=opt, val=val)
+            )
+            livechanges.setdefault(sec, []).append(opt)
 
-            sectionchanges = []
+        for key in sorted(want):
+            (opt, val) = want[key]
 
-            for opt, val in opts_remove:
-                parser.remove_option(sec, opt)
+            if key in have:
+                (fopt, fval) = have[key]
+                if fval == val:
+                    continue
 
                 sectionchanges.append('Remove option: {opt} = {val}'.format(
-                    opt=opt, val=val)
+                    opt=fopt, val=fval)
                 )
 
-            for opt, val in opts_add:
-                parser.set(sec, opt, str(val))
+            # an existing line of the key is updated in place
+            doc.set(sec, opt, val)
 
-                sectionchanges.append('New option: {opt} = {val}'.format(
-                    opt=opt, val=val)
-                )
+            sectionchanges.append('New option: {opt} = {val}'.format(
+                opt=opt, val=val)
+            )
+            livechanges.setdefault(sec, []).append(opt)
+
+        if sectionchanges:
+            cfgchanges[sec] = sectionchanges
 
-            if sectionchanges:
-                cfgchanges[sec] = sectionchanges
+    live = _CephConfLive(cluster)
 
     if cfgchanges:
         changes[conf] = cfgchanges
         cfg.write()
+
+        # running daemons get the new values now, or wait for a restart
+        (applied, restart) = live.apply(livechanges)
+        if applied:
+            changes['applied'] = applied
+        if restart:
+            changes['restart_required'] = restart
     else:
         ret['comment'] = 'ceph conf for: {0} is already managed, skip'.format(cluster)
 
+    pending = live.pending()
+    if pending:
+        ret['comment'] += ', restart needed to apply: {0}'.format(
+            '; '.join('{0} ({1})'.format(name, ', '.join(keys))
+                      for name, keys in sorted(pending.iteritems())))
+
     return ret
+
+
+@_traced('conf_pending_restart', record=False)
+def conf_pending_restart(cluster=CEPH_CLUSTER):
+    '''
+    Get ceph.conf options changed by conf_manage which running daemons on
+    this host could not apply, i.e. daemons to restart.
+
+    :param cluster: Cluster name.
+    :return: A dict of daemon name -> list of option keys.
+    '''
+    return _CephConfLive(cluster).pending()
+
+
+def trace_last(slowest=0):
+    '''
+    Get the external commands run by the traced calls of the last job on
+    this minion, e.g. all ceph_deploy states run by the last highstate.
+    Cheap queries, e.g. mon_running, are not traced.
+
+    Set the ceph_deploy.trace config option to True to also attach the trace
+    to the return of each state.
+
+    :param slowest: Only return this many slowest commands of each call if
+    not 0.
+    :return: A list of traces, oldest first, each trace has operation, job,
+    started, elapsed, commands, dropped and records, each record has
+    operation, argv, started, elapsed, code, timed_out, stdout_bytes and
+    stderr_bytes, or an empty list if nothing traced.
+    '''
+    traces = _CephTrace.load()
+
+    if not traces:
+        return []
+
+    # the traces of the last job are the last ones of its process
+    job = traces[-1].get('job')
+
+    last = []
+    for trace in reversed(traces):
+        if trace.get('job') != job:
+            break
+        last.insert(0, trace)
+
+    if slowest:
+        for trace in last:
+            records = sorted(trace['records'], key=lambda r: r['elapsed'],
+                             reverse=True)
+            trace['records'] = records[:int(slowest)]
+
+    return last
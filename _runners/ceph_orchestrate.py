@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+'''
+Orchestrate ceph cluster deployment from the master.
+
+Hosts are taken from the roles in the ceph pillar, e.g.
+
+    ceph:
+      roles:
+        mon: [ceph1, ceph2, ceph3]
+        osd: [ceph1, ceph2, ceph3]
+        client: [ceph0]
+'''
+
+# Import python libs
+from __future__ import absolute_import
+import threading
+import time
+
+# Import salt libs
+import salt.client
+import salt.pillar
+
+CEPH_CLUSTER = 'ceph'                   # Default cluster name
+
+STATE_TIMEOUT = 3600                    # 1 hour per wave
+OSD_WAVE_SIZE = 10                      # Default OSD hosts per wave
+OSD_FAILURE_BUDGET = 0                  # Default failed OSD hosts tolerated
+CLIENT_MIN_OSD_HOSTS = 1                # OSD hosts done to set up clients
+OSD_ROLLING_TIMEOUT = 900               # 15 minutes per restart step
+STATUS_TIMEOUT = 60                     # 1 minute to query a host
+
+
+def _ceph_pillar():
+    # the pillar minions get, the top file matches all hosts
+    pillar = salt.pillar.get_pillar(__opts__, {}, __opts__['id'],
+                                    __opts__.get('environment') or 'base')
+
+    return pillar.compile_pillar().get('ceph', {})
+
+
+def _roles(roles):
+    if roles is None:
+        roles = _ceph_pillar().get('roles', {})
+
+    return dict((role, list(roles.get(role) or []))
+                for role in ('mon', 'osd', 'client'))
+
+
+def _failure(ret):
+    '''
+    Check the return of a state run or a ceph_deploy function on a host.
+
+    :return: None if succeeded, or why it failed.
+    '''
+    if ret is None:
+        return 'no response'
+
+    # a list is returned if the sls failed to render
+    if not isinstance(ret, dict):
+        return ret
+
+    # a ceph_deploy function returns a single state return
+    if 'result' in ret and 'comment' in ret:
+        return None if ret['result'] else ret['comment']
+
+    comments = [x.get('comment') for x in ret.itervalues()
+                if isinstance(x, dict) and x.get('result') is False]
+
+    return comments or None
+
+
+class _Wave(object):
+    '''
+    A set of hosts running the same function concurrently, e.g. state.sls.
+    '''
+    def __init__(self, name, hosts, fun, arg=(), timeout=STATE_TIMEOUT):
+        super(_Wave, self).__init__()
+
+        self.name = name
+        self.hosts = hosts
+        self.fun = fun
+        self.arg = list(arg)
+        self.timeout = timeout
+
+        self.started = None
+        self.elapsed = None
+        self.succeeded = []
+        self.failed = []
+        self.errors = {}        # host -> why it failed
+
+    @classmethod
+    def state(cls, name, hosts, sls, timeout=STATE_TIMEOUT):
+        return cls(name, hosts, 'state.sls', [sls], timeout)
+
+    def run(self):
+        '''
+        Run on all hosts of the wave and wait for all of them.
+
+        :return: True if succeeded on all hosts.
+        '''
+        self.started = started = time.time()
+
+        # one client per wave, waves may run in different threads
+        client = salt.client.LocalClient(__opts__['conf_file'])
+        rets = client.cmd(self.hosts, self.fun, self.arg,
+                          timeout=self.timeout, expr_form='list')
+
+        for host in self.hosts:
+            error = _failure(rets.get(host))
+            if error is None:
+                self.succeeded.append(host)
+            else:
+                self.failed.append(host)
+                self.errors[host] = error
+
+        self.elapsed = round(time.time() - started, 3)
+
+        return not self.failed
+
+    def report(self):
+        return {
+            'name': self.name,
+            'run': ' '.join([self.fun] + [str(x) for x in self.arg]),
+            'hosts': self.hosts,
+            'started': self.started,
+            'elapsed': self.elapsed,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+def _mon_waves(hosts, timeout=STATE_TIMEOUT):
+    # MON stores are made everywhere before any MON starts, ceph.mon then
+    # starts all MONs at about the same time and waits for the quorum by
+    # the ceph.mon.quorum state, mon_prepare reads the options from the
+    # pillar of each MON host, e.g. its own mon_addr
+    return [
+        _Wave.state('mon.conf', hosts, 'ceph.conf', timeout),
+        _Wave('mon.prepare', hosts, 'ceph_deploy.mon_prepare', (), timeout),
+        _Wave.state('mon', hosts, 'ceph.mon', timeout),
+    ]
+
+
+def mon_bootstrap(hosts=None,
+                  timeout=STATE_TIMEOUT):
+    '''
+    Bring up the initial MONs together: ceph.conf and MON stores are set up
+    on all MON hosts concurrently, then ceph.mon starts all MONs at once and
+    each MON waits for the quorum, polling mon_status with exponential
+    backoff, see ceph_deploy.mon_wait_quorum.
+
+    :param hosts: MON hosts, default is ceph:roles:mon in the pillar.
+    :param timeout: Max seconds a wave runs.
+    :return: A dict of result, elapsed and waves, each wave has name, run,
+    hosts, started, elapsed, failed and errors, errors of the mon wave tell
+    which MONs are out of quorum if the quorum can not form.
+    '''
+    started = time.time()
+
+    if hosts is None:
+        hosts = _roles(None)['mon']
+
+    waves = []
+    result = True
+
+    for wave in _mon_waves(hosts, timeout):
+        waves.append(wave)
+        if not wave.run():
+            result = False
+            break
+
+    return {
+        'result': result,
+        'elapsed': round(time.time() - started, 3),
+        'waves': [x.report() for x in waves],
+    }
+
+
+def deploy(roles=None,
+           osd_wave_size=None,
+           osd_failure_budget=None,
+           client_min_osd_hosts=None,
+           timeout=STATE_TIMEOUT):
+    '''
+    Deploy a cluster in waves: all MONs at once, see mon_bootstrap, OSD
+    hosts wave by wave, clients as soon as the MONs and enough OSD hosts are
+    done, while the remaining OSD waves go on.
+
+    Options not given are read from ceph:orchestrate in the pillar, i.e.
+    osd_wave_size, osd_failure_budget and client_min_osd_hosts.
+
+    :param roles: A dict of mon, osd, client -> list of hosts, default is
+    ceph:roles in the pillar.
+    :param osd_wave_size: Number of OSD hosts in a wave.
+    :param osd_failure_budget: Number of failed OSD hosts tolerated before
+    the remaining waves are cancelled.
+    :param client_min_osd_hosts: Number of OSD hosts done before clients
+    are set up.
+    :param timeout: Max seconds a wave runs.
+    :return: A dict of result, elapsed and waves, each wave has name, run,
+    hosts, started, elapsed, failed and errors.
+    '''
+    started = time.time()
+
+    opts = _ceph_pillar().get('orchestrate', {}) if None in (
+        osd_wave_size, osd_failure_budget, client_min_osd_hosts) else {}
+
+    if osd_wave_size is None:
+        osd_wave_size = opts.get('osd_wave_size', OSD_WAVE_SIZE)
+    if osd_failure_budget is None:
+        osd_failure_budget = opts.get('osd_failure_budget', OSD_FAILURE_BUDGET)
+    if client_min_osd_hosts is None:
+        client_min_osd_hosts = opts.get('client_min_osd_hosts',
+                                        CLIENT_MIN_OSD_HOSTS)
+
+    osd_wave_size = max(int(osd_wave_size), 1)
+
+    roles = _roles(roles)
+
+    waves = []
+    result = True
+
+    # MONs first, everything else needs the quorum
+    if roles['mon']:
+        for wave in _mon_waves(roles['mon'], timeout):
+            waves.append(wave)
+            if not wave.run():
+                break
+
+        if waves[-1].failed:
+            return {
+                'result': False,
+                'elapsed': round(time.time() - started, 3),
+                'waves': [x.report() for x in waves],
+            }
+
+    osd_hosts = roles['osd']
+    client_min_osd_hosts = min(int(client_min_osd_hosts), len(osd_hosts))
+
+    # clients start from another thread once enough OSD hosts are done
+    ready = threading.Event()
+    cancelled = []
+
+    client = None
+    if roles['client']:
+        client = _Wave.state('client', roles['client'], 'ceph.admin',
+                             timeout)
+
+    def run_client():
+        ready.wait()
+        if not cancelled:
+            client.run()
+
+    thread = None
+    if client is not None:
+        thread = threading.Thread(target=run_client)
+        thread.daemon = True
+        thread.start()
+
+    if client_min_osd_hosts == 0:
+        ready.set()
+
+    succeeded = 0
+    failed = 0
+
+    for i in xrange(0, len(osd_hosts), osd_wave_size):
+        if failed > osd_failure_budget:
+            # out of budget, remaining waves are cancelled
+            result = False
+            break
+
+        wave = _Wave.state('osd.{0}'.format(i // osd_wave_size),
+                           osd_hosts[i:i + osd_wave_size], 'ceph.osd',
+                           timeout)
+        waves.append(wave)
+        wave.run()
+
+        succeeded += len(wave.succeeded)
+        failed += len(wave.failed)
+
+        if succeeded >= client_min_osd_hosts:
+            ready.set()
+
+    if failed > osd_failure_budget:
+        result = False
+
+    if not ready.is_set():
+        # not enough OSD hosts, clients are not set up
+        cancelled.append(True)
+        ready.set()
+        result = False
+
+    if thread is not None:
+        thread.join()
+        if client.elapsed is not None:
+            waves.append(client)
+            if client.failed:
+                result = False
+
+    return {
+        'result': result,
+        'elapsed': round(time.time() - started, 3),
+        'waves': [x.report() for x in sorted(waves, key=lambda x: x.started)],
+    }
+
+
+def _restart_timeout(client, host, parallel, timeout, cluster):
+    '''
+    Max seconds a rolling restart of the OSDs on a host may take, i.e. one
+    wait for the cluster to be clean plus one wait per restart step.
+    '''
+    status = client.cmd(host, 'ceph_deploy.osd_status', [cluster],
+                        timeout=STATUS_TIMEOUT).get(host)
+
+    count = 0
+    if isinstance(status, dict):
+        count = len([x for x in status.itervalues()
+                     if isinstance(x, dict) and x.get('running')])
+
+    parallel = max(int(parallel), 1)
+    steps = (count + parallel - 1) // parallel
+
+    return (steps + 1) * int(timeout) + STATUS_TIMEOUT
+
+
+def osd_rolling_restart(hosts=None,
+                        parallel=1,
+                        timeout=OSD_ROLLING_TIMEOUT,
+                        cluster=CEPH_CLUSTER):
+    '''
+    Restart OSDs of the whole cluster host by host, see
+    ceph_deploy.osd_rolling_restart, stops at the first host failed.
+
+    :param hosts: OSD hosts, default is ceph:roles:osd in the pillar.
+    :param parallel: Number of OSDs restarted at a time on a host.
+    :param timeout: Max seconds to wait for each step to become healthy.
+    :param cluster: Cluster name.
+    :return: A dict of result and hosts, each host has elapsed and the
+    return of ceph_deploy.osd_rolling_restart.
+    '''
+    if hosts is None:
+        hosts = _roles(None)['osd']
+
+    client = salt.client.LocalClient(__opts__['conf_file'])
+
+    ret = {'result': True, 'hosts': {}}
+
+    for host in hosts:
+        started = time.time()
+
+        # a host may restart many OSDs, each step waits up to timeout, the
+        # client must not give up while the minion job goes on
+        r = client.cmd(host, 'ceph_deploy.osd_rolling_restart',
+                       [None, cluster, parallel, timeout],
+                       timeout=_restart_timeout(client, host, parallel,
+                                                timeout, cluster)).get(host)
+
+        ret['hosts'][host] = {
+            'elapsed': round(time.time() - started, 3),
+            'return': r,
+        }
+
+        if not isinstance(r, dict) or not r.get('result'):
+            ret['result'] = False
+            break
+
+    return ret
@@ -58,3 +58,15 @@ def auth_absent(name,
     return __salt__['ceph_deploy.auth_unmanage'](name,
                                                  admin_name, admin_key,
                                                  cluster)
+
+
+def auth_set(name,
+             entities,
+             admin_name,
+             admin_key,
+             cluster=CEPH_CLUSTER):
+    ret = __salt__['ceph_deploy.auth_manage_batch'](entities,
+                                                    admin_name, admin_key,
+                                                    cluster)
+    ret['name'] = name
+    return ret
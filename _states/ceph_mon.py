@@ -8,6 +8,7 @@ author: runsisi AT hust.edu.cn
 __virtualname__ = 'ceph_mon'
 
 CEPH_CLUSTER = 'ceph'                   # Default cluster name
+MON_QUORUM_TIMEOUT = 300                # 5 minutes
 
 def __virtual__():
     '''
@@ -40,6 +41,12 @@ def absent(name,
                                                 mon_addr, cluster)
 
 
+def quorum(name,
+           cluster=CEPH_CLUSTER,
+           timeout=MON_QUORUM_TIMEOUT):
+    return __salt__['ceph_deploy.mon_wait_quorum'](name, cluster, timeout)
+
+
 def running(name,
             cluster=CEPH_CLUSTER):
     ret = {
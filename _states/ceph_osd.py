@@ -8,6 +8,10 @@ author: runsisi AT hust.edu.cn
 __virtualname__ = 'ceph_osd'
 
 CEPH_CLUSTER = 'ceph'                   # Default cluster name
+OSD_BATCH_WORKERS = 8                   # Default workers of OSD batch
+OSD_ROLLING_TIMEOUT = 900               # 15 minutes per restart step
+CRUSH_RAMP_STEP = 0.1                   # Fraction of target weight per step
+CRUSH_RAMP_MAX_RECOVERING = 10          # Max PGs recovering to step on
 
 
 def __virtual__():
@@ -25,11 +29,98 @@ def _error(ret, msg):
 
 def present(name,
             journal='',
-            cluster=CEPH_CLUSTER):
-    return __salt__['ceph_deploy.osd_manage'](name, journal, cluster)
+            cluster=CEPH_CLUSTER,
+            initial_weight=None):
+    return __salt__['ceph_deploy.osd_manage'](name, journal, cluster,
+                                              initial_weight)
 
 
 def absent(name,
            journal='',
            cluster=CEPH_CLUSTER):
     return __salt__['ceph_deploy.osd_unmanage'](name, journal, cluster)
+
+
+def batch_present(name,
+                  osds=None,
+                  cluster=CEPH_CLUSTER,
+                  max_workers=OSD_BATCH_WORKERS,
+                  initial_weight=None,
+                  maintenance=False):
+    ret = __salt__['ceph_deploy.osd_manage_batch'](osds, cluster, max_workers,
+                                                   initial_weight, maintenance)
+    ret['name'] = name
+    return ret
+
+
+def batch_absent(name,
+                 osds=None,
+                 cluster=CEPH_CLUSTER,
+                 max_workers=OSD_BATCH_WORKERS,
+                 maintenance=True):
+    ret = __salt__['ceph_deploy.osd_unmanage_batch'](osds, cluster,
+                                                     max_workers, maintenance)
+    ret['name'] = name
+    return ret
+
+
+def crush_ramp(name,
+               osds=None,
+               cluster=CEPH_CLUSTER,
+               step=CRUSH_RAMP_STEP,
+               max_recovering=CRUSH_RAMP_MAX_RECOVERING):
+    ret = __salt__['ceph_deploy.osd_crush_ramp'](osds, cluster, step,
+                                                 max_recovering)
+    ret['name'] = name
+    return ret
+
+
+def rolling_restart(name,
+                    osds=None,
+                    cluster=CEPH_CLUSTER,
+                    parallel=1,
+                    timeout=OSD_ROLLING_TIMEOUT):
+    ret = {
+        'name': name,
+        'result': True,
+        'comment': 'No OSD waits for a restart',
+        'changes': {}
+    }
+
+    # only OSDs which could not apply ceph.conf changes at runtime
+    pending = __salt__['ceph_deploy.conf_pending_restart'](cluster)
+
+    targets = [int(x.split('.', 1)[1]) for x in pending
+               if x.startswith('osd.')]
+    if osds is not None:
+        targets = [x for x in targets if x in [int(y) for y in osds]]
+
+    if not targets:
+        return ret
+
+    ret = __salt__['ceph_deploy.osd_rolling_restart'](targets, cluster,
+                                                      parallel, timeout)
+    ret['name'] = name
+    return ret
+
+
+def mod_watch(name,
+              sfun=None,
+              **kwargs):
+    ret = {
+        'name': name,
+        'result': True,
+        'comment': '',
+        'changes': {}
+    }
+
+    if sfun != 'rolling_restart':
+        return _error(ret, 'watch requisite is not '
+                           'implemented for {0}'.format(sfun))
+
+    # changes applied at runtime leave no OSD to restart
+    return rolling_restart(name,
+                           kwargs.get('osds'),
+                           kwargs.get('cluster', CEPH_CLUSTER),
+                           kwargs.get('parallel', 1),
+                           kwargs.get('timeout', OSD_ROLLING_TIMEOUT))
@@ -48,6 +48,7 @@ cp -r $CWD/reactor/ $SALTDIR
 cp -r $CWD/ceph/ $SALTDIR
 cp -r $CWD/_modules/ $SALTDIR
 cp -r $CWD/_states/ $SALTDIR
+cp -r $CWD/_runners/ $SALTDIR
 
 # copy pillars
 
@@ -0,0 +1,1101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Offline benchmark of the ceph_deploy execution module.
+
+Runs conf_manage, mon_manage, osd_manage and osd_manage_batch of
+_modules/ceph_deploy.py in-process against a fake host, no real disks and no
+live cluster needed:
+
+ - disks are sparse image files under a private root dir, seen by the module
+   as /dev/sdX block devices, sysfs, /proc/mounts and /dev/disk/by-partuuid
+   are generated from an in-memory partition table model;
+ - external commands (sgdisk, parted, lsblk, blkid, partprobe, mkfs, mount,
+   umount, xfs_db, debugfs, ceph-disk, ceph, ceph-conf, ceph-mon,
+   ceph-authtool, /etc/init.d/ceph) are served by scripted fakes that keep
+   the model up to date;
+ - running daemons listen on their admin sockets under the fake root.
+
+For every operation and fleet size the wall time, the number of command
+invocations (per program) and the number of mounts are reported.
+
+Usage:
+
+    python test/bench.py [--disks 1,12,36,90] [--journal-disks N]
+                         [--latency MS] [--workers N] [--json]
+
+salt must be importable, the module is not loaded by the salt loader though.
+TMPDIR must not contain digits, as partition paths are parsed as
+<disk><num>.
+'''
+
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import imp
+import stat
+import json
+import time
+import uuid
+import errno
+import random
+import string
+import shutil
+import socket
+import tempfile
+import optparse
+import threading
+import ConfigParser
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, '_modules', 'ceph_deploy.py')
+
+OSD_UUID = '4fbd7e29-9d25-41b8-afd0-062c0ceff05d'
+JOURNAL_UUID = '45b0969e-9b03-4f30-b4c6-b4b80ceff106'
+
+DISK_SIZE = 4 * 1024 * 1024         # 4TB, in MB
+JOURNAL_SIZE = 5120                 # in MB
+
+# paths the module sees are mapped under the fake root
+VIRTUAL_PREFIXES = ('/dev', '/sys', '/proc', '/etc/ceph', '/var/lib/ceph',
+                    '/var/run/ceph')
+
+FAKE_PROGRAMS = ('lsblk', 'blkid', 'sgdisk', 'parted', 'partprobe', 'mkfs',
+                 'mount', 'umount', 'xfs_db', 'debugfs', 'ceph-disk', 'ceph',
+                 'ceph-conf', 'ceph-mon', 'ceph-authtool', '/etc/init.d/ceph',
+                 'partx', 'udevadm')
+
+
+class _FakeRoot(object):
+    def __init__(self, root):
+        self.root = root
+
+    def real(self, path):
+        if path is None or not os.path.isabs(path):
+            return path
+        if path == self.root or path.startswith(self.root + '/'):
+            return path
+        for prefix in VIRTUAL_PREFIXES:
+            if path == prefix or path.startswith(prefix + '/'):
+                return self.root + path
+        return path
+
+    def virtual(self, path):
+        if path.startswith(self.root + '/'):
+            vpath = path[len(self.root):]
+            for prefix in VIRTUAL_PREFIXES:
+                if vpath == prefix or vpath.startswith(prefix + '/'):
+                    return vpath
+        return path
+
+
+class _FakePath(object):
+    def __init__(self, root):
+        self.__root = root
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
+
+    def exists(self, path):
+        return os.path.exists(self.__root.real(path))
+
+    def lexists(self, path):
+        return os.path.lexists(self.__root.real(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self.__root.real(path))
+
+    def isfile(self, path):
+        return os.path.isfile(self.__root.real(path))
+
+    def islink(self, path):
+        return os.path.islink(self.__root.real(path))
+
+    def getsize(self, path):
+        return os.path.getsize(self.__root.real(path))
+
+    def realpath(self, path):
+        return self.__root.virtual(os.path.realpath(self.__root.real(path)))
+
+
+class _FakeOs(object):
+    '''
+    The os module as seen by ceph_deploy, image files under /dev are block
+    devices.
+    '''
+    def __init__(self, root):
+        self.__root = root
+        self.path = _FakePath(root)
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def stat(self, path):
+        rpath = self.__root.real(path)
+        st = os.stat(rpath)
+        if rpath.startswith(self.__root.root + '/dev/') \
+                and stat.S_ISREG(st.st_mode):
+            fields = list(st[:10])
+            fields[0] = stat.S_IFBLK | 0660
+            st = os.stat_result(fields)
+        return st
+
+    def lstat(self, path):
+        return os.lstat(self.__root.real(path))
+
+    def listdir(self, path):
+        return os.listdir(self.__root.real(path))
+
+    def remove(self, path):
+        return os.remove(self.__root.real(path))
+
+    unlink = remove
+
+    def rmdir(self, path):
+        return os.rmdir(self.__root.real(path))
+
+    def mkdir(self, path, mode=0777):
+        return os.mkdir(self.__root.real(path), mode)
+
+    def makedirs(self, path, mode=0777):
+        return os.makedirs(self.__root.real(path), mode)
+
+    def rename(self, src, dst):
+        return os.rename(self.__root.real(src), self.__root.real(dst))
+
+    def chmod(self, path, mode):
+        return os.chmod(self.__root.real(path), mode)
+
+    def open(self, path, flags, mode=0777):
+        return os.open(self.__root.real(path), flags, mode)
+
+
+class _FakeTempfile(object):
+    def __init__(self, root):
+        self.__root = root
+
+    def __getattr__(self, name):
+        return getattr(tempfile, name)
+
+    def mkstemp(self, suffix='', prefix='tmp', dir=None):
+        (fd, path) = tempfile.mkstemp(suffix, prefix, self.__root.real(dir))
+        return fd, self.__root.virtual(path)
+
+    def mkdtemp(self, suffix='', prefix='tmp', dir=None):
+        path = tempfile.mkdtemp(suffix, prefix, self.__root.real(dir))
+        return self.__root.virtual(path)
+
+
+class _FakeShutil(object):
+    def __init__(self, root):
+        self.__root = root
+
+    def __getattr__(self, name):
+        return getattr(shutil, name)
+
+    def rmtree(self, path, *args, **kwargs):
+        return shutil.rmtree(self.__root.real(path), *args, **kwargs)
+
+    def move(self, src, dst):
+        return shutil.move(self.__root.real(src), self.__root.real(dst))
+
+
+class _FakeSocket(object):
+    def __init__(self, root, sock):
+        self.__root = root
+        self.__sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self.__sock, name)
+
+    def connect(self, address):
+        if self.__sock.family == socket.AF_UNIX:
+            address = self.__root.real(address)
+        return self.__sock.connect(address)
+
+
+class _FakeSocketModule(object):
+    '''
+    The socket module as seen by ceph_deploy, admin sockets are under the
+    fake root.
+    '''
+    def __init__(self, root):
+        self.__root = root
+
+    def __getattr__(self, name):
+        return getattr(socket, name)
+
+    def socket(self, *args):
+        return _FakeSocket(self.__root, socket.socket(*args))
+
+
+class _FakeUtils(object):
+    def __init__(self, utils):
+        self.__utils = utils
+
+    def __getattr__(self, name):
+        return getattr(self.__utils, name)
+
+    def which(self, name):
+        return name if name in FAKE_PROGRAMS else None
+
+
+class _FakePipe(object):
+    def __init__(self, done):
+        self.__done = done
+        self.__lines = []
+
+    def feed(self, data):
+        self.__lines = data.splitlines(True)
+
+    def readline(self):
+        self.__done.wait()
+        return self.__lines.pop(0) if self.__lines else ''
+
+    def close(self):
+        pass
+
+
+class _FakeStdin(object):
+    def __init__(self, proc):
+        self.__proc = proc
+        self.__data = []
+
+    def write(self, data):
+        self.__data.append(data)
+
+    def close(self):
+        self.__proc.run(''.join(self.__data))
+
+
+class _FakePopen(object):
+    '''
+    A process served by the fake host, it runs when its stdin is closed.
+    '''
+    def __init__(self, host, argv, **kwargs):
+        self.host = host
+        self.argv = argv
+        self.pid = 0
+        self.returncode = None
+
+        self.__done = threading.Event()
+        self.stdin = _FakeStdin(self)
+        self.stdout = _FakePipe(self.__done)
+        self.stderr = _FakePipe(self.__done)
+
+    def run(self, data):
+        try:
+            (code, out, err) = self.host.run(self.argv, data)
+        except Exception as e:
+            (code, out, err) = (1, '', 'fake: {0!r}\n'.format(e))
+        self.stdout.feed(out)
+        self.stderr.feed(err)
+        self.returncode = code
+        self.__done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.__done.wait()
+        return self.returncode
+
+    def send_signal(self, sig):
+        pass
+
+
+class _FakeSubprocess(object):
+    PIPE = -1
+
+    def __init__(self, host):
+        self.__host = host
+
+    def Popen(self, argv, **kwargs):
+        return _FakePopen(self.__host, argv, **kwargs)
+
+
+class _FakePart(object):
+    def __init__(self, num, size):
+        self.num = num
+        self.size = size
+        self.guid = str(uuid.uuid4())
+        self.typecode = '00000000-0000-0000-0000-000000000000'
+        self.name = ''
+        self.fstype = None
+        self.fsuuid = None
+        self.files = {}
+
+
+class _FakeDisk(object):
+    def __init__(self, name, size=DISK_SIZE):
+        self.name = name
+        self.size = size
+        self.label = None
+        self.parts = {}
+
+    def free(self):
+        return self.size - sum(p.size for p in self.parts.values())
+
+
+class _FakeHost(object):
+    '''
+    A host with fake disks, cluster and daemons.
+    '''
+    def __init__(self, root, cluster, disks, latency=0.0):
+        self.root = _FakeRoot(root)
+        self.cluster = cluster
+        self.fsid = str(uuid.uuid4())
+        self.latency = latency
+
+        self.disks = dict((name, _FakeDisk(name)) for name in disks)
+        self.mounts = []        # list of (dev, path, fstype, options)
+        self.daemons = {}       # name -> listening admin socket
+        self.auths = {}
+        self.next_osd = 0
+
+        self.calls = {}
+        self.nmounts = 0
+
+        self.__lock = threading.RLock()
+
+        self.sync()
+
+    # ### helpers ### #
+
+    def real(self, path):
+        return self.root.real(path)
+
+    def reset_counters(self):
+        self.calls = {}
+        self.nmounts = 0
+
+    def part_path(self, disk, num):
+        return '/dev/{0}{1}'.format(disk.name, num)
+
+    def find(self, dev):
+        '''
+        :return: (disk, part) of a device path, part is None for a disk.
+        '''
+        name = os.path.realpath(self.real(dev))[len(self.root.root) + 5:]
+        m = re.match(r'(\D+)(\d*)$', name)
+        if not m or m.group(1) not in self.disks:
+            raise ValueError('no such device: {0}'.format(dev))
+        disk = self.disks[m.group(1)]
+        if not m.group(2):
+            return disk, None
+        return disk, disk.parts[int(m.group(2))]
+
+    def find_mount(self, target):
+        for mount in self.mounts:
+            if target in (mount[0], mount[1]):
+                return mount
+        return None
+
+    def sync(self):
+        '''
+        Make the dev, sysfs and procfs trees reflect the model, entries are
+        changed one by one as the module may be reading them concurrently.
+        '''
+        root = self.root.root
+
+        for sub in ('dev/disk/by-partuuid', 'sys/block', 'proc', 'etc/ceph',
+                    'var/lib/ceph/osd', 'var/lib/ceph/mon', 'var/run/ceph'):
+            path = os.path.join(root, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        images = {}     # name -> size
+        links = {}      # partition guid -> name
+
+        for disk in self.disks.values():
+            images[disk.name] = disk.size
+
+            sysdir = os.path.join(root, 'sys/block', disk.name)
+            if not os.path.isdir(sysdir):
+                os.mkdir(sysdir)
+
+            names = set()
+            for part in disk.parts.values():
+                name = '{0}{1}'.format(disk.name, part.num)
+                names.add(name)
+                images[name] = part.size
+                links[part.guid] = name
+
+                if not os.path.isdir(os.path.join(sysdir, name)):
+                    os.mkdir(os.path.join(sysdir, name))
+                    self.__write(os.path.join(sysdir, name, 'partition'),
+                                 '{0}\n'.format(part.num))
+
+            for name in os.listdir(sysdir):
+                if name not in names:
+                    os.remove(os.path.join(sysdir, name, 'partition'))
+                    os.rmdir(os.path.join(sysdir, name))
+
+        devdir = os.path.join(root, 'dev')
+        for name, size in images.items():
+            path = os.path.join(devdir, name)
+            if not os.path.exists(path):
+                with open(path, 'wb') as fobj:
+                    fobj.truncate(size * 1024 * 1024)
+        for name in os.listdir(devdir):
+            path = os.path.join(devdir, name)
+            if os.path.isfile(path) and name not in images:
+                os.remove(path)
+
+        linkdir = os.path.join(root, 'dev/disk/by-partuuid')
+        for guid in os.listdir(linkdir):
+            path = os.path.join(linkdir, guid)
+            if os.readlink(path) != os.path.join('../..', links.get(guid, '')):
+                os.remove(path)
+        for guid, name in links.items():
+            path = os.path.join(linkdir, guid)
+            if not os.path.lexists(path):
+                os.symlink(os.path.join('../..', name), path)
+
+        self.__write(os.path.join(root, 'proc/mounts'), ''.join(
+            '{0} {1} {2} {3} 0 0\n'.format(*mount) for mount in self.mounts
+        ))
+
+    @classmethod
+    def __write(cls, path, content):
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(content)
+        os.rename(tmp, path)
+
+    def mount(self, dev, path, fstype, options):
+        (_, part) = self.find(dev)
+        if part is None or part.fstype is None:
+            raise ValueError('no filesystem on: {0}'.format(dev))
+
+        rpath = self.real(path)
+        for name, content in part.files.items():
+            with open(os.path.join(rpath, name), 'wb') as fobj:
+                fobj.write(content)
+
+        self.mounts.append((dev, path, fstype, options or 'rw'))
+        self.nmounts += 1
+
+    def umount(self, mount):
+        (dev, path, _, _) = mount
+        (_, part) = self.find(dev)
+
+        rpath = self.real(path)
+        part.files = {}
+        for name in os.listdir(rpath):
+            fpath = os.path.join(rpath, name)
+            if os.path.isfile(fpath):
+                with open(fpath, 'rb') as fobj:
+                    part.files[name] = fobj.read()
+                os.remove(fpath)
+            else:
+                shutil.rmtree(fpath)
+
+        self.mounts.remove(mount)
+
+    def start(self, name):
+        '''
+        Start a daemon, i.e. listen on its admin socket.
+        '''
+        if name in self.daemons:
+            return
+
+        path = self.real('/var/run/ceph/{0}-{1}.asok'.format(self.cluster,
+                                                             name))
+        if os.path.exists(path):
+            os.remove(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(128)
+        self.daemons[name] = sock
+
+    def stop(self, name):
+        '''
+        Stop a daemon, its admin socket file is left as a dead daemon does.
+        '''
+        sock = self.daemons.pop(name, None)
+        if sock is not None:
+            sock.close()
+
+    def wipe(self):
+        '''
+        Back to blank disks and no cluster state.
+        '''
+        with self.__lock:
+            for mount in list(self.mounts):
+                self.umount(mount)
+            for disk in self.disks.values():
+                disk.label = None
+                disk.parts = {}
+            for name in list(self.daemons):
+                self.stop(name)
+            self.auths = {}
+            self.sync()
+
+    # ### command dispatch ### #
+
+    def run(self, argv, data):
+        prog = argv[0]
+        name = 'init.d/ceph' if prog == '/etc/init.d/ceph' else prog
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.__lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+            if prog not in FAKE_PROGRAMS:
+                return 127, '', '{0}: command not found\n'.format(prog)
+
+            handler = getattr(self, 'cmd_' + re.sub(r'\W', '_', name))
+
+            try:
+                return handler(argv[1:], data)
+            finally:
+                self.sync()
+
+    @classmethod
+    def __dev_arg(cls, args):
+        return args[args.index('--') + 1] if '--' in args else args[-1]
+
+    def cmd_lsblk(self, args, data):
+        devs = []
+        for disk in sorted(self.disks.values(), key=lambda d: d.name):
+            entry = {
+                'name': '/dev/' + disk.name,
+                'fstype': None, 'uuid': None, 'partuuid': None,
+                'parttype': None, 'partlabel': None, 'pttype': disk.label,
+                'children': [],
+            }
+            for num in sorted(disk.parts):
+                part = disk.parts[num]
+                entry['children'].append({
+                    'name': self.part_path(disk, num),
+                    'fstype': part.fstype, 'uuid': part.fsuuid,
+                    'partuuid': part.guid, 'parttype': part.typecode,
+                    'partlabel': part.name or None, 'pttype': disk.label,
+                })
+            devs.append(entry)
+        return 0, json.dumps({'blockdevices': devs}), ''
+
+    def cmd_blkid(self, args, data):
+        if '-p' not in args:
+            return 2, '', ''
+        (_, part) = self.find(self.__dev_arg(args))
+        if part is None or part.fstype is None:
+            return 2, '', ''
+        key = args[args.index('-s') + 1]
+        return 0, part.fstype if key == 'TYPE' else part.fsuuid, ''
+
+    def cmd_sgdisk(self, args, data):
+        (disk, _) = self.find(self.__dev_arg(args))
+        out = []
+
+        for arg in args:
+            if arg == '--zap-all':
+                disk.label = None
+                disk.parts = {}
+            elif arg == '--clear':
+                disk.label = 'gpt'
+                disk.parts = {}
+            elif arg == '--mbrtogpt':
+                disk.label = disk.label or 'gpt'
+            elif arg == '--print':
+                for num in sorted(disk.parts):
+                    out.append('   {0}   2048   4096   {1}.0 MiB   FFFF  {2}'
+                               .format(num, disk.parts[num].size,
+                                       disk.parts[num].name))
+            elif arg.startswith('--info='):
+                part = disk.parts.get(int(arg.split('=')[1]))
+                if part is not None:
+                    out.append('Partition GUID code: {0}'
+                               .format(part.typecode.upper()))
+                    out.append('Partition unique GUID: {0}'
+                               .format(part.guid.upper()))
+                    out.append("Partition name: '{0}'".format(part.name))
+            elif arg.startswith('--new=') or arg.startswith('--largest-new='):
+                spec = arg.split('=', 1)[1].split(':')
+                num = int(spec[0])
+                if num in disk.parts:
+                    return 4, '', 'partition {0} exists\n'.format(num)
+                size = int(spec[2][1:-1]) if len(spec) == 3 else disk.free()
+                disk.label = disk.label or 'gpt'
+                disk.parts[num] = _FakePart(num, size)
+            elif arg.startswith('--delete='):
+                disk.parts.pop(int(arg.split('=')[1]), None)
+            elif arg.startswith('--partition-guid='):
+                (num, guid) = arg.split('=', 1)[1].split(':', 1)
+                disk.parts[int(num)].guid = guid.lower()
+            elif arg.startswith('--typecode='):
+                (num, typecode) = arg.split('=', 1)[1].split(':', 1)
+                disk.parts[int(num)].typecode = typecode.lower()
+            elif arg.startswith('--change-name='):
+                (num, name) = arg.split('=', 1)[1].split(':', 1)
+                disk.parts[int(num)].name = name
+
+        return 0, '\n'.join(out), ''
+
+    def cmd_parted(self, args, data):
+        (disk, _) = self.find(self.__dev_arg(args))
+        if args[-1] == 'print':
+            label = disk.label or 'unknown'
+            return (1 if label == 'unknown' else 0,
+                    'Partition Table: {0}\n'.format(label), '')
+        if args[-2] == 'mklabel':
+            disk.label = args[-1]
+            disk.parts = {}
+        return 0, '', ''
+
+    def cmd_partprobe(self, args, data):
+        return 0, '', ''
+
+    def cmd_partx(self, args, data):
+        return 0, '', ''
+
+    def cmd_udevadm(self, args, data):
+        return 0, '', ''
+
+    def cmd_mkfs(self, args, data):
+        (_, part) = self.find(self.__dev_arg(args))
+        part.fstype = args[args.index('-t') + 1]
+        part.fsuuid = str(uuid.uuid4())
+        part.files = {}
+        return 0, '', ''
+
+    def cmd_mount(self, args, data):
+        fstype = args[args.index('-t') + 1]
+        options = args[args.index('-o') + 1] if '-o' in args else ''
+        self.mount(args[-2], args[-1], fstype, options)
+        return 0, '', ''
+
+    def cmd_umount(self, args, data):
+        mount = self.find_mount(args[-1])
+        if mount is None:
+            return 32, '', 'umount: {0}: not mounted\n'.format(args[-1])
+        self.umount(mount)
+        return 0, '', ''
+
+    def cmd_debugfs(self, args, data):
+        (_, part) = self.find(args[-1])
+        if part is None or part.fstype != 'ext4':
+            return 1, '', 'Bad magic number in super-block\n'
+        out = []
+        for line in data.splitlines():
+            out.append('debugfs: {0}\n'.format(line))
+            content = part.files.get(line.split('/', 1)[1])
+            if content is not None:
+                out.append(content)
+        return 0, ''.join(out), ''
+
+    def cmd_xfs_db(self, args, data):
+        (_, part) = self.find(args[-1])
+        if part is None or part.fstype != 'xfs':
+            return 1, '', 'not a valid XFS filesystem\n'
+
+        names = sorted(part.files)
+        (root, cur) = (128, 128)
+        out = []
+
+        cmds = [args[i + 1] for i, arg in enumerate(args) if arg == '-c']
+        for cmd in cmds:
+            if cmd == 'path /':
+                cur = root
+            elif cmd.startswith('path /'):
+                name = cmd[6:]
+                if name in part.files:
+                    cur = root + 1 + names.index(name)
+                else:
+                    out.append('{0}: No such file or directory'.format(name))
+            elif cmd == 'inode':
+                out.append('current inode number is {0}'.format(cur))
+            elif cmd.startswith('echo '):
+                out.append(cmd[5:])
+            elif cmd == 'print' and cur != root:
+                content = part.files[names[cur - root - 1]]
+                content += '\0' * (64 - len(content) % 64)
+                for off in range(0, len(content), 16):
+                    chunk = content[off:off + 16]
+                    out.append('{0:03x}: {1}'.format(
+                        off, ' '.join('{0:02x}'.format(ord(c)) for c in chunk)
+                    ))
+
+        return 0, '\n'.join(out) + '\n', ''
+
+    def cmd_ceph_disk(self, args, data):
+        if args[0] == 'prepare':
+            return self.__ceph_disk_prepare(args[3:])
+        if args[0] == 'activate':
+            return self.__ceph_disk_activate(args[1])
+        return 1, '', 'unknown ceph-disk command\n'
+
+    def __new_part(self, disk, typecode, name, size=None):
+        num = 1
+        while num in disk.parts:
+            num += 1
+        part = _FakePart(num, size or disk.free())
+        part.typecode = typecode
+        part.name = name
+        disk.label = disk.label or 'gpt'
+        disk.parts[num] = part
+        return part
+
+    def __ceph_disk_prepare(self, args):
+        osd_uuid = None
+        if args[0] == '--osd-uuid':
+            osd_uuid = args[1]
+            args = args[2:]
+
+        (ddisk, dpart) = self.find(args[0])
+
+        jpart = None
+        if len(args) > 1:
+            (jdisk, jpart) = self.find(args[1])
+            if jpart is None:
+                jpart = self.__new_part(jdisk, JOURNAL_UUID, 'ceph journal',
+                                        JOURNAL_SIZE)
+            jpart.typecode = JOURNAL_UUID
+        elif dpart is None:
+            ddisk.parts = {}
+            jpart = _FakePart(2, JOURNAL_SIZE)
+            jpart.typecode = JOURNAL_UUID
+            jpart.name = 'ceph journal'
+            ddisk.parts[2] = jpart
+
+        if dpart is None:
+            ddisk.label = 'gpt'
+            dpart = _FakePart(1, ddisk.free())
+            dpart.name = 'ceph data'
+            ddisk.parts[1] = dpart
+            dpart.typecode = OSD_UUID
+
+        # ceph-disk uses the OSD uuid as the data partition GUID
+        if osd_uuid is not None:
+            dpart.guid = osd_uuid
+
+        dpart.fstype = 'xfs'
+        dpart.fsuuid = str(uuid.uuid4())
+        dpart.files = {
+            'magic': 'ceph osd volume v026\n',
+            'ceph_fsid': self.fsid + '\n',
+            'fsid': dpart.guid + '\n',
+        }
+        if jpart is not None:
+            dpart.files['journal_uuid'] = jpart.guid + '\n'
+
+        return 0, '', ''
+
+    def __ceph_disk_activate(self, dev):
+        (_, part) = self.find(dev)
+
+        if 'whoami' not in part.files:
+            part.files['whoami'] = '{0}\n'.format(self.next_osd)
+            self.next_osd += 1
+        part.files['ready'] = 'ready\n'
+        part.files['active'] = 'ok\n'
+        part.files['keyring'] = '[osd]\n'
+
+        osdid = int(part.files['whoami'])
+        path = '/var/lib/ceph/osd/{0}-{1}'.format(self.cluster, osdid)
+        if not os.path.isdir(self.real(path)):
+            os.makedirs(self.real(path))
+        if self.find_mount(dev) is None:
+            self.mount(dev, path, part.fstype, 'rw,noatime,inode64')
+
+        self.start('osd.{0}'.format(osdid))
+
+        return 0, '', ''
+
+    def cmd_ceph(self, args, data):
+        opts = {}
+        rest = []
+        idx = 0
+        while idx < len(args):
+            if args[idx].startswith('--'):
+                opts[args[idx]] = args[idx + 1]
+                idx += 2
+            else:
+                rest.append(args[idx])
+                idx += 1
+
+        if rest[0] == 'daemon':
+            if rest[1] in self.daemons:
+                return 0, '{}', ''
+            return errno.EINVAL, '', 'admin_socket: exception\n'
+
+        if rest[0] == 'auth':
+            name = rest[2]
+            if rest[1] == 'get':
+                if name in self.auths:
+                    return 0, self.auths[name], ''
+                return errno.ENOENT, '', 'failed to find {0}\n'.format(name)
+            if rest[1] == 'add':
+                with open(self.real(opts['--in-file']), 'rb') as fobj:
+                    self.auths[name] = fobj.read()
+            elif rest[1] == 'export':
+                with open(self.real(opts['--out-file']), 'wb') as fobj:
+                    fobj.write(self.auths.get(name, ''))
+            elif rest[1] == 'del':
+                self.auths.pop(name, None)
+            return 0, '', ''
+
+        # mon add/remove, osd crush rm, osd rm etc.
+        return 0, '', ''
+
+    def cmd_ceph_conf(self, args, data):
+        name = args[args.index('--name') + 1]
+        (_, eid) = name.split('.', 1)
+
+        defaults = {
+            'mon_data': '/var/lib/ceph/mon/{0}-{1}'.format(self.cluster, eid),
+            'osd_data': '/var/lib/ceph/osd/{0}-{1}'.format(self.cluster, eid),
+            'run_dir': '/var/run/ceph',
+            'osd_journal_size': str(JOURNAL_SIZE),
+            'osd_mkfs_type': 'xfs',
+            'osd_mkfs_options_xfs': '-f',
+            'osd_mount_options_xfs': 'rw,noatime,inode64',
+        }
+
+        if '--show-config' in args:
+            return 0, ''.join('{0} = {1}\n'.format(k, v)
+                              for k, v in sorted(defaults.items())), ''
+
+        key = args[args.index('--show-config-value') + 1]
+        if key in defaults:
+            return 0, defaults[key] + '\n', ''
+        return 1, '', ''
+
+    def cmd_ceph_mon(self, args, data):
+        mon_id = args[args.index('--id') + 1]
+        path = self.real('/var/lib/ceph/mon/{0}-{1}'
+                         .format(self.cluster, mon_id))
+        if not os.path.isdir(os.path.join(path, 'store.db')):
+            os.makedirs(os.path.join(path, 'store.db'))
+        with open(os.path.join(path, 'keyring'), 'wb') as fobj:
+            fobj.write('[mon.]\n')
+        return 0, '', ''
+
+    def cmd_ceph_authtool(self, args, data):
+        keyring = self.real(args[0])
+        name = args[args.index('--name') + 1]
+
+        parser = ConfigParser.RawConfigParser()
+        parser.read(keyring)
+        if not parser.has_section(name):
+            parser.add_section(name)
+        parser.set(name, 'key', args[args.index('--add-key') + 1])
+        for idx, arg in enumerate(args):
+            if arg == '--cap':
+                parser.set(name, 'caps ' + args[idx + 1],
+                           '"{0}"'.format(args[idx + 2]))
+
+        with open(keyring, 'wb') as fobj:
+            parser.write(fobj)
+
+        return 0, '', ''
+
+    def cmd_init_d_ceph(self, args, data):
+        (action, name) = args[-2:]
+        if action in ('start', 'restart'):
+            self.start(name)
+        elif action == 'stop':
+            self.stop(name)
+        return 0, '', ''
+
+
+def _disk_names(count, skip=0):
+    names = []
+    idx = skip + 1      # sda is the system disk
+    while len(names) < count:
+        (name, num) = ('', idx)
+        while True:
+            name = string.ascii_lowercase[num % 26] + name
+            num = num // 26 - 1
+            if num < 0:
+                break
+        names.append('sd' + name)
+        idx += 1
+    return names
+
+
+def _load_module(host):
+    mod = imp.load_source('ceph_deploy_bench', MODULE)
+
+    mod.__salt__ = {'config.get': lambda key, default=None: default}
+    mod.__grains__ = {'id': 'bench', 'host': 'bench'}
+
+    mod.os = _FakeOs(host.root)
+    mod.tempfile = _FakeTempfile(host.root)
+    mod.shutil = _FakeShutil(host.root)
+    mod.socket = _FakeSocketModule(host.root)
+    mod.utils = _FakeUtils(mod.utils)
+    mod.subprocess = _FakeSubprocess(host)
+    mod.open = lambda path, *args: open(host.real(path), *args)
+
+    mod.OSD_CACHE_DIR = host.real('/var/lib/ceph/bench/cache/osd')
+    mod.FINGERPRINT_DIR = host.real('/var/lib/ceph/bench/cache/fingerprint')
+    mod.TRACE_FILE = host.real('/var/lib/ceph/bench/trace.json')
+    mod.RAMP_FILE = host.real('/var/lib/ceph/bench/ramp.json')
+
+    return mod
+
+
+def _new_run(mod):
+    # every state run is a new minion job process, no in-memory caches
+    mod._BlockInventory.invalidate()
+    mod._CephConf._cache.clear()
+
+
+def _measure(mod, host, result, op, func):
+    _new_run(mod)
+    host.reset_counters()
+
+    started = time.time()
+    ret = func()
+    elapsed = time.time() - started
+
+    rets = ret if isinstance(ret, list) else [ret]
+    for r in rets:
+        if not r['result']:
+            raise AssertionError('{0} failed: {1}'.format(op, r['comment']))
+
+    result.append({
+        'op': op,
+        'disks': host.ndata,
+        'seconds': elapsed,
+        'calls': sum(host.calls.values()),
+        'mounts': host.nmounts,
+        'by_program': dict(host.calls),
+    })
+
+
+def bench(ndisks, njournals, latency, workers):
+    letters = ''.join(random.choice(string.ascii_lowercase) for _ in range(8))
+    root = os.path.join(tempfile.gettempdir(), 'cephbench' + letters)
+    if re.search(r'\d', root):
+        raise SystemExit('temp dir: {0} contains digits, set TMPDIR'
+                         .format(root))
+
+    cluster = 'ceph'
+    datas = _disk_names(ndisks)
+    journals = _disk_names(njournals, ndisks)
+
+    host = _FakeHost(root, cluster, datas + journals, latency)
+    host.ndata = ndisks
+
+    # data device -> journal device, as in pillar
+    osds = {}
+    for idx, data in enumerate(datas):
+        journal = '/dev/' + journals[idx % njournals] if journals else ''
+        osds['/dev/' + data] = journal
+
+    ctx = {
+        'global': {
+            'fsid': host.fsid,
+            'mon host': '192.168.0.1',
+            'auth cluster required': 'none',
+            'osd journal size': str(JOURNAL_SIZE),
+        },
+    }
+
+    result = []
+
+    try:
+        mod = _load_module(host)
+
+        _measure(mod, host, result, 'conf_manage (new)',
+                 lambda: mod.conf_manage(ctx, cluster))
+        _measure(mod, host, result, 'conf_manage (managed)',
+                 lambda: mod.conf_manage(ctx, cluster))
+
+        _measure(mod, host, result, 'mon_manage (new)',
+                 lambda: mod.mon_manage('a', 'none', '', '', cluster))
+        _measure(mod, host, result, 'mon_manage (managed)',
+                 lambda: mod.mon_manage('a', 'none', '', '', cluster))
+        _measure(mod, host, result, 'mon_manage (fingerprint)',
+                 lambda: mod.mon_manage('a', 'none', '', '', cluster))
+
+        def manage_all():
+            return [mod.osd_manage(data, journal, cluster)
+                    for data, journal in sorted(osds.items())]
+
+        def manage_batch():
+            return mod.osd_manage_batch(osds, cluster, workers)
+
+        _measure(mod, host, result, 'osd_manage (new)', manage_all)
+        _measure(mod, host, result, 'osd_manage (managed)', manage_all)
+        _measure(mod, host, result, 'osd_manage (fingerprint)', manage_all)
+
+        shutil.rmtree(mod.OSD_CACHE_DIR, ignore_errors=True)
+        shutil.rmtree(mod.FINGERPRINT_DIR, ignore_errors=True)
+        _measure(mod, host, result, 'osd_manage (managed, cold cache)',
+                 manage_all)
+
+        for mount in list(host.mounts):
+            host.umount(mount)
+        shutil.rmtree(mod.OSD_CACHE_DIR, ignore_errors=True)
+        host.sync()
+        _measure(mod, host, result, 'osd_manage (unmounted, cold cache)',
+                 manage_all)
+
+        host.wipe()
+        shutil.rmtree(mod.OSD_CACHE_DIR, ignore_errors=True)
+        _measure(mod, host, result, 'osd_manage_batch (new)', manage_batch)
+        _measure(mod, host, result, 'osd_manage_batch (managed)',
+                 manage_batch)
+        _measure(mod, host, result, 'osd_manage_batch (fingerprint)',
+                 manage_batch)
+
+        def inventory():
+            inv = mod.inventory(cluster)
+            return {'result': len(inv['osds']) == ndisks,
+                    'comment': 'OSDs found: {0}'.format(len(inv['osds']))}
+
+        _measure(mod, host, result, 'inventory', inventory)
+    finally:
+        for name in list(host.daemons):
+            host.stop(name)
+        shutil.rmtree(root, ignore_errors=True)
+
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--disks', default='1,12,36,90',
+                      help='comma separated fleet sizes [%default]')
+    parser.add_option('--journal-disks', type='int', default=0,
+                      help='dedicated journal disks, 0 for colocated '
+                           'journals [%default]')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='simulated cost of each command in ms [%default]')
+    parser.add_option('--workers', type='int', default=8,
+                      help='workers of osd_manage_batch [%default]')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print results as JSON')
+    (options, _) = parser.parse_args()
+
+    results = []
+    for ndisks in [int(x) for x in options.disks.split(',')]:
+        results.extend(bench(ndisks, options.journal_disks,
+                             options.latency / 1000.0, options.workers))
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+
+    fmt = '{0:<38} {1:>6} {2:>10} {3:>7} {4:>7}  {5}'
+    print fmt.format('operation', 'disks', 'seconds', 'calls', 'mounts',
+                     'top programs')
+    for r in results:
+        top = sorted(r['by_program'].items(), key=lambda x: -x[1])[:4]
+        print fmt.format(r['op'], r['disks'], '{0:.3f}'.format(r['seconds']),
+                         r['calls'], r['mounts'],
+                         ' '.join('{0}={1}'.format(k, v) for k, v in top))
+
+
+if __name__ == '__main__':
+    main()